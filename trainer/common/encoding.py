@@ -0,0 +1,52 @@
+from io import BytesIO
+from PIL import Image
+from typing import BinaryIO, Dict, Optional
+
+
+class ImageFormat:
+    """
+    An encoding stored images are saved with. Stored images are read with Image.open, which
+    detects the format from the data, so images saved with different formats read the same way.
+    """
+    name: str
+    pil_format: str
+    extension: str
+    content_type: str
+    options: dict
+
+    def __init__(self, *, name: str, pil_format: str, extension: str, content_type: str, options: Optional[dict] = None):
+        self.name = name
+        self.pil_format = pil_format
+        self.extension = extension
+        self.content_type = content_type
+        self.options = options or {}
+
+    def encode(self, image: Image.Image, output: BinaryIO):
+        if self.pil_format == 'JPEG' and image.mode != 'RGB':
+            # JPEG has no alpha channel
+            image = image.convert('RGB')
+        image.save(output, format=self.pil_format, **self.options)
+
+    def to_bytes(self, image: Image.Image) -> bytes:
+        with BytesIO() as output:
+            self.encode(image, output)
+            return output.getvalue()
+
+
+IMAGE_FORMATS: Dict[str, ImageFormat] = {
+    'png': ImageFormat(name='png', pil_format='PNG', extension='.png', content_type='image/png'),
+    # Lossless, the pixels read back are the same as with png
+    'webp': ImageFormat(name='webp', pil_format='WEBP', extension='.webp', content_type='image/webp',
+                        options={'lossless': True}),
+    'jpeg': ImageFormat(name='jpeg', pil_format='JPEG', extension='.jpg', content_type='image/jpeg',
+                        options={'quality': 95, 'subsampling': 0}),
+}
+
+PNG = IMAGE_FORMATS['png']
+
+
+def image_format(name: str) -> ImageFormat:
+    if name not in IMAGE_FORMATS:
+        raise ValueError(
+            f'Unknown image format {name}, expected one of {", ".join(IMAGE_FORMATS)}')
+    return IMAGE_FORMATS[name]
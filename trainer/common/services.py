@@ -0,0 +1,71 @@
+"""
+Process wide clients for Google APIs. A service is built once per process from the discovery
+document bundled with google-api-python-client, and every request is sent over a kept alive
+connection of the calling thread with retries built in.
+"""
+import threading
+import httplib2
+import google.auth
+import google_auth_httplib2
+
+from googleapiclient.discovery import build as build_api, Resource
+from googleapiclient.http import HttpRequest
+from typing import Dict, Tuple
+
+SCOPES = ['https://www.googleapis.com/auth/spreadsheets']
+# Retries after the first attempt of a request, with randomized exponential backoff on 429 and 5xx.
+# A failed request may still have been applied, so requests that are not safe to repeat, like
+# appending rows, are executed with num_retries=0.
+RETRIES = 4
+TIMEOUT_SECONDS = 30
+
+_services: Dict[Tuple[str, str], Resource] = {}
+_services_lock = threading.Lock()
+_credentials = None
+_credentials_lock = threading.Lock()
+_connections = threading.local()
+
+
+class PooledHttpRequest(HttpRequest):
+    """
+    httplib2 connections are not thread safe, so instead of the connection the service was built
+    with each request runs on a connection that belongs to the calling thread and is reused by its
+    later requests.
+    """
+
+    def execute(self, http=None, num_retries=RETRIES):
+        return super().execute(http=http or _connection(), num_retries=num_retries)
+
+
+def _default_credentials():
+    global _credentials
+    with _credentials_lock:
+        if _credentials is None:
+            _credentials, _ = google.auth.default(scopes=SCOPES)
+        return _credentials
+
+
+def _connection() -> google_auth_httplib2.AuthorizedHttp:
+    http = getattr(_connections, 'http', None)
+    if http is None:
+        http = google_auth_httplib2.AuthorizedHttp(
+            _default_credentials(), http=httplib2.Http(timeout=TIMEOUT_SECONDS))
+        _connections.http = http
+    return http
+
+
+def service(name: str, version: str) -> Resource:
+    with _services_lock:
+        if (name, version) not in _services:
+            try:
+                _services[(name, version)] = build_api(
+                    name, version, http=_connection(), requestBuilder=PooledHttpRequest, static_discovery=True)
+            except TypeError:
+                # Releases before 2.0 do not bundle discovery documents, it is fetched this once
+                _services[(name, version)] = build_api(
+                    name, version, http=_connection(), requestBuilder=PooledHttpRequest, cache_discovery=False)
+        return _services[(name, version)]
+
+
+def sheets_service() -> Resource:
+    return service('sheets', 'v4')
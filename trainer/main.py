@@ -4,17 +4,16 @@ import pytz
 
 import tensorflow as tf
 
-from astral import LocationInfo
-from astral.sun import sun
 from common import twitter, downloader, frozenmodel
 from common.classifier import Classifier
+from common.encoding import image_format
 from common.frozenmodel import Label
 from common.image import preprocess, brand
 from common.sheets import RangeData, ClassificationRow
-from googleapiclient.discovery import build
+from common.services import sheets_service
+from common.solar import solar_calendar
 from datetime import datetime, timedelta
 from google.cloud import storage
-from io import BytesIO
 from PIL import Image
 from typing import List, Optional
 
@@ -22,15 +21,12 @@ LAST_CLASSIFICATION_STATE_FILE = 'is-the-mountain-out-state.txt'
 LAST_IMAGE_STATE_FILE = 'is-the-mountain-out-image.png'
 SPREADSHEET_ID = '1nMkjiqMvsOhj-ljEab2aBvNWy3bJXdot3u2vRXsyI5Q'
 PACIFIC_TIMEZONE = pytz.timezone('US/Pacific')
+# 'png', 'webp' (lossless) or 'jpeg', see common.encoding
+IMAGE_FORMAT = os.environ.get('ISTHEMOUNTAINOUT_SNAPSHOT_FORMAT', 'png')
+
+_storage_client: Optional[storage.Client] = None
 
 
-seattle = LocationInfo(
-    name='Seattle',
-    region='Washington',
-    timezone='America/Los_Angeles',
-    latitude=47.6209673,
-    longitude=-122.348993
-)
 notable_transitions = {
     Label.NIGHT: {Label.NOT_VISIBLE, Label.MYSTICAL, Label.BEAUTIFUL},
     Label.NOT_VISIBLE: {Label.MYSTICAL, Label.BEAUTIFUL},
@@ -115,11 +111,11 @@ def classify(request) -> str:
 
 def __is_night(timestamp: datetime) -> bool:
     date = timestamp.astimezone(PACIFIC_TIMEZONE)
-    info = sun(seattle.observer, date=datetime(
-        year=date.year, month=date.month, day=date.day))
-    is_night = date < info['dawn'] or date > info['dusk']
+    calendar = solar_calendar()
+    is_night = calendar.is_night(date)
+    dawn, dusk = calendar.dawn_and_dusk(date.date())
     print(
-        f"[INFO] is_night={is_night} [now]={date} [dawn]={info['dawn']} [dusk]={info['dusk']}")
+        f"[INFO] is_night={is_night} [now]={date} [dawn]={dawn} [dusk]={dusk}")
     return is_night
 
 
@@ -132,9 +128,16 @@ def __load_brand() -> Image:
     return Image.open(os.path.join('branding', 'branding_1920x1080.png'))
 
 
+def __bucket(name: str) -> storage.Bucket:
+    # One client per process, the bucket handle is built without fetching its metadata
+    global _storage_client
+    if _storage_client is None:
+        _storage_client = storage.Client()
+    return _storage_client.bucket(name)
+
+
 def __load_twitter_keys(*, bucket: str) -> twitter.ApiKeys:
-    client = storage.Client()
-    bucket = client.get_bucket(bucket)
+    bucket = __bucket(bucket)
     blob = bucket.get_blob('is-the-mountain-out-keys.json')
     keys = json.loads(blob.download_as_string().decode('utf-8'))
     return twitter.ApiKeys(
@@ -151,8 +154,7 @@ def __load_weights(*, bucket: str, filepath: str = '/tmp/isthemountainout.h5') -
         return filepath
     else:
         print(f'{filepath} does not exist, downloading weights')
-        client = storage.Client()
-        bucket = client.get_bucket(bucket)
+        bucket = __bucket(bucket)
         blob = bucket.get_blob('isthemountainout.h5')
         with open(filepath, 'wb') as f:
             blob.download_to_file(f)
@@ -184,7 +186,7 @@ def __get_last_classification() -> Label:
 
 def __get_prev_classifications(*, count: int) -> List[ClassificationRow]:
     lastRowRange = __get_latest_classification_range()
-    service = build('sheets', 'v4')
+    service = sheets_service()
     result = service.spreadsheets().values() \
         .get(
             spreadsheetId=SPREADSHEET_ID,
@@ -204,7 +206,7 @@ def __get_prev_classifications(*, count: int) -> List[ClassificationRow]:
 
 
 def __get_latest_classification_range() -> RangeData:
-    service = build('sheets', 'v4')
+    service = sheets_service()
     return RangeData(service.spreadsheets().values()
                      .append(
         spreadsheetId=SPREADSHEET_ID,
@@ -220,7 +222,7 @@ def __get_latest_classification_range() -> RangeData:
 def __update_last_classification(classification: ClassificationRow) -> None:
     print(
         f'[INFO] Updating classification={classification.classification.value}')
-    service = build('sheets', 'v4')
+    service = sheets_service()
     service.spreadsheets().values() \
         .append(
             spreadsheetId=SPREADSHEET_ID,
@@ -228,17 +230,17 @@ def __update_last_classification(classification: ClassificationRow) -> None:
             valueInputOption='USER_ENTERED',
             insertDataOption='INSERT_ROWS',
             body={'values': [classification.asList()]},
-    ).execute()
+    ).execute(num_retries=0)
 
 
 def __store_image(image: Image.Image, *, name: str, bucket: str) -> None:
     print(f'[INFO] Storing image name={name}')
-    client = storage.Client()
-    bucket = client.get_bucket(bucket)
-    blob = bucket.blob(f'mt-rainier-history/Unclassified/{name}.png')
-    imagefile = BytesIO()
-    image.save(imagefile, format='PNG')
-    blob.upload_from_string(imagefile.getvalue())
+    bucket = __bucket(bucket)
+    encoding = image_format(IMAGE_FORMAT)
+    blob = bucket.blob(
+        f'mt-rainier-history/Unclassified/{name}{encoding.extension}')
+    blob.upload_from_string(encoding.to_bytes(
+        image), content_type=encoding.content_type)
 
 
 if __name__ == '__main__':
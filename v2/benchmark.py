@@ -0,0 +1,345 @@
+import os
+import io
+import sys
+import json
+import time
+import shutil
+import tempfile
+import argparse
+import numpy as np
+
+from common.frozenmodel import generate_model, generate_inference_model, region_of_interest_array, Label, REGION_OF_INTEREST_SHAPE
+from common.serving import KerasPredictor, ServingPredictor, export_serving_model
+from datetime import datetime, timedelta
+from typing import Callable, Dict, List, Optional
+
+os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
+
+parser = argparse.ArgumentParser(
+    description='Benchmark parts of the classification pipeline')
+parser.add_argument('suite', choices=[
+                    'inference', 'pipeline', 'encoding'], help='Benchmark suite to run')
+parser.add_argument(
+    '--local-weights', help='Set this flag to the path for the local weights filename, unset will use untrained weights')
+parser.add_argument('--iterations', type=int, default=20,
+                    help='Number of timed iterations for each case')
+parser.add_argument('--warmup', type=int, default=3,
+                    help='Number of untimed iterations before timing each case')
+parser.add_argument(
+    '--output', help='Write the results as JSON to this file instead of stdout')
+parser.add_argument('--latency-ms', type=float, default=0,
+                    help='Simulated round-trip latency of each stand-in remote call')
+parser.add_argument('--camera-size', default='14000x3000',
+                    help='Size of the panorama served by the stand-in camera')
+parser.add_argument(
+    '--snapshots', help='Directory of stored snapshots the encoding suite re-encodes, unset uses a snapshot cropped from the stand-in panorama')
+parser.add_argument(
+    '--baseline', help='Compare against the results of a previous run and fail on regressions')
+parser.add_argument('--tolerance', type=float, default=0.25,
+                    help='Allowed relative slowdown of a mean timing compared to the baseline')
+
+args = parser.parse_args()
+
+
+def measure(function: Callable[[], object], *, iterations: int, warmup: int) -> Dict[str, float]:
+    for _ in range(warmup):
+        function()
+    timings = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        function()
+        timings.append((time.perf_counter() - start) * 1000)
+    return summarize(timings)
+
+
+def summarize(timings_ms: List[float]) -> Dict[str, float]:
+    timings = np.array(timings_ms)
+    return {
+        'count': int(len(timings)),
+        'mean_ms': float(np.mean(timings)),
+        'p50_ms': float(np.percentile(timings, 50)),
+        'p95_ms': float(np.percentile(timings, 95)),
+        'min_ms': float(np.min(timings)),
+    }
+
+
+def write_results(results: Dict[str, object], output: Optional[str]):
+    text = json.dumps(results, indent=2)
+    if output:
+        with open(output, 'w') as f:
+            f.write(text)
+        print(f'wrote results -> {output}')
+    else:
+        print(text)
+
+
+def benchmark_inference() -> Dict[str, object]:
+    """
+    Compare per image CPU latency of model.predict with the traced serving signature, with and
+    without XLA compilation.
+    """
+    model = generate_inference_model(
+        weights_filepath=args.local_weights, can_ignore_weights=args.local_weights is None)
+    batch = np.random.uniform(
+        0, 255, size=(1, *REGION_OF_INTEREST_SHAPE)).astype('float32')
+    predictors = {
+        'keras_predict': KerasPredictor(model),
+        'serving': ServingPredictor.from_model(model),
+        'serving_xla': ServingPredictor.from_model(model, jit_compile=True),
+    }
+    return {
+        name: measure(lambda: predictor.predict(batch),
+                      iterations=args.iterations, warmup=args.warmup)
+        for name, predictor in predictors.items()
+    }
+
+
+def benchmark_pipeline() -> Dict[str, object]:
+    """
+    Time each phase of classify.main separately against local stand-ins for cloud storage, sheets,
+    twitter and the camera, then time main itself end to end.
+    """
+    import standins
+    import tweepy
+    import classify
+    import common.image
+    import common.state
+    from flask import Flask
+    from google.cloud import storage
+    from common.cache import disk_cache
+    from common.config import model_bucket_name, model_filename
+    from common.image import SpaceNeedleImageProvider
+    from common.registry import models
+    from common.sheets import ClassificationRow
+    from common.twitter import TwitterApiKeys, TwitterPoster
+    from common.weights import weights
+    from common.writebehind import write_behind
+
+    root = tempfile.mkdtemp(prefix='isthemountainout-benchmark-')
+    os.environ['ISTHEMOUNTAINOUT_CACHE_DIR'] = os.path.join(root, 'cache')
+    recorder = standins.CallRecorder(latency_ms=args.latency_ms)
+    client = standins.FakeStorageClient(root=root, recorder=recorder)
+    sheets = standins.FakeSheetsService(
+        recorder=recorder, sheets={'StateV2': history_rows()})
+    twitter = standins.FakeTwitter(recorder=recorder)
+    width, height = [int(size) for size in args.camera_size.split('x')]
+
+    storage.Client = client
+    common.state.sheets_service = sheets
+    tweepy.OAuthHandler = tweepy.API = tweepy.Client = twitter
+    try:
+        populate_buckets(client, root)
+        with standins.CameraServer(size=(width, height)) as camera:
+            common.image.space_needle_url = lambda: camera.url
+            provider = SpaceNeedleImageProvider()
+            data = provider.download()[0].read()
+            decoded = provider.decode(io.BytesIO(data))
+            image = provider.resize_and_crop(decoded)
+
+            phases = {
+                'roundshot_fetch': timed(lambda: SpaceNeedleImageProvider().download()[0].read()),
+                'jpeg_decode': timed(lambda: provider.decode(io.BytesIO(data))),
+                'resize_crop': timed(lambda: provider.resize_and_crop(decoded)),
+                'weights_download': timed(download_weights(weights)),
+                'graph_build': timed(lambda: generate_inference_model(weights_filepath=os.path.join(root, model_bucket_name(), model_filename()))),
+            }
+            model = generate_inference_model(weights_filepath=os.path.join(
+                root, model_bucket_name(), model_filename()))
+            predictor = ServingPredictor.from_model(model)
+            batch = region_of_interest_array(image)[np.newaxis]
+            phases['inference'] = timed(lambda: predictor.predict(batch))
+
+            recorder.reset()
+            tracker = classify.ClassificationTracker(
+                common.state.SheetsStateStore())
+            row = ClassificationRow(
+                date=datetime.now(), classification=Label.BEAUTIFUL)
+            # A store reads the history once, so each decision gets a fresh one like an invocation would
+            phases['sheets_should_post'] = timed(lambda: classify.ClassificationTracker(
+                common.state.SheetsStateStore()).should_post(row.classification))
+            phases['sheets_amend'] = timed(lambda: tracker.amend(row))
+            sqlite = common.state.SqliteStateStore(
+                os.path.join(root, 'state.sqlite3'))
+            for history_row in tracker.store.latest(classify.ClassificationTracker.history_size):
+                sqlite.append(history_row)
+            sqlite_tracker = classify.ClassificationTracker(sqlite)
+            phases['sqlite_should_post'] = timed(
+                lambda: sqlite_tracker.should_post(row.classification))
+            phases['sqlite_amend'] = timed(lambda: sqlite_tracker.amend(row))
+            sqlite_tracker.close()
+            phases['twitter_keys'] = timed(
+                lambda: TwitterApiKeys.from_storage())
+            poster = TwitterPoster(keys=TwitterApiKeys.from_storage())
+            phases['twitter_brand_image'] = timed(
+                lambda: poster.brand_image(image))
+            branded = poster.brand_image(image)
+            phases['twitter_post'] = timed(lambda: poster.post(
+                status='benchmark', image=branded, tags=['benchmark']))
+            calls = {name: summarize(timings)
+                     for name, timings in recorder.calls.items()}
+
+            models.clear()
+            app = Flask('benchmark')
+
+            class Request:
+                # Every run sees the same camera frame, force it so each run does the full work
+                json = {'source': 'live', 'force': True}
+
+            def run_main() -> float:
+                """
+                Time until main responds, then let its write behind work finish so runs do not
+                overlap.
+                """
+                start = time.perf_counter()
+                with app.app_context():
+                    classify.main(Request())
+                response_ms = (time.perf_counter() - start) * 1000
+                write_behind().flush()
+                return response_ms
+            cold_ms = run_main()
+            for _ in range(args.warmup):
+                run_main()
+            end_to_end = {'cold_ms': cold_ms, 'warm': summarize(
+                [run_main() for _ in range(args.iterations)])}
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+    return {
+        'phases': phases,
+        'calls': calls,
+        'cache': disk_cache().stats(),
+        'end_to_end': end_to_end,
+    }
+
+
+def benchmark_encoding() -> Dict[str, object]:
+    """
+    Compare the time to encode and decode a snapshot and the bytes stored for every snapshot format.
+    """
+    from PIL import Image
+    from common.encoding import IMAGE_FORMATS
+    from common.image import SpaceNeedleImageProvider
+    from standins import panorama_jpeg
+
+    if args.snapshots:
+        snapshots = []
+        for name in sorted(os.listdir(args.snapshots)):
+            with Image.open(os.path.join(args.snapshots, name)) as image:
+                snapshots.append(image.convert('RGB'))
+    else:
+        width, height = [int(size) for size in args.camera_size.split('x')]
+        provider = SpaceNeedleImageProvider()
+        snapshots = [provider.resize_and_crop(provider.decode(
+            io.BytesIO(panorama_jpeg(size=(width, height)))))]
+
+    def decode(data: bytes):
+        with Image.open(io.BytesIO(data)) as image:
+            image.load()
+
+    results = {}
+    for name, image_format in IMAGE_FORMATS.items():
+        encoded = [image_format.to_bytes(snapshot) for snapshot in snapshots]
+        results[name] = {
+            'encode': timed(lambda: [image_format.to_bytes(snapshot) for snapshot in snapshots]),
+            'decode': timed(lambda: [decode(data) for data in encoded]),
+            'mean_bytes': int(np.mean([len(data) for data in encoded])),
+        }
+    return {'snapshots': len(snapshots), 'formats': results}
+
+
+def timed(function: Callable[[], object]) -> Dict[str, float]:
+    return measure(function, iterations=args.iterations, warmup=args.warmup)
+
+
+def download_weights(weights) -> Callable[[], None]:
+    def download():
+        with weights():
+            pass
+    return download
+
+
+def history_rows() -> List[List[str]]:
+    now = datetime.now()
+    rows = []
+    for index in reversed(range(100)):
+        date = now - timedelta(minutes=10 * (index + 1))
+        label = Label.NIGHT if index > 80 else Label.HIDDEN
+        rows.append([date.strftime('%Y-%m-%dT%H:%M:%S'),
+                    label.value, 'TRUE' if index == 80 else 'FALSE'])
+    return rows
+
+
+def populate_buckets(client, root: str):
+    """
+    Store untrained weights, the exported serving model, a brand image and twitter keys in the
+    stand-in buckets where classify.py expects them.
+    """
+    from common.config import model_bucket_name, model_filename, serving_model_filename, brand_bucket_name, brand_filename, twitter_api_key_bucket_name, twitter_api_key_filename
+    from PIL import Image
+
+    bucket = client.bucket(model_bucket_name())
+    weights_filename = os.path.join(root, 'weights.h5')
+    generate_model(weights_filepath=None,
+                   can_ignore_weights=True).save_weights(weights_filename)
+    bucket.blob(model_filename()).upload_from_filename(weights_filename)
+    export_directory = os.path.join(root, 'serving')
+    export_serving_model(generate_inference_model(
+        weights_filepath=weights_filename), export_directory)
+    archive = shutil.make_archive(export_directory, 'zip', root_dir=export_directory)
+    bucket.blob(serving_model_filename()).upload_from_filename(archive)
+
+    with io.BytesIO() as output:
+        Image.new('RGBA', (1920, 1080), (0, 0, 0, 0)).save(output, format='PNG')
+        client.bucket(brand_bucket_name()).blob(
+            brand_filename()).upload_from_string(output.getvalue())
+    client.bucket(twitter_api_key_bucket_name()).blob(twitter_api_key_filename()).upload_from_string(json.dumps({
+        'consumer_key': 'key',
+        'consumer_key_secret': 'secret',
+        'access_token': 'token',
+        'access_token_secret': 'secret',
+    }))
+
+
+def regressions(results: Dict[str, object], baseline: Dict[str, object], *, tolerance: float, path: str = '') -> List[str]:
+    """
+    Every mean timing that is more than tolerance slower than the same timing in the baseline.
+    """
+    found = []
+    for key, value in results.items():
+        name = f'{path}.{key}' if path else key
+        if isinstance(value, dict) and isinstance(baseline.get(key), dict):
+            found.extend(regressions(
+                value, baseline[key], tolerance=tolerance, path=name))
+        elif key in ('mean_ms', 'cold_ms') and isinstance(baseline.get(key), (int, float)):
+            if value > baseline[key] * (1 + tolerance):
+                found.append(
+                    f'{name}: {value:.2f}ms vs baseline {baseline[key]:.2f}ms')
+    return found
+
+
+def check_baseline(results: Dict[str, object]):
+    if not args.baseline:
+        return
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    found = regressions(results, baseline, tolerance=args.tolerance)
+    for regression in found:
+        print(f'Regression {regression}')
+    if found:
+        sys.exit(1)
+
+
+if args.suite == 'inference':
+    results = {'inference': benchmark_inference()}
+    write_results(results, args.output)
+    check_baseline(results)
+elif args.suite == 'pipeline':
+    results = {'pipeline': benchmark_pipeline()}
+    write_results(results, args.output)
+    check_baseline(results)
+elif args.suite == 'encoding':
+    results = {'encoding': benchmark_encoding()}
+    write_results(results, args.output)
+    check_baseline(results)
+else:
+    print(f'Unknown suite {args.suite}')
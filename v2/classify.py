@@ -4,21 +4,31 @@ import tensorflow as tf
 import numpy as np
 import json
 import pytz
+import tweepy
 
-from astral import LocationInfo
-from astral.sun import sun
-from common.config import model_bucket_name
+from common.config import model_bucket_name, serving_model_filename, quantized_model_filename, posted_prefix, write_behind_bucket_name, write_behind_enabled
+from common.pipeline import prefetch, batched
 from common.image import LatestSnapshotImageProvider, SpaceNeedleImageProvider, ImageProvider, TimestampedSnapshotImageProvider
-from common.frozenmodel import generate_model, labels, Label
-from common.storage import GcpBucketStorage
-from common.weights import weights
-from common.sheets import ClassificationRow, RangeData
+from common.frozenmodel import generate_inference_model, region_of_interest_array, labels, Label
+from common.registry import models
+from common.serving import Predictor, KerasPredictor, ServingPredictor, TfLitePredictor, convert_to_tflite
+from common.storage import Storage, bucket_storage
+from common.weights import weights, weights_version, model_archive
+from common.sheets import ClassificationRow
+from common.state import StateStore, state_store
 from common.twitter import TwitterApiKeys, TwitterPoster
+from common.frames import ProcessedFrameRecord
+from common.solar import solar_calendar
+from common import tracing
+from common.tracing import span, traced, propagate
+from common.writebehind import write_behind
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from datetime import datetime, timedelta
-from googleapiclient.discovery import build as build_api, Resource
 from PIL import Image
-from typing import Optional, Tuple, List
+from typing import Iterator, Optional, Tuple, List
 from flask import make_response
+from google.api_core.exceptions import NotFound, PreconditionFailed
 
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
 
@@ -27,69 +37,176 @@ parser = argparse.ArgumentParser(
 parser.add_argument('source', choices=[
                     'live', 'snapshot'], help='Source image provider')
 parser.add_argument(
-    '--local-weights', help='Set this flag to the path for the local weights filename, unset will load weights from cloud storage')
+    '--local-weights', help='Set this flag to the path for the local weights filename (or exported serving model directory, or .tflite model), unset will load weights from cloud storage')
+parser.add_argument('--model-format', choices=['serving', 'keras', 'tflite'], default='serving',
+                    help='Run the exported serving signature, the keras model or the quantized tflite model')
 parser.add_argument('--snapshot-timestamp',
                     help='Set this flag to the snapshot timestamp to use for classification')
+parser.add_argument('--range-start',
+                    help='Classify every snapshot taken from this timestamp on, must be used with --range-end')
+parser.add_argument('--range-end',
+                    help='Classify every snapshot taken up to this timestamp, must be used with --range-start')
+parser.add_argument('--batch-size', type=int, default=16,
+                    help='Number of snapshots to classify at once when classifying a range')
+parser.add_argument('--force', action='store_true',
+                    help='Classify even if the latest frame has already been processed')
+parser.add_argument('--trace', action='store_true',
+                    help='Emit timed spans and include a summary of them in the response')
+parser.add_argument('--output', default='classifications.jsonl',
+                    help='File to write range classifications to')
 
 PACIFIC_TIMEZONE = pytz.timezone('US/Pacific')
+# Runs the independent fetches that come before a classification is decided
+io_executor = ThreadPoolExecutor(max_workers=4)
+# A post that could not be sent within this long is no longer news
+post_max_age = timedelta(minutes=30)
 
 
 class Classifier:
-    seattle = LocationInfo(
-        name='Seattle',
-        region='Washington',
-        timezone='America/Los_Angeles',
-        latitude=47.6209673,
-        longitude=-122.348993
-    )
-    model_bucket: GcpBucketStorage
+    model_bucket: Storage
     image_source: str
     local_weights: Optional[str]
     snapshot_timestamp: Optional[str]
+    model_format: str
+    __image_provider: Optional[ImageProvider]
 
-    def __init__(self, *, image_source: str, local_weights: Optional[str] = None, snapshot_timestamp: Optional[str] = None):
-        self.model_bucket = GcpBucketStorage(bucket_name=model_bucket_name())
+    def __init__(self, *, image_source: str, local_weights: Optional[str] = None, snapshot_timestamp: Optional[str] = None, model_format: str = 'serving'):
+        self.model_bucket = bucket_storage(bucket_name=model_bucket_name())
         self.image_source = image_source
         self.local_weights = local_weights
         self.snapshot_timestamp = snapshot_timestamp
+        self.model_format = model_format
+        self.__image_provider = None
+
+    @property
+    def image_provider(self) -> ImageProvider:
+        if self.__image_provider is None:
+            self.__image_provider = self._get_image_provider(self.image_source)
+        return self.__image_provider
+
+    def _load_model(self) -> Predictor:
+        if self.model_format == 'keras':
+            return models.get(
+                'classifier-keras',
+                version=weights_version(local_filename=self.local_weights),
+                load=lambda: KerasPredictor(self.__build_model()))
+        elif self.model_format == 'serving':
+            try:
+                version = weights_version(
+                    local_filename=self.local_weights, filename=serving_model_filename())
+            except NotFound:
+                # Until the serving model is exported, trace the serving function from the weights
+                return models.get(
+                    'classifier-serving-traced',
+                    version=weights_version(),
+                    load=lambda: ServingPredictor.from_model(self.__build_model()))
+            return models.get(
+                'classifier-serving',
+                version=version,
+                load=self.__load_serving_model)
+        elif self.model_format == 'tflite':
+            return models.get(
+                'classifier-tflite',
+                version=weights_version(
+                    local_filename=self.local_weights, filename=quantized_model_filename()),
+                load=self.__load_tflite_model)
+        else:
+            raise Exception(f'Unknown model format {self.model_format}')
 
-    def _load_model(self):
+    def __build_model(self):
         with weights(local_filename=self.local_weights) as filepath:
-            return generate_model(weights_filepath=filepath)
+            return generate_inference_model(weights_filepath=filepath)
+
+    def __load_serving_model(self) -> Predictor:
+        if self.local_weights and not os.path.isdir(self.local_weights):
+            # Local keras weights have not been exported yet, so trace the serving function in process
+            return ServingPredictor.from_model(self.__build_model())
+        with model_archive(serving_model_filename(), local_directory=self.local_weights) as directory:
+            return ServingPredictor.from_saved_model(directory)
+
+    def __load_tflite_model(self) -> Predictor:
+        if self.local_weights and not self.local_weights.endswith('.tflite'):
+            # Local keras weights have not been quantized yet, so convert them in process. Dynamic
+            # range quantization needs no calibration images.
+            return TfLitePredictor(tf.lite.Interpreter(model_content=convert_to_tflite(
+                self.__build_model(), quantization='dynamic')))
+        with weights(local_filename=self.local_weights, filename=quantized_model_filename()) as filepath:
+            return TfLitePredictor.from_file(filepath)
 
     def classify(self, *, image: Image.Image):
+        return self.classify_batch(images=[image])[0]
+
+    def classify_batch(self, *, images: List[Image.Image]) -> List[Label]:
         model = self._load_model()
-        img_array = tf.keras.utils.img_to_array(
-            image).astype('float32')
-        img_array = tf.expand_dims(img_array, 0)
-        score = tf.nn.softmax(model.predict(img_array))
-        return labels()[np.argmax(score, axis=1)[0]]
+        batch = np.stack([region_of_interest_array(image) for image in images])
+        return self.__labels_of(model, batch)
 
+    def classify_range(self, start: datetime, end: datetime, *, batch_size: int = 16, workers: int = 8) -> Iterator[List[ClassificationRow]]:
+        """
+        Classify every snapshot taken between start and end. Snapshots are downloaded and decoded on
+        a thread pool while the previous batch is being classified, and classifications are yielded
+        one batch at a time so they can be written out in bulk.
+        """
+        model = self._load_model()
+        provider = TimestampedSnapshotImageProvider()
+        snapshots = provider.blobs_between(start, end)
+        print(f'Classifying {len(snapshots)} snapshots from {start} to {end}')
+
+        def load(snapshot):
+            blob, date = snapshot
+            return date, region_of_interest_array(provider.load(blob))
+
+        for batch in batched(prefetch(load, snapshots, workers=workers, depth=batch_size * 2), size=batch_size):
+            dates = [date for date, _ in batch]
+            classifications = self.__labels_of(
+                model, np.stack([array for _, array in batch]))
+            yield [
+                ClassificationRow(
+                    date=date,
+                    classification=self._correct_for_time_of_day(date, classification))
+                for date, classification in zip(dates, classifications)]
+
+    def __load_model_traced(self) -> Predictor:
+        with span('classifier.load_model', model_format=self.model_format):
+            return self._load_model()
+
+    def __labels_of(self, model: Predictor, batch: np.ndarray) -> List[Label]:
+        indices, _ = model.predict(batch)
+        return [labels()[index] for index in indices]
+
+    @traced('classifier.classify_next')
     def classify_next(self) -> Tuple[ClassificationRow, Image.Image]:
-        image_provider = self._get_image_provider(self.image_source)
-        image, date = image_provider.get()
+        # The model loads (or is found in the registry) while the image is fetched
+        model = io_executor.submit(propagate(self.__load_model_traced))
+        with span('classifier.get_image', source=self.image_source):
+            image, date = self.image_provider.get()
+            batch = region_of_interest_array(image)[np.newaxis]
 
         print(f'Classifying image for date {date}')
-        classification = self.classify(image=image)
+        with span('classifier.wait_for_model'):
+            predictor = model.result()
+        with span('classifier.classify'):
+            classification = self._correct_for_time_of_day(
+                date, self.__labels_of(predictor, batch)[0])
+
+        return ClassificationRow(
+            date=date,
+            classification=classification), image
 
+    def _correct_for_time_of_day(self, date: datetime, classification: Label) -> Label:
         if self.__is_night(date) and classification != Label.NIGHT:
             print(
                 f'Faulty classification detected, defaulting to {Label.NIGHT}: was {classification}, but is actually night time')
-            classification = Label.NIGHT
+            return Label.NIGHT
         elif not self.__is_night(date) and classification == Label.NIGHT:
             print(
                 f'Faulty classification detected, defaulting to {Label.HIDDEN}: was {classification}, but is not night time')
-            classification = Label.HIDDEN
-
-        return ClassificationRow(
-            date=date,
-            classification=classification), image
+            return Label.HIDDEN
+        else:
+            return classification
 
     def __is_night(self, timestamp: datetime) -> bool:
-        date = timestamp.replace(tzinfo=PACIFIC_TIMEZONE)
-        info = sun(Classifier.seattle.observer, date=datetime(
-            year=date.year, month=date.month, day=date.day, tzinfo=PACIFIC_TIMEZONE))
-        return date < info['dawn'] or date > info['dusk']
+        return solar_calendar().is_night(timestamp)
 
     def _get_image_provider(self, source: str) -> ImageProvider:
         if source == 'live':
@@ -106,64 +223,27 @@ class Classifier:
 
 
 class ClassificationTracker:
-    spreadsheet_id = '1nMkjiqMvsOhj-ljEab2aBvNWy3bJXdot3u2vRXsyI5Q'
-    spreadsheet_sheet_name = 'StateV2'
-    spreadsheet_range = f'{spreadsheet_sheet_name}!A2:C'
     notable_transitions = {
         Label.NIGHT: {Label.HIDDEN, Label.MYSTICAL, Label.BEAUTIFUL},
         Label.HIDDEN: {Label.MYSTICAL, Label.BEAUTIFUL},
         Label.MYSTICAL: {Label.BEAUTIFUL},
         Label.BEAUTIFUL: {Label.HIDDEN},
     }
-    service: Resource
+    # Search back 100 (around 2 days) rows to see when the last posted classification was
+    history_size = 100
+    store: StateStore
 
-    def __init__(self) -> None:
-        self.service = build_api('sheets', 'v4')
+    def __init__(self, store: Optional[StateStore] = None) -> None:
+        self.store = store if store is not None else state_store()
 
+    @traced('tracker.amend')
     def amend(self, classification: ClassificationRow):
-        spreadsheet_data = self.service.spreadsheets() \
-            .get(spreadsheetId=ClassificationTracker.spreadsheet_id) \
-            .execute()
-        state_sheet = list(filter(
-            lambda sheet: sheet['properties']['title'] ==
-            ClassificationTracker.spreadsheet_sheet_name, spreadsheet_data['sheets']))[0]
-        state_sheet_id = state_sheet['properties']['sheetId']
-        self.service.spreadsheets().values().append(
-            spreadsheetId=ClassificationTracker.spreadsheet_id,
-            range=ClassificationTracker.spreadsheet_range,
-            valueInputOption='USER_ENTERED',
-            insertDataOption='INSERT_ROWS',
-            body={'values': [classification.as_list()]},
-        ).execute()
-        last_classification_range = self.__get_latest_classification_range()
-        self.service.spreadsheets().batchUpdate(
-            spreadsheetId=ClassificationTracker.spreadsheet_id,
-            body={
-                'requests': [{
-                    'copyPaste': {
-                        'source': {
-                            'sheetId': state_sheet_id,
-                            'startColumnIndex': 3,
-                            'endColumnIndex': 4,
-                            'startRowIndex': 1,
-                            'endRowIndex': 2,
-                        },
-                        'destination': {
-                            'sheetId': state_sheet_id,
-                            'startColumnIndex': 3,
-                            'endColumnIndex': 4,
-                            # Index for row starts at 1, so subtract an additional row to
-                            # get the proper starting location
-                            'startRowIndex': last_classification_range.start_cell.row - 2,
-                            'endRowIndex': last_classification_range.start_cell.row - 1,
-                        },
-                        'pasteType': 'PASTE_FORMULA',
-                        'pasteOrientation': 'NORMAL',
-                    },
-                }],
-            }
-        ).execute()
+        self.store.append(classification)
+
+    def close(self):
+        self.store.close()
 
+    @traced('tracker.should_post')
     def should_post(self, classification: Label) -> bool:
         last_classification = self.read_last_notable_classification()
         new_classification_is_notable = classification in ClassificationTracker.notable_transitions[
@@ -188,9 +268,10 @@ class ClassificationTracker:
             return True
 
     def will_classification_settle_with(self, classification: Label) -> bool:
-        history = [
-            c.classification for c in self.__read_latest_classifications(count=2)]
-        will_it_settle = all(c == classification for c in history)
+        state = self.store.notable_state()
+        will_it_settle = state.settles_with(classification, count=2)
+        history = [state.last_classification] * \
+            min(state.streak, 2) if state.last_classification else []
         next_history = [c.value for c in [*history, classification]]
         if will_it_settle:
             print(
@@ -210,84 +291,166 @@ class ClassificationTracker:
         yesterday = datetime.now(PACIFIC_TIMEZONE).date() - \
             timedelta(days=1)
 
-        # Search back 100 (around 2 days) rows to see when the last posted
-        # classification was and take that as the last classification.
-        for row in reversed(self.__read_latest_classifications(count=100)):
-            if row.was_posted or row.classification == Label.NIGHT:
-                return row.classification
-            elif row.date.date() == yesterday:
-                print(
-                    f'Post not found since yesterday, assuming {Label.NIGHT}')
-                return Label.NIGHT
-
-        # If there has been no posts or night found, just assume that there was
-        # night at some point
-        return Label.NIGHT
-
-    def __read_latest_classifications(self, *, count: int) -> List[ClassificationRow]:
-        range = self.__get_latest_classification_range()
-        response = self.service.spreadsheets().values().get(
-            spreadsheetId=ClassificationTracker.spreadsheet_id,
-            range=str(RangeData.of(
-                sheet_name=range.sheet_name,
-                start=range.start_cell.minus_rows(count, min_row=2),
-                end=range.end_cell,
-            ))
-        ).execute()
-        return [
-            ClassificationRow(
-                date=datetime.strptime(
-                    value[0], r'%Y-%m-%dT%H:%M:%S').replace(tzinfo=PACIFIC_TIMEZONE),
-                classification=Label(value[1]),
-                was_posted=True if value[2] == 'TRUE' else False,
-            ) for value in response.get('values', [])]
-
-    def __get_latest_classification_range(self) -> RangeData:
-        response = self.service.spreadsheets().values().append(
-            spreadsheetId=ClassificationTracker.spreadsheet_id,
-            range=ClassificationTracker.spreadsheet_range,
-            valueInputOption='USER_ENTERED',
-            body={'values': [['', '', '']]}
-        ).execute()
-        return RangeData(response.get('updates', {}).get('updatedRange', ''))
+        return self.store.notable_state().last_notable_classification(
+            yesterday=yesterday, history_size=ClassificationTracker.history_size)
+
+
+def amend_classification(store: StateStore, payload: dict, image: Optional[Image.Image]):
+    """
+    Append the row to the store the decision was made with, then mark its frame as processed. A
+    frame only counts as processed once its row is written, so a failed write is classified again.
+    Both steps skip what is already done, so a retry only redoes the step that failed, and a replayed
+    row that is older than the last row is not appended after it.
+    """
+    row = ClassificationRow.from_list(payload['row'])
+    store.append(row)
+    ProcessedFrameRecord().mark_processed(
+        payload.get('source'), payload.get('frame'), date=row.date)
+
+
+def post_classification(payload: dict, image: Optional[Image.Image]):
+    """
+    Post the classification at most once. A marker for its date is saved before the tweet is
+    created, so a retry after the tweet may have gone out does not post it again. The marker is only
+    removed when twitter rejected the tweet, since then nothing was posted.
+    """
+    label = Label(payload['label'])
+    storage = bucket_storage(bucket_name=write_behind_bucket_name())
+    marker = f'{posted_prefix()}{payload["date"]}.json'
+    if storage.get(marker) is not None:
+        print(f'Classification of {payload["date"]} was already posted')
+        return
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        keys = executor.submit(propagate(TwitterApiKeys.from_storage))
+        brand = executor.submit(propagate(TwitterPoster.load_brand))
+        twitter = TwitterPoster(keys=keys.result())
+        media_id = twitter.upload(twitter.brand_image(image, brand=brand.result()))
+    try:
+        storage.save_bytes(json.dumps(payload).encode('utf-8'), filename=marker,
+                           content_type='application/json', if_generation_match=0)
+    except PreconditionFailed:
+        print(f'Classification of {payload["date"]} was already posted')
+        return
+    try:
+        twitter.tweet(status=twitter.status_for_label(label),
+                      tags=twitter.tags_for_label(label), media_id=media_id)
+    except tweepy.errors.HTTPException as error:
+        if error.response is not None and error.response.status_code < 500:
+            storage.delete(marker)
+        raise
 
 
 def main(request):
     req = request.json
-    classifier = Classifier(
-        image_source=req.get('source', 'snapshot'),
-        local_weights=req.get('local_weights', None),
-        snapshot_timestamp=req.get('snapshot_timestamp', None))
-    classification, image = classifier.classify_next()
-    print('Classification', classification)
-    classification_tracker = ClassificationTracker()
-
-    if classification_tracker.should_post(classification.classification):
-        classification.was_posted = True
-        classification_tracker.amend(classification)
-        twitter = TwitterPoster(keys=TwitterApiKeys.from_storage())
-        twitter.post(
-            status=twitter.status_for_label(classification.classification),
-            image=twitter.brand_image(image),
-            tags=twitter.tags_for_label(classification.classification))
-    else:
-        classification_tracker.amend(classification)
-
-    return make_response((json.dumps({
+    # Tracing can be turned on for a single invocation, which also adds the timings to the response
+    trace = bool(req.get('trace', False))
+    tracing.enable(trace or tracing.enabled_by_environment())
+    tracing.start_trace()
+
+    with span('main', source=req.get('source', 'snapshot')):
+        classifier = Classifier(
+            image_source=req.get('source', 'snapshot'),
+            local_weights=req.get('local_weights', None),
+            snapshot_timestamp=req.get('snapshot_timestamp', None),
+            model_format=req.get('model_format', 'serving'))
+
+        # The frame check reads run at once, the history is only read once there is a new frame
+        frame_record = ProcessedFrameRecord()
+        last_frame = io_executor.submit(propagate(
+            frame_record.last_processed), classifier.image_source)
+        with span('main.frame'):
+            frame = classifier.image_provider.frame()
+
+        # Skip all work when the camera has not published a new frame since the last invocation
+        if not req.get('force', False) and frame is not None and last_frame.result() == frame:
+            print(f'Frame {frame} has already been processed, skipping')
+            response = {'skipped': True, 'frame': frame}
+            if trace:
+                response['trace'] = tracing.summary()
+            return make_response((json.dumps(response), 200, {'Content-Type': 'application/json'}))
+
+        # Reading the history overlaps classifying the frame
+        classification_tracker = ClassificationTracker()
+        notable_state = io_executor.submit(
+            propagate(classification_tracker.store.notable_state))
+        classification, image = classifier.classify_next()
+        print('Classification', classification)
+        with span('main.wait_for_state'):
+            notable_state.result()
+        classification.was_posted = classification_tracker.should_post(
+            classification.classification)
+
+        # Writing the state and posting do not change the response, they finish in the background.
+        # The amend appends with the store that made the decision, so the history is not read again.
+        # When the response waits for them anyway they are only journaled if they fail.
+        store = classification_tracker.store
+        work = write_behind()
+        journal = write_behind_enabled()
+        work.register('amend', partial(
+            amend_classification, store), ordered=True)
+        work.register('post', post_classification,
+                      max_age=post_max_age)
+        work.drain()
+        amended = work.submit('amend', {
+            'row': classification.as_list(),
+            'source': classifier.image_source,
+            'frame': frame,
+        }, journal=journal)
+        amended.add_done_callback(lambda _: store.close())
+        if classification.was_posted:
+            work.submit('post', {
+                'label': classification.classification.value,
+                'date': classification.date.strftime('%Y-%m-%dT%H:%M:%S'),
+            }, image=image, journal=journal)
+        if not journal:
+            with span('main.write_behind'):
+                work.flush()
+
+    response = {
         'date': classification.date.isoformat(),
         'classification': classification.classification.name,
-    }), 200, {'Content-Type': 'application/json'}))
+    }
+    if trace:
+        response['trace'] = tracing.summary()
+    return make_response((json.dumps(response), 200, {'Content-Type': 'application/json'}))
+
+
+def classify_range(args):
+    classifier = Classifier(
+        image_source='snapshot',
+        local_weights=args.local_weights,
+        model_format=args.model_format)
+    start = datetime.strptime(args.range_start, '%Y-%m-%dT%H:%M:%S')
+    end = datetime.strptime(args.range_end, '%Y-%m-%dT%H:%M:%S')
+    count = 0
+    with open(args.output, 'w') as f:
+        for rows in classifier.classify_range(start, end, batch_size=args.batch_size):
+            f.writelines([json.dumps({
+                'date': row.date.strftime('%Y-%m-%dT%H:%M:%S'),
+                'classification': row.classification.name,
+            }) + '\n' for row in rows])
+            count += len(rows)
+            print(f'Classified {count} snapshots')
+    print(f'Wrote {count} classifications to {args.output}')
 
 
 if __name__ == '__main__':
     args = parser.parse_args()
 
-    class FakeRequest:
-        @ property
-        def json(self):
-            return {
-                'source': args.source,
-                'local_weights': args.local_weights,
-                'snapshot_timestamp': args.snapshot_timestamp,
-            }
-    main(FakeRequest())
+    if args.range_start or args.range_end:
+        if not (args.range_start and args.range_end):
+            parser.error('--range-start and --range-end must be used together')
+        classify_range(args)
+    else:
+        class FakeRequest:
+            @ property
+            def json(self):
+                return {
+                    'source': args.source,
+                    'local_weights': args.local_weights,
+                    'snapshot_timestamp': args.snapshot_timestamp,
+                    'model_format': args.model_format,
+                    'trace': args.trace,
+                    'force': args.force,
+                }
+        main(FakeRequest())
@@ -0,0 +1,281 @@
+import os
+import json
+import shutil
+import hashlib
+import tempfile
+import threading
+
+from collections import OrderedDict
+from common.config import cache_directory, cache_max_bytes
+from common.encoding import ImageFormat, PNG
+from common.storage import Storage, bucket_storage
+from contextlib import contextmanager
+from google.api_core.exceptions import NotFound
+from io import BytesIO
+from PIL import Image
+from typing import Dict, Iterator, List, Optional
+
+
+class CachedBlob:
+    """
+    A file read through the cache, standing in for the parts of a storage.Blob callers use.
+    """
+    name: str
+    generation: Optional[int]
+    etag: Optional[str]
+    size: int
+    path: str
+
+    def __init__(self, *, name: str, generation: Optional[int], etag: Optional[str], size: int, path: str):
+        self.name = name
+        self.generation = generation
+        self.etag = etag
+        self.size = size
+        self.path = path
+
+    def download_as_bytes(self, **kwargs) -> bytes:
+        with open(self.path, 'rb') as f:
+            return f.read()
+
+    def download_as_string(self, **kwargs) -> bytes:
+        return self.download_as_bytes()
+
+    def download_to_filename(self, filename: str, **kwargs):
+        shutil.copyfile(self.path, filename)
+
+
+class DiskCache:
+    """
+    Files kept in a local directory up to a byte budget, evicting the least recently used first.
+    The index is saved next to the files so batch jobs reuse the cache between runs. Files that
+    are pinned are in use and never evicted.
+    """
+    directory: str
+    max_bytes: int
+    entries: 'OrderedDict[str, dict]'
+    pins: Dict[str, int]
+    hits: int
+    misses: int
+    evictions: int
+    lock: threading.RLock
+
+    def __init__(self, *, directory: str, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.pins = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.RLock()
+        os.makedirs(directory, exist_ok=True)
+        self.entries = self.__read_index()
+
+    def lookup(self, key: str) -> Optional[dict]:
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or not os.path.exists(self.path_of(key)):
+                return None
+            self.entries.move_to_end(key)
+            return entry
+
+    def store(self, key: str, temporary_filename: str, *, generation: Optional[int], etag: Optional[str]) -> dict:
+        with self.lock:
+            os.replace(temporary_filename, self.path_of(key))
+            entry = {
+                'generation': generation,
+                'etag': etag,
+                'size': os.path.getsize(self.path_of(key)),
+            }
+            self.entries[key] = entry
+            self.entries.move_to_end(key)
+            self.__evict()
+            self.__write_index()
+            return entry
+
+    def remove(self, key: str):
+        with self.lock:
+            if self.entries.pop(key, None) is not None:
+                self.__unlink(key)
+                self.__write_index()
+
+    def record(self, *, hit: bool):
+        with self.lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    @contextmanager
+    def pinned(self, key: str):
+        with self.lock:
+            self.pins[key] = self.pins.get(key, 0) + 1
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.pins[key] -= 1
+                if not self.pins[key]:
+                    del self.pins[key]
+
+    def path_of(self, key: str) -> str:
+        # Keep the extension, some loaders pick the format from it
+        _, extension = os.path.splitext(key)
+        return os.path.join(self.directory, hashlib.sha256(key.encode('utf-8')).hexdigest() + extension)
+
+    def size(self) -> int:
+        with self.lock:
+            return sum(entry['size'] for entry in self.entries.values())
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'files': len(self.entries),
+                'bytes': self.size(),
+                'max_bytes': self.max_bytes,
+            }
+
+    def __evict(self):
+        total = self.size()
+        newest = next(reversed(self.entries), None)
+        for key in list(self.entries.keys()):
+            if total <= self.max_bytes:
+                break
+            if key in self.pins or key == newest:
+                # Never evict what is in use or was just stored
+                continue
+            total -= self.entries.pop(key)['size']
+            self.__unlink(key)
+            self.evictions += 1
+
+    def __unlink(self, key: str):
+        try:
+            os.unlink(self.path_of(key))
+        except FileNotFoundError:
+            pass
+
+    def __read_index(self) -> 'OrderedDict[str, dict]':
+        try:
+            with open(os.path.join(self.directory, 'index.json')) as f:
+                return OrderedDict(json.load(f))
+        except (FileNotFoundError, ValueError):
+            return OrderedDict()
+
+    def __write_index(self):
+        index = os.path.join(self.directory, 'index.json')
+        with open(f'{index}.tmp', 'w') as f:
+            json.dump(list(self.entries.items()), f)
+        os.replace(f'{index}.tmp', index)
+
+
+class CachingStorage(Storage):
+    """
+    Reads a bucket through a DiskCache. Every read revalidates the cached copy with a download
+    conditional on its generation, so an unchanged file costs one request and no transfer.
+    """
+    storage: Storage
+    cache: DiskCache
+
+    def __init__(self, storage: Storage, *, cache: DiskCache):
+        self.storage = storage
+        self.cache = cache
+
+    def save_image(self, image: Image.Image, *, filename: str, image_format: ImageFormat = PNG, stream: bool = False) -> str:
+        self.cache.remove(self.__key(f'{filename}{image_format.extension}'))
+        return self.storage.save_image(image, filename=filename, image_format=image_format, stream=stream)
+
+    def save_file(self, local_filename: str, *, filename: str):
+        self.cache.remove(self.__key(filename))
+        self.storage.save_file(local_filename, filename=filename)
+
+    def save_bytes(self, data: bytes, *, filename: str, content_type: str = 'application/octet-stream', if_generation_match: Optional[int] = None) -> Optional[int]:
+        self.cache.remove(self.__key(filename))
+        return self.storage.save_bytes(
+            data, filename=filename, content_type=content_type, if_generation_match=if_generation_match)
+
+    def list_files(self, directory: str) -> List:
+        return self.storage.list_files(directory)
+
+    def stream(self, filename: str, *, chunk_size: int = 1024 * 1024) -> Iterator[bytes]:
+        return self.storage.stream(filename, chunk_size=chunk_size)
+
+    def get(self, filename: str) -> Optional[CachedBlob]:
+        """
+        The cached copy of filename, downloaded when it is missing or out of date. The key is
+        pinned while this runs so the copy it revalidated is not evicted before it is returned.
+        """
+        key = self.__key(filename)
+        with self.cache.pinned(key):
+            entry = self.__revalidate(filename, key, self.cache.lookup(key))
+            if entry is not None and not os.path.exists(self.cache.path_of(key)):
+                # Removed from the disk after it was found unmodified, download it again
+                entry = self.__revalidate(filename, key, None)
+            if entry is None:
+                return None
+            return CachedBlob(name=filename, generation=entry['generation'], etag=entry['etag'], size=entry['size'], path=self.cache.path_of(key))
+
+    @contextmanager
+    def pinned(self, filename: str) -> Iterator[Optional[CachedBlob]]:
+        """
+        Get filename and keep it from being evicted while it is read from its path.
+        """
+        with self.cache.pinned(self.__key(filename)):
+            yield self.get(filename)
+
+    def get_image(self, filename: str) -> Image.Image:
+        return Image.open(BytesIO(self.get(filename).download_as_bytes()))
+
+    def delete(self, filename: str, *, if_generation_match: Optional[int] = None):
+        self.cache.remove(self.__key(filename))
+        self.storage.delete(filename, if_generation_match=if_generation_match)
+
+    def __revalidate(self, filename: str, key: str, entry: Optional[dict]) -> Optional[dict]:
+        descriptor, temporary_filename = tempfile.mkstemp(
+            dir=self.cache.directory, prefix='download-')
+        os.close(descriptor)
+        try:
+            blob = self.storage.download_if_modified(
+                filename, temporary_filename, generation=entry['generation'] if entry else None)
+            if blob is None:
+                self.cache.record(hit=True)
+                return entry
+            self.cache.record(hit=False)
+            return self.cache.store(key, temporary_filename, generation=int(
+                blob.generation) if blob.generation is not None else None, etag=blob.etag)
+        except NotFound:
+            self.cache.remove(key)
+            return None
+        finally:
+            if os.path.exists(temporary_filename):
+                os.unlink(temporary_filename)
+
+    def __key(self, filename: str) -> str:
+        return f'{self.storage.bucket_name}/{filename}'
+
+
+_cache: Optional[DiskCache] = None
+_storages: Dict[str, CachingStorage] = {}
+_lock = threading.Lock()
+
+
+def disk_cache() -> DiskCache:
+    global _cache
+    with _lock:
+        if _cache is None:
+            _cache = DiskCache(directory=cache_directory(),
+                               max_bytes=cache_max_bytes())
+        return _cache
+
+
+def cached_storage(*, bucket_name: str) -> CachingStorage:
+    """
+    The process wide caching storage of a bucket, all buckets share one cache and byte budget.
+    """
+    cache = disk_cache()
+    with _lock:
+        if bucket_name not in _storages:
+            _storages[bucket_name] = CachingStorage(
+                bucket_storage(bucket_name=bucket_name), cache=cache)
+        return _storages[bucket_name]
@@ -1,3 +1,10 @@
+import os
+
+
+def space_needle_url() -> str:
+    return 'https://backend.roundshot.com/cams/241/original'
+
+
 def mountain_history_bucket_name() -> str:
     return 'mountain-history'
 
@@ -6,6 +13,13 @@ def mountain_history_filename_template() -> str:
     return 'MountRainier-%Y-%m-%dT%H:%M:%S'
 
 
+def mountain_history_day_prefix_template() -> str:
+    """
+    The start of the names of every snapshot taken on a day, see mountain_history_filename_template.
+    """
+    return 'MountRainier-%Y-%m-%d'
+
+
 def classification_bucket_name() -> str:
     return 'isthemountainout.appspot.com'
 
@@ -36,3 +50,95 @@ def twitter_api_key_bucket_name():
 
 def twitter_api_key_filename():
     return 'v2/twitter-keys.json'
+
+
+def serving_model_filename() -> str:
+    return 'v2/isthemountainout.serving.zip'
+
+
+def quantized_model_filename() -> str:
+    return 'v2/isthemountainout.quantized.tflite'
+
+
+def processed_frame_bucket_name() -> str:
+    return 'isthemountainout.appspot.com'
+
+
+def processed_frame_filename() -> str:
+    return 'v2/last-processed-frame.json'
+
+
+def notable_state_bucket_name() -> str:
+    return 'isthemountainout.appspot.com'
+
+
+def notable_state_filename() -> str:
+    return 'v2/notable-state.json'
+
+
+def state_store_backend() -> str:
+    """
+    Where the classification state is kept: 'sheets', 'sqlite' or 'sqlite+sheets' (sqlite as the
+    source of truth with the sheet as a mirror).
+    """
+    return os.environ.get('ISTHEMOUNTAINOUT_STATE_STORE', 'sheets')
+
+
+def state_store_path() -> str:
+    return os.environ.get('ISTHEMOUNTAINOUT_STATE_PATH', '/tmp/isthemountainout/state.sqlite3')
+
+
+def write_behind_bucket_name() -> str:
+    return 'isthemountainout.appspot.com'
+
+
+def write_behind_prefix() -> str:
+    return 'v2/pending/'
+
+
+def posted_prefix() -> str:
+    """
+    Where a marker is saved for each classification that was posted, in the write behind bucket.
+    """
+    return 'v2/posted/'
+
+
+def write_behind_enabled() -> bool:
+    """
+    Whether state writes and posts finish after the response is sent. Off unless a deployment
+    turns it on, only do so where the instance keeps its CPU after responding (a function throttles
+    it, the work then waits for the next invocation).
+    """
+    return os.environ.get('ISTHEMOUNTAINOUT_WRITE_BEHIND', '0') not in ('', '0')
+
+
+def cache_directory() -> str:
+    """
+    Where files read through the cache are kept, /tmp for functions or a local directory for batch
+    jobs.
+    """
+    return os.environ.get('ISTHEMOUNTAINOUT_CACHE_DIR', '/tmp/isthemountainout-cache')
+
+
+def cache_max_bytes() -> int:
+    # /tmp of a function is held in memory, so the default leaves room for the model
+    return int(os.environ.get('ISTHEMOUNTAINOUT_CACHE_MAX_BYTES', 256 * 1024 * 1024))
+
+
+def storage_backend() -> str:
+    """
+    Where buckets are read from and written to: 'gcs', or 'local' for copies of the buckets in
+    local_storage_root().
+    """
+    return os.environ.get('ISTHEMOUNTAINOUT_STORAGE', 'gcs')
+
+
+def local_storage_root() -> str:
+    return os.environ.get('ISTHEMOUNTAINOUT_STORAGE_ROOT', 'buckets')
+
+
+def snapshot_format() -> str:
+    """
+    How snapshots are encoded: 'png', 'webp' (lossless) or 'jpeg', see common.encoding.
+    """
+    return os.environ.get('ISTHEMOUNTAINOUT_SNAPSHOT_FORMAT', 'png')
@@ -0,0 +1,96 @@
+import random
+import numpy as np
+
+from collections import defaultdict
+from common.frozenmodel import Label, labels, region_of_interest_array
+from common.image import DatasetImageProvider
+from common.pipeline import prefetch, batched
+from common.serving import Predictor
+from io import BytesIO
+from PIL import Image
+from typing import Dict, Iterator, List, Optional, Tuple
+
+
+class LabelledSamples:
+    """
+    A fixed set of labelled images drawn from the classified dataset so several models can be
+    compared on exactly the same images. The sample is seeded and drawn from every label in
+    proportion to how often it occurs, rather than taken from the start of the labels file where
+    neighbouring images are taken minutes apart. Images are only downloaded a batch at a time as
+    they are used.
+    """
+    entries: List[Tuple[str, int]]
+    provider: DatasetImageProvider
+
+    def __init__(self, entries: List[Tuple[str, int]], *, provider: Optional[DatasetImageProvider] = None):
+        self.entries = entries
+        self.provider = provider or DatasetImageProvider()
+
+    @classmethod
+    def sample(cls, *, count: int, seed: int = 0) -> 'LabelledSamples':
+        provider = DatasetImageProvider()
+        files_by_label = defaultdict(list)
+        for file_name, classification in provider:
+            files_by_label[labels().index(Label(classification))].append(file_name)
+        total = sum(len(files) for files in files_by_label.values())
+        generator = random.Random(seed)
+        entries = []
+        for label_index, files in sorted(files_by_label.items()):
+            share = min(len(files), max(1, round(count * len(files) / total)))
+            entries.extend((file_name, label_index)
+                           for file_name in generator.sample(files, share))
+        # Shuffled so any slice of the sample is spread over the labels too
+        generator.shuffle(entries)
+        print(f'Sampled {min(count, len(entries))} of {total} labelled images')
+        return LabelledSamples(entries[:count], provider=provider)
+
+    def split(self, count: int) -> Tuple['LabelledSamples', 'LabelledSamples']:
+        return (LabelledSamples(self.entries[:count], provider=self.provider),
+                LabelledSamples(self.entries[count:], provider=self.provider))
+
+    def arrays(self, *, workers: int = 8) -> Iterator[np.ndarray]:
+        """
+        The region of interest array of each sample, downloaded ahead of use on a few threads.
+        """
+        return prefetch(self.__load, [file_name for file_name, _ in self.entries], workers=workers, depth=workers * 2)
+
+    def batches(self, *, size: int) -> Iterator[Tuple[np.ndarray, np.ndarray]]:
+        """
+        Batches of region of interest arrays and their label indices.
+        """
+        for batch in batched(zip(self.arrays(), (label_index for _, label_index in self.entries)), size=size):
+            yield np.stack([array for array, _ in batch]), np.array([label_index for _, label_index in batch])
+
+    def __load(self, file_name: str) -> np.ndarray:
+        image = Image.open(
+            BytesIO(self.provider.get(file_name).download_as_bytes()))
+        return region_of_interest_array(image)
+
+    def __len__(self):
+        return len(self.entries)
+
+
+def evaluate(predictor: Predictor, samples: LabelledSamples, *, batch_size: int = 8) -> Tuple[float, np.ndarray]:
+    """
+    Returns the accuracy of the predictor over the samples along with each predicted label index.
+    """
+    predictions = []
+    label_indices = []
+    for batch, batch_label_indices in samples.batches(size=batch_size):
+        indices, _ = predictor.predict(batch)
+        predictions.extend(indices)
+        label_indices.extend(batch_label_indices)
+    predictions = np.array(predictions)
+    return float(np.mean(predictions == np.array(label_indices))), predictions
+
+
+def compare(reference: Predictor, candidate: Predictor, samples: LabelledSamples) -> Dict[str, float]:
+    reference_accuracy, reference_predictions = evaluate(reference, samples)
+    candidate_accuracy, candidate_predictions = evaluate(candidate, samples)
+    return {
+        'samples': len(samples),
+        'reference_accuracy': reference_accuracy,
+        'candidate_accuracy': candidate_accuracy,
+        'accuracy_drop': reference_accuracy - candidate_accuracy,
+        'agreement': float(np.mean(reference_predictions == candidate_predictions)),
+    }
@@ -0,0 +1,73 @@
+import json
+
+from common.config import processed_frame_bucket_name, processed_frame_filename
+from common.storage import Storage, bucket_storage
+from datetime import datetime
+from google.api_core.exceptions import PreconditionFailed
+from typing import Dict, Optional
+
+
+class ProcessedFrameRecord:
+    """
+    Remembers the last camera frame that was classified for each image source, so an invocation
+    can return early when the camera has not published a new frame since.
+
+    Every source shares one file, so it is only replaced while it is still at the generation that
+    was read, and a write that lost to another instance is redone on top of what that one wrote.
+    """
+    attempts = 5
+    storage: Storage
+    frames: Optional[Dict[str, dict]]
+    generation: int
+
+    def __init__(self):
+        self.storage = bucket_storage(bucket_name=processed_frame_bucket_name())
+        self.frames = None
+        self.generation = 0
+
+    def __read(self) -> Dict[str, dict]:
+        while self.frames is None:
+            blob = self.storage.get(processed_frame_filename())
+            if blob is None:
+                self.frames, self.generation = {}, 0
+                continue
+            try:
+                # Pinned to the listed generation so the contents and generation go together
+                self.frames = json.loads(blob.download_as_bytes(
+                    if_generation_match=blob.generation).decode('utf-8'))
+                self.generation = int(blob.generation)
+            except PreconditionFailed:
+                # Replaced between getting and downloading it
+                pass
+        return self.frames
+
+    def last_processed(self, source: str) -> Optional[str]:
+        return self.__read().get(source, {}).get('frame')
+
+    def is_processed(self, source: str, frame: Optional[str]) -> bool:
+        return frame is not None and self.last_processed(source) == frame
+
+    def mark_processed(self, source: str, frame: Optional[str], *, date: datetime):
+        """
+        Remember frame as the last processed frame of source, unless a later frame already is.
+        """
+        if frame is None:
+            return
+        for attempt in range(ProcessedFrameRecord.attempts):
+            frames = self.__read()
+            marked = frames.get(source, {}).get('date')
+            if marked is not None and marked > date.strftime('%Y-%m-%dT%H:%M:%S'):
+                return
+            frames[source] = {
+                'frame': frame,
+                'date': date.strftime('%Y-%m-%dT%H:%M:%S'),
+            }
+            try:
+                self.generation = self.storage.save_bytes(json.dumps(frames).encode('utf-8'), filename=processed_frame_filename(),
+                                                          content_type='application/json', if_generation_match=self.generation)
+                return
+            except PreconditionFailed:
+                if attempt + 1 == ProcessedFrameRecord.attempts:
+                    raise
+                # Another instance marked a frame since it was read, mark this one on top of it
+                self.frames = None
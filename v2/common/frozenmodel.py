@@ -1,9 +1,10 @@
 import os
+import numpy as np
 import tensorflow as tf
 import common.model as m
 
 from tensorflow.keras.layers import RandomTranslation, RandomBrightness, Cropping2D, Dense, Dropout, GlobalAveragePooling2D, Conv2D, BatchNormalization, MaxPooling2D, SeparableConv2D, Activation, add
-from typing import List, Optional
+from typing import List, Optional, Tuple
 from enum import Enum
 
 
@@ -18,8 +19,35 @@ def labels() -> List[Label]:
     return sorted(Label.__members__.values(), key=lambda label: label.value)
 
 
+# Cropping2D parameter are how much to take off of top, bottom,
+# left and right, not a rectangle of the cropped image
+CROPPING = ((160, 350), (580, 450))
+IMAGE_SHAPE = (1080, 1920, 3)
+REGION_OF_INTEREST_SHAPE = (
+    IMAGE_SHAPE[0] - sum(CROPPING[0]),
+    IMAGE_SHAPE[1] - sum(CROPPING[1]),
+    IMAGE_SHAPE[2],
+)
+
+
+def region_of_interest() -> Tuple[int, int, int, int]:
+    """
+    The (left, top, right, bottom) box of a full 1920x1080 image that the model actually looks at.
+    """
+    (top, bottom), (left, right) = CROPPING
+    return left, top, IMAGE_SHAPE[1] - right, IMAGE_SHAPE[0] - bottom
+
+
+def region_of_interest_array(image) -> np.ndarray:
+    """
+    Convert only the region of interest of a 1920x1080 PIL image to a float array, the rest of the
+    image is never looked at by the model.
+    """
+    return tf.keras.utils.img_to_array(image.crop(region_of_interest()), dtype='float32')
+
+
 def generate_model(*, weights_filepath: Optional[str], with_augmentations: bool = False, can_ignore_weights: bool = False):
-    shape = (1080, 1920, 3)
+    shape = IMAGE_SHAPE
     inputs = tf.keras.Input(shape=shape)
 
     translation_amount = 0.12 if with_augmentations else 0.0
@@ -32,9 +60,36 @@ def generate_model(*, weights_filepath: Optional[str], with_augmentations: bool
             fill_mode='nearest'
         ),
         RandomBrightness(brightness_amount),
-        # Cropping2D parameter are how much to take off of top, bottom,
-        # left and right, not a rectangle of the cropped image
-        Cropping2D(cropping=((160, 350), (580, 450))),
+        Cropping2D(cropping=CROPPING),
+        *_classifier_layers(),
+    )(inputs)
+    return _finalize_model(
+        inputs=inputs,
+        outputs=outputs,
+        shape=shape,
+        weights_filepath=weights_filepath,
+        can_ignore_weights=can_ignore_weights)
+
+
+def generate_inference_model(*, weights_filepath: Optional[str], can_ignore_weights: bool = False):
+    """
+    Build the classifier without the augmentation and cropping layers. The model only accepts the
+    region of interest (see region_of_interest()) and loads the same weights as generate_model since
+    none of the removed layers carry weights.
+    """
+    shape = REGION_OF_INTEREST_SHAPE
+    inputs = tf.keras.Input(shape=shape)
+    outputs = m.chained(*_classifier_layers())(inputs)
+    return _finalize_model(
+        inputs=inputs,
+        outputs=outputs,
+        shape=shape,
+        weights_filepath=weights_filepath,
+        can_ignore_weights=can_ignore_weights)
+
+
+def _classifier_layers() -> list:
+    return [
         # Entry Flow
         Conv2D(filters=12, kernel_size=5, strides=2, padding='same'),
         BatchNormalization(),
@@ -105,7 +160,10 @@ def generate_model(*, weights_filepath: Optional[str], with_augmentations: bool
         GlobalAveragePooling2D(),
         Dense(len(labels()), activation='linear'),
         Dropout(0.2),
-    )(inputs)
+    ]
+
+
+def _finalize_model(*, inputs, outputs, shape, weights_filepath: Optional[str], can_ignore_weights: bool):
     model = tf.keras.Model(inputs=inputs, outputs=outputs)
     model.build(input_shape=(None, *shape))
     if weights_filepath and os.path.exists(weights_filepath):
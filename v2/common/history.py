@@ -0,0 +1,143 @@
+import numpy as np
+
+from common.frozenmodel import Label, labels
+from common.sheets import ClassificationRow
+from common.solar import solar_calendar
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+
+
+class ColumnarHistory:
+    """
+    The classification history as columns: epoch seconds, label codes (indices into labels()) and
+    whether the classification was posted. Queries work on whole columns at once, so years of
+    history are answered in milliseconds.
+
+    position is where the source store left off, so a later sync only reads the rows after it.
+    """
+    # Classifications further apart than this are not assumed to cover the time between them
+    max_gap_seconds = 60 * 60
+    timestamps: np.ndarray
+    codes: np.ndarray
+    posted: np.ndarray
+    source: str
+    position: int
+
+    def __init__(self, *, timestamps: np.ndarray, codes: np.ndarray, posted: np.ndarray, source: str, position: int):
+        self.timestamps = np.asarray(timestamps, dtype=np.int64)
+        self.codes = np.asarray(codes, dtype=np.uint8)
+        self.posted = np.asarray(posted, dtype=bool)
+        self.source = source
+        self.position = position
+
+    def __len__(self) -> int:
+        return len(self.timestamps)
+
+    @classmethod
+    def empty(cls, *, source: str) -> 'ColumnarHistory':
+        return ColumnarHistory(timestamps=[], codes=[], posted=[], source=source, position=0)
+
+    @classmethod
+    def from_rows(cls, rows: List[ClassificationRow], *, source: str, position: int) -> 'ColumnarHistory':
+        calendar = solar_calendar()
+        codes = {label: code for code, label in enumerate(labels())}
+        return ColumnarHistory(
+            # Row dates are local wall clock times
+            timestamps=calendar.epoch_seconds(
+                [row.date.replace(tzinfo=None) for row in rows]).astype(np.int64),
+            codes=[codes[row.classification] for row in rows],
+            posted=[bool(row.was_posted) for row in rows],
+            source=source,
+            position=position)
+
+    def extend(self, rows: List[ClassificationRow], *, position: int) -> 'ColumnarHistory':
+        appended = ColumnarHistory.from_rows(
+            rows, source=self.source, position=position)
+        return ColumnarHistory(
+            timestamps=np.concatenate([self.timestamps, appended.timestamps]),
+            codes=np.concatenate([self.codes, appended.codes]),
+            posted=np.concatenate([self.posted, appended.posted]),
+            source=self.source,
+            position=position)
+
+    def save(self, path: str):
+        with open(path, 'wb') as f:
+            np.savez_compressed(f, timestamps=self.timestamps, codes=self.codes, posted=self.posted,
+                                source=np.array(self.source), position=np.array(self.position, dtype=np.int64))
+
+    @classmethod
+    def load(cls, path: str) -> 'ColumnarHistory':
+        with np.load(path) as data:
+            return ColumnarHistory(
+                timestamps=data['timestamps'],
+                codes=data['codes'],
+                posted=data['posted'],
+                source=str(data['source']),
+                position=int(data['position']))
+
+    def between(self, start: Optional[datetime] = None, end: Optional[datetime] = None) -> 'ColumnarHistory':
+        """
+        The classifications from start up to (not including) end, naive datetimes are local time.
+        """
+        calendar = solar_calendar()
+        first = 0 if start is None else np.searchsorted(
+            self.timestamps, calendar.localize(start).timestamp(), side='left')
+        last = len(self) if end is None else np.searchsorted(
+            self.timestamps, calendar.localize(end).timestamp(), side='left')
+        return ColumnarHistory(timestamps=self.timestamps[first:last], codes=self.codes[first:last],
+                               posted=self.posted[first:last], source=self.source, position=self.position)
+
+    def counts(self) -> Dict[Label, int]:
+        counts = np.bincount(self.codes, minlength=len(labels()))
+        return {label: int(count) for label, count in zip(labels(), counts)}
+
+    def durations(self) -> np.ndarray:
+        """
+        Seconds each classification held until the next one, capped at max_gap_seconds.
+        """
+        if len(self) == 0:
+            return np.zeros(0, dtype=np.int64)
+        return np.minimum(np.diff(self.timestamps, append=self.timestamps[-1]), ColumnarHistory.max_gap_seconds)
+
+    def hours(self, label: Label, *, by: str = 'month') -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Hours spent classified as label per local day ('day') or month ('month'), as the periods
+        (datetime64) and their hours.
+        """
+        periods = self.__local_days().astype(
+            'datetime64[M]' if by == 'month' else 'datetime64[D]')
+        unique, inverse = np.unique(periods, return_inverse=True)
+        seconds = np.bincount(inverse, weights=np.where(
+            self.codes == self.__code(label), self.durations(), 0), minlength=len(unique))
+        return unique, seconds / 3600
+
+    def streaks(self, label: Label) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Every run of consecutive label classifications, as the epoch seconds each run started at
+        and its number of classifications.
+        """
+        matches = np.concatenate(
+            [[False], self.codes == self.__code(label), [False]])
+        edges = np.flatnonzero(np.diff(matches.astype(np.int8)))
+        starts, ends = edges[0::2], edges[1::2]
+        return self.timestamps[starts], ends - starts
+
+    def daily_visibility(self) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        For every local day with classifications: the day (datetime64), whether the mountain was
+        seen (mystical or beautiful) and how many of the day's classifications saw it.
+        """
+        days = self.__local_days()
+        unique, inverse = np.unique(days, return_inverse=True)
+        visible = np.isin(self.codes, [self.__code(
+            Label.MYSTICAL), self.__code(Label.BEAUTIFUL)])
+        visible_counts = np.bincount(
+            inverse, weights=visible, minlength=len(unique)).astype(np.int64)
+        return unique, visible_counts > 0, visible_counts
+
+    def __local_days(self) -> np.ndarray:
+        ordinals = solar_calendar().day_ordinals(self.timestamps)
+        return np.datetime64('0001-01-01', 'D') + (ordinals - 1)
+
+    def __code(self, label: Label) -> int:
+        return labels().index(label)
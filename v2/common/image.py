@@ -1,91 +1,204 @@
-import json
+import math
 import os
 import io
-import shutil
 from datetime import date as Date
-from datetime import datetime
-from typing import Tuple, Dict, Iterator, Optional
+from datetime import datetime, timedelta
+from typing import Tuple, Dict, Iterator, List, Optional
 from google.cloud import storage as gstorage
 from urllib.parse import urlparse
-from common.config import brand_bucket_name, brand_filename, mountain_history_bucket_name, mountain_history_filename_template, classification_bucket_name, classification_filename
-from common.storage import GcpBucketStorage
+from common.config import space_needle_url, brand_bucket_name, brand_filename, mountain_history_bucket_name, mountain_history_filename_template, mountain_history_day_prefix_template, classification_bucket_name, classification_filename
+from common.storage import Storage, bucket_storage
+from common.pipeline import prefetch
+from common.jsonstream import JsonObjectStream
 from io import BytesIO
 import requests
+import pytz
 from PIL import Image
 from bisect import bisect
 
+PACIFIC_TIMEZONE = pytz.timezone('US/Pacific')
+
 
 class ImageProvider:
     def get(self) -> Tuple[Image.Image, datetime]:
         pass
 
+    def frame(self) -> Optional[str]:
+        """
+        Identify the image get() would return without downloading it, None when the provider can
+        not tell which image it will return ahead of time.
+        """
+        return None
+
 
 class SpaceNeedleImageProvider(ImageProvider):
+    # (x, y, width, height) of the mountain within the panorama resized to resized_height
+    crop = (7036, 162, 1920, 1080)
+    resized_height = 2048
     cropped: bool
+    latest: Optional[Tuple[str, datetime]]
 
     def __init__(self, *, cropped: bool = True):
         self.cropped = cropped
-
-    def __space_needle_url(self) -> str:
-        return 'https://backend.roundshot.com/cams/241/original'
+        self.latest = None
 
     def get(self) -> Tuple[Image.Image, datetime]:
-        url = self.__space_needle_url()
-        redirected_url = requests.head(url, allow_redirects=True).url
-        # Example format: https://storage.roundshot.com/544a1a9d451563.40343637/2021-07-02/14-40-00/2021-07-02-14-40-00_original.jpg
-        url = urlparse(redirected_url)
-        url_path = list(filter(None, url.path.split('/')))
-        date = datetime.strptime(
-            f'{url_path[1]}T{url_path[2]}', '%Y-%m-%dT%H-%M-%S')
+        stream, date = self.download()
+        # Release the connection and its buffers as soon as the panorama is decoded
+        with stream:
+            decoded = self.decode(stream)
+        return self.resize_and_crop(decoded), date
+
+    def frame(self) -> Optional[str]:
+        redirected_url, _ = self.latest_frame()
+        return redirected_url
+
+    def latest_frame(self) -> Tuple[str, datetime]:
+        """
+        The url and date of the latest panorama. The camera url redirects to the latest panorama, so
+        this is only looked up once per provider.
+        """
+        if self.latest is None:
+            redirected_url = requests.head(
+                space_needle_url(), allow_redirects=True).url
+            # Example format: https://storage.roundshot.com/544a1a9d451563.40343637/2021-07-02/14-40-00/2021-07-02-14-40-00_original.jpg
+            url_path = list(
+                filter(None, urlparse(redirected_url).path.split('/')))
+            date = datetime.strptime(
+                f'{url_path[1]}T{url_path[2]}', '%Y-%m-%dT%H-%M-%S')
+            self.latest = redirected_url, date
+        return self.latest
+
+    def download(self) -> Tuple[io.RawIOBase, datetime]:
+        redirected_url, date = self.latest_frame()
+        url = space_needle_url()
         req = requests.get(redirected_url, stream=True)
         if req.status_code == 200:
             req.raw.decode_content = True
-            data = io.BytesIO()
-            shutil.copyfileobj(req.raw, data)
-            data.seek(0)
-            image = Image.open(data)
-            width, height = image.size
-            # The original image size had a height of 2048, so try to keep it within those bounds keeping the aspect ratio
-            scale = height / 2048
-            resized = image.resize((int(width / scale), int(height / scale)))
-            if self.cropped:
-                resized = ImageEditor(resized).crop(
-                    x=7036, y=162, width=1920, height=1080).image
-            return resized, date
+            return req.raw, date
         else:
             raise IOError(
                 f'Could not download latest image from {url} -> {redirected_url}', req)
 
+    def decode(self, stream: io.RawIOBase) -> Image.Image:
+        """
+        Decode the panorama straight from the stream at the smallest JPEG (DCT) scale that is still
+        at least as large as the resized panorama, so the full resolution image is never held in memory.
+        """
+        image = Image.open(stream)
+        width, height = image.size
+        scale = height / SpaceNeedleImageProvider.resized_height
+        image.draft('RGB', (math.ceil(width / scale),
+                    SpaceNeedleImageProvider.resized_height))
+        image.load()
+        return image
+
+    def resize_and_crop(self, image: Image.Image) -> Image.Image:
+        width, height = image.size
+        # The original image size had a height of 2048, so try to keep it within those bounds keeping the aspect ratio
+        scale = height / SpaceNeedleImageProvider.resized_height
+        if self.cropped:
+            # Translate the crop into the coordinates of the decoded image so only the region of
+            # interest is resized
+            x, y, crop_width, crop_height = SpaceNeedleImageProvider.crop
+            return image.resize((crop_width, crop_height), box=(
+                x * scale, y * scale, (x + crop_width) * scale, (y + crop_height) * scale))
+        else:
+            return image.resize((int(width / scale), int(height / scale)))
+
 
 class TimestampedSnapshotImageProvider(ImageProvider):
-    storage: GcpBucketStorage
+    """
+    Snapshot names start with the day they were taken on, so snapshots are found by listing the
+    few days around the timestamp rather than the whole bucket.
+    """
+    # Days listed one at a time before falling back to listing every snapshot
+    search_days = 7
+    storage: Storage
     timestamp: Optional[datetime]
+    image_file: Optional[Tuple[gstorage.Blob, datetime]]
 
     def _image_file(self) -> Tuple[gstorage.Blob, datetime]:
+        if self.image_file is None:
+            self.image_file = self.__find_image_file()
+        return self.image_file
+
+    def __find_image_file(self) -> Tuple[gstorage.Blob, datetime]:
         if self.timestamp is None:
-            blob = next(
-                reversed(sorted(self.storage.list_files(''), key=self._date_of_blob)))
-            return blob, self._date_of_blob(blob)
+            return self.__latest()
         else:
-            blobs = list(
-                sorted(self.storage.list_files(''), key=self._date_of_blob))
-            timestamps = [self._date_of_blob(blob) for blob in blobs]
-            index = max(0, min(len(timestamps) - 1,
-                        bisect(timestamps, self.timestamp)))
-            blob = blobs[index]
-            return blob, self._date_of_blob(blob)
+            return self.__next_after(self.timestamp)
+
+    def __latest(self) -> Tuple[gstorage.Blob, datetime]:
+        today = datetime.now(PACIFIC_TIMEZONE).date()
+        for days in range(TimestampedSnapshotImageProvider.search_days):
+            snapshots = self.snapshots_on(today - timedelta(days=days))
+            if snapshots:
+                return snapshots[-1]
+        return self.__all_snapshots()[-1]
+
+    def __next_after(self, timestamp: datetime) -> Tuple[gstorage.Blob, datetime]:
+        """
+        The first snapshot taken after timestamp, or the latest snapshot when there is none.
+        """
+        today = datetime.now(PACIFIC_TIMEZONE).date()
+        day = timestamp.date()
+        for _ in range(TimestampedSnapshotImageProvider.search_days):
+            if day > today:
+                # Every day up to today was searched, nothing was taken after timestamp
+                return self.__latest()
+            snapshots = self.snapshots_on(day)
+            index = bisect([date for _, date in snapshots], timestamp)
+            if index < len(snapshots):
+                return snapshots[index]
+            day += timedelta(days=1)
+
+        snapshots = self.__all_snapshots()
+        index = max(0, min(len(snapshots) - 1,
+                    bisect([date for _, date in snapshots], timestamp)))
+        return snapshots[index]
+
+    def snapshots_on(self, day: Date) -> List[Tuple[gstorage.Blob, datetime]]:
+        """
+        Every snapshot taken on day (local time) ordered by the time they were taken.
+        """
+        blobs = self.storage.list_files(
+            day.strftime(mountain_history_day_prefix_template()))
+        return sorted([(blob, self._date_of_blob(blob)) for blob in blobs], key=lambda entry: entry[1])
+
+    def __all_snapshots(self) -> List[Tuple[gstorage.Blob, datetime]]:
+        return sorted([(blob, self._date_of_blob(blob)) for blob in self.storage.list_files('')], key=lambda entry: entry[1])
 
     def _date_of_blob(self, blob) -> datetime:
         return datetime.strptime(os.path.splitext(blob.name)[0], mountain_history_filename_template())
 
     def __init__(self, *, timestamp: Optional[datetime] = None):
-        self.storage = GcpBucketStorage(
-            bucket_name=mountain_history_bucket_name())
+        self.storage = bucket_storage(bucket_name=mountain_history_bucket_name())
         self.timestamp = timestamp
+        self.image_file = None
+
+    def frame(self) -> Optional[str]:
+        # Snapshots looked up by timestamp are intentional reruns, so they are never identified
+        if self.timestamp is not None:
+            return None
+        image_blob, _ = self._image_file()
+        return image_blob.name
 
     def get(self) -> Tuple[Image.Image, Date]:
         image_blob, date = self._image_file()
-        return Image.open(BytesIO(image_blob.download_as_bytes())), date
+        return self.load(image_blob), date
+
+    def blobs_between(self, start: datetime, end: datetime) -> List[Tuple[gstorage.Blob, datetime]]:
+        """
+        All snapshots taken within [start, end] ordered by the time they were taken.
+        """
+        days = [start.date() + timedelta(days=offset)
+                for offset in range((end.date() - start.date()).days + 1)]
+        return [(blob, date) for snapshots in prefetch(self.snapshots_on, days)
+                for blob, date in snapshots if start <= date <= end]
+
+    def load(self, blob: gstorage.Blob) -> Image.Image:
+        return Image.open(BytesIO(blob.download_as_bytes()))
 
 
 class LatestSnapshotImageProvider(TimestampedSnapshotImageProvider):
@@ -99,22 +212,20 @@ class Classification:
 
 
 class DatasetImageProvider:
-    storage: GcpBucketStorage
-    image_storage: GcpBucketStorage
+    storage: Storage
+    image_storage: Storage
     classifications: Iterator[Tuple[str, Classification]]
 
     def __init__(self):
-        self.storage = GcpBucketStorage(
-            bucket_name=classification_bucket_name())
-        self.image_storage = GcpBucketStorage(
-            bucket_name=mountain_history_bucket_name())
+        self.storage = bucket_storage(bucket_name=classification_bucket_name())
+        self.image_storage = bucket_storage(bucket_name=mountain_history_bucket_name())
 
-    def __get_all_classifications(self) -> Dict[str, Classification]:
-        return json.loads(self.storage.get(
-            classification_filename()).download_as_string())
+    def __get_all_classifications(self) -> Iterator[Tuple[str, Classification]]:
+        # The labels file grows with every labelled image, so it is parsed as it is read
+        return iter(JsonObjectStream(self.storage.stream(classification_filename())))
 
     def __iter__(self):
-        self.classifications = iter(self.__get_all_classifications().items())
+        self.classifications = self.__get_all_classifications()
         return self
 
     def __next__(self) -> Tuple[str, str]:
@@ -124,13 +235,21 @@ class DatasetImageProvider:
     def get(self, filename) -> gstorage.Blob:
         return self.image_storage.get(filename)
 
+    def download(self, filename: str, local_filename: str) -> Optional[int]:
+        """
+        Download an image straight to a local file, without first fetching its metadata. Returns
+        the generation that was downloaded.
+        """
+        blob = self.image_storage.download_if_modified(
+            filename, local_filename, generation=None)
+        return int(blob.generation) if blob.generation is not None else None
+
 
 class BrandImageProvider:
-    storage: GcpBucketStorage
+    storage: Storage
 
     def __init__(self):
-        self.storage = GcpBucketStorage(
-            bucket_name=brand_bucket_name())
+        self.storage = bucket_storage(bucket_name=brand_bucket_name())
 
     def get(self) -> Image.Image:
         blob = self.storage.get(brand_filename())
@@ -0,0 +1,91 @@
+import json
+import codecs
+
+from typing import Any, Iterable, Iterator, Tuple
+
+NUMBER_CHARACTERS = frozenset('0123456789.eE+-')
+
+
+class JsonObjectStream:
+    """
+    Reads the members of a top level JSON object from a sequence of byte chunks, decoding one
+    member at a time with raw_decode so only that member and the current chunk are held in memory.
+    """
+    decoder: json.JSONDecoder
+    chunks: Iterator[bytes]
+    text: codecs.IncrementalDecoder
+    buffer: str
+    position: int
+    exhausted: bool
+
+    def __init__(self, chunks: Iterable[bytes]):
+        self.decoder = json.JSONDecoder()
+        self.chunks = iter(chunks)
+        self.text = codecs.getincrementaldecoder('utf-8')()
+        self.buffer = ''
+        self.position = 0
+        self.exhausted = False
+
+    def __iter__(self) -> Iterator[Tuple[str, Any]]:
+        self.__expect('{')
+        if self.__peek() == '}':
+            return
+        while True:
+            key = self.__value()
+            if not isinstance(key, str):
+                raise ValueError(f'Expected a member name, found {key!r}')
+            self.__expect(':')
+            yield key, self.__value()
+            if self.__peek() == ',':
+                self.position += 1
+            else:
+                self.__expect('}')
+                return
+
+    def __fill(self) -> bool:
+        chunk = next(self.chunks, None)
+        if chunk is None:
+            self.exhausted = True
+            chunk = b''
+        self.buffer = self.buffer[self.position:] + \
+            self.text.decode(chunk, final=self.exhausted)
+        self.position = 0
+        return not self.exhausted
+
+    def __peek(self) -> str:
+        while True:
+            while self.position < len(self.buffer) and self.buffer[self.position].isspace():
+                self.position += 1
+            if self.position < len(self.buffer):
+                return self.buffer[self.position]
+            if not self.__fill():
+                raise ValueError('Unexpected end of JSON')
+
+    def __expect(self, character: str):
+        found = self.__peek()
+        if found != character:
+            raise ValueError(f'Expected {character!r}, found {found!r}')
+        self.position += 1
+
+    def __value(self) -> Any:
+        self.__peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.position)
+                if self.exhausted or not self.__may_continue(value, end):
+                    self.position = end
+                    return value
+            except json.JSONDecodeError:
+                if self.exhausted:
+                    raise
+            self.__fill()
+
+    def __may_continue(self, value: Any, end: int) -> bool:
+        """
+        Whether a decoded number may be the start of a longer one split across chunks, which is
+        the case while nothing but number characters follow it up to the end of the buffer. Every
+        other value ends with a character that can not be mistaken for its end.
+        """
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            return False
+        return all(character in NUMBER_CHARACTERS for character in self.buffer[end:])
@@ -0,0 +1,33 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Iterable, Iterator, List, TypeVar
+
+T = TypeVar('T')
+R = TypeVar('R')
+
+
+def prefetch(function: Callable[[T], R], items: Iterable[T], *, workers: int = 8, depth: int = 32) -> Iterator[R]:
+    """
+    Map function over items on a thread pool while keeping at most depth results in flight. Results
+    are yielded in the order of items, so the consumer can work on one result while the next ones are
+    still being fetched.
+    """
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        for item in items:
+            pending.append(executor.submit(function, item))
+            if len(pending) >= depth:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def batched(items: Iterable[T], *, size: int) -> Iterator[List[T]]:
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
@@ -0,0 +1,37 @@
+from threading import Lock
+from typing import Any, Callable, Dict, Tuple, TypeVar
+
+T = TypeVar('T')
+
+
+class ModelRegistry:
+    """
+    Process wide cache of loaded models. Each model is stored under a name along with the version
+    of the weights it was built from so a warm process only rebuilds a model when the weights change.
+    """
+    entries: Dict[str, Tuple[str, Any]]
+    lock: Lock
+
+    def __init__(self):
+        self.entries = {}
+        self.lock = Lock()
+
+    def get(self, name: str, *, version: str, load: Callable[[], T]) -> T:
+        with self.lock:
+            entry = self.entries.get(name)
+            if entry is not None and entry[0] == version:
+                print(f'Reusing model {name} for weights version {version}')
+                return entry[1]
+            print(f'Building model {name} for weights version {version}')
+            # Drop the stale model before building the new one so both are never held at once
+            self.entries.pop(name, None)
+            model = load()
+            self.entries[name] = (version, model)
+            return model
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+models = ModelRegistry()
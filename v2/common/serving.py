@@ -0,0 +1,125 @@
+import os
+import numpy as np
+import tensorflow as tf
+
+from common.frozenmodel import REGION_OF_INTEREST_SHAPE
+from typing import Callable, Iterable, Optional, Tuple
+
+
+class Predictor:
+    def predict(self, batch: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Classify a batch of region of interest images, returning the label index and softmax scores
+        for each image.
+        """
+        pass
+
+
+class KerasPredictor(Predictor):
+    model: tf.keras.Model
+
+    def __init__(self, model: tf.keras.Model):
+        self.model = model
+
+    def predict(self, batch: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        scores = tf.nn.softmax(self.model.predict(batch, verbose=0)).numpy()
+        return np.argmax(scores, axis=1), scores
+
+
+class ServingPredictor(Predictor):
+    serve: tf.types.experimental.ConcreteFunction
+
+    def __init__(self, serve):
+        self.serve = serve
+
+    @classmethod
+    def from_model(cls, model: tf.keras.Model, *, jit_compile: bool = False) -> 'ServingPredictor':
+        return ServingPredictor(serving_module(model, jit_compile=jit_compile).serve.get_concrete_function())
+
+    @classmethod
+    def from_saved_model(cls, directory: str) -> 'ServingPredictor':
+        return ServingPredictor(tf.saved_model.load(directory).signatures['serving_default'])
+
+    def predict(self, batch: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        outputs = self.serve(image=tf.convert_to_tensor(batch, dtype=tf.float32))
+        return outputs['label'].numpy(), outputs['scores'].numpy()
+
+
+class TfLitePredictor(Predictor):
+    interpreter: tf.lite.Interpreter
+
+    def __init__(self, interpreter: tf.lite.Interpreter):
+        self.interpreter = interpreter
+        self.interpreter.allocate_tensors()
+
+    @classmethod
+    def from_file(cls, filename: str, *, num_threads: Optional[int] = None) -> 'TfLitePredictor':
+        # Read the model into memory so the file can be removed once the predictor is built
+        with open(filename, 'rb') as f:
+            return TfLitePredictor(tf.lite.Interpreter(model_content=f.read(), num_threads=num_threads))
+
+    def predict(self, batch: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        input_details = self.interpreter.get_input_details()[0]
+        output_details = self.interpreter.get_output_details()[0]
+        if tuple(input_details['shape']) != batch.shape:
+            self.interpreter.resize_tensor_input(
+                input_details['index'], batch.shape)
+            self.interpreter.allocate_tensors()
+        self.interpreter.set_tensor(
+            input_details['index'], batch.astype(np.float32))
+        self.interpreter.invoke()
+        logits = self.interpreter.get_tensor(output_details['index'])
+        scores = tf.nn.softmax(logits).numpy()
+        return np.argmax(scores, axis=1), scores
+
+
+def serving_module(model: tf.keras.Model, *, jit_compile: bool = False) -> tf.Module:
+    """
+    Wrap an inference model (see generate_inference_model) in a module with a single traced serving
+    function. The function has a fixed image shape so it is only traced once, and returns both the
+    label index and softmax scores so no eager post processing is needed by the caller.
+    """
+    module = tf.Module()
+    module.model = model
+
+    @tf.function(
+        input_signature=[tf.TensorSpec(
+            shape=(None, *REGION_OF_INTEREST_SHAPE), dtype=tf.float32, name='image')],
+        jit_compile=jit_compile)
+    def serve(image):
+        scores = tf.nn.softmax(model(image, training=False))
+        return {
+            'label': tf.argmax(scores, axis=1, output_type=tf.int32),
+            'scores': scores,
+        }
+
+    module.serve = serve
+    return module
+
+
+def export_serving_model(model: tf.keras.Model, directory: str, *, jit_compile: bool = False):
+    module = serving_module(model, jit_compile=jit_compile)
+    os.makedirs(directory, exist_ok=True)
+    tf.saved_model.save(module, directory, signatures={
+        'serving_default': module.serve.get_concrete_function(),
+    })
+
+
+def convert_to_tflite(model: tf.keras.Model, *, quantization: str, representative_images: Optional[Callable[[], Iterable[np.ndarray]]] = None) -> bytes:
+    """
+    Convert an inference model to a quantized TFLite model. Dynamic range quantization stores the
+    weights as int8, int8 quantization also quantizes activations which requires representative
+    images (region of interest arrays) to calibrate their ranges.
+    """
+    converter = tf.lite.TFLiteConverter.from_keras_model(model)
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    if quantization == 'int8':
+        if representative_images is None:
+            raise Exception('int8 quantization requires representative images')
+        converter.representative_dataset = lambda: (
+            [image[np.newaxis].astype(np.float32)] for image in representative_images())
+        converter.target_spec.supported_ops = [
+            tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+    elif quantization != 'dynamic':
+        raise Exception(f'Unknown quantization {quantization}')
+    return converter.convert()
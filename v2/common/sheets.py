@@ -1,5 +1,6 @@
 from datetime import datetime
 from common.frozenmodel import Label
+from common.solar import PACIFIC_TIMEZONE
 from typing import List, Optional
 
 
@@ -16,6 +17,15 @@ class ClassificationRow:
     def as_list(self) -> List[str]:
         return [self.date.strftime('%Y-%m-%dT%H:%M:%S'), self.classification.value, 'TRUE' if self.was_posted else 'FALSE']
 
+    @classmethod
+    def from_list(cls, values: List[str]) -> 'ClassificationRow':
+        return ClassificationRow(
+            date=datetime.strptime(
+                values[0], r'%Y-%m-%dT%H:%M:%S').replace(tzinfo=PACIFIC_TIMEZONE),
+            classification=Label(values[1]),
+            was_posted=True if values[2] == 'TRUE' else False,
+        )
+
     def __str__(self) -> str:
         return f'{self.__class__.__name__}(date={self.date.strftime("%Y-%m-%dT%H:%M:%S")} classification={self.classification.value} was_posted={self.was_posted})'
 
@@ -52,3 +62,41 @@ class RangeData:
     @classmethod
     def of(cls, *, sheet_name: str, start: Cell, end: Cell) -> 'RangeData':
         return RangeData(f'{sheet_name}!{str(start)}:{str(end)}')
+
+
+class ClassificationHistory:
+    """
+    The latest rows of the classification sheet as read in one request, along with what is needed
+    to write the next row right after them.
+    """
+    sheet_id: int
+    rows: List[ClassificationRow]
+    last_row: int
+
+    def __init__(self, *, sheet_id: int, rows: List[ClassificationRow], last_row: int):
+        self.sheet_id = sheet_id
+        self.rows = rows
+        self.last_row = last_row
+
+    def latest(self, count: int) -> List[ClassificationRow]:
+        return self.rows[-count:]
+
+    def append(self, row: ClassificationRow):
+        self.rows.append(row)
+        self.last_row += 1
+
+    @classmethod
+    def from_grid_data(cls, *, sheet_id: int, start_row: int, row_data: List[dict]) -> 'ClassificationHistory':
+        """
+        Build the history from the RowData of a range starting at start_row (1 based), blank rows
+        are skipped.
+        """
+        rows = []
+        last_row = start_row - 1
+        for index, data in enumerate(row_data):
+            values = [cell.get('formattedValue', '')
+                      for cell in data.get('values', [])]
+            if len(values) >= 3 and values[0]:
+                rows.append(ClassificationRow.from_list(values))
+                last_row = start_row + index
+        return ClassificationHistory(sheet_id=sheet_id, rows=rows, last_row=last_row)
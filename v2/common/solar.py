@@ -0,0 +1,175 @@
+import numpy as np
+import pytz
+
+from astral import LocationInfo
+from astral.sun import dawn, dusk
+from datetime import date as Date, datetime, timedelta
+from threading import Lock
+from typing import Iterable, Optional, Tuple
+
+PACIFIC_TIMEZONE = pytz.timezone('US/Pacific')
+SEATTLE = LocationInfo(
+    name='Seattle',
+    region='Washington',
+    timezone='America/Los_Angeles',
+    latitude=47.6209673,
+    longitude=-122.348993
+)
+
+
+class SolarTable:
+    """
+    Dawn and dusk of every day from start_year through end_year, stored as epoch seconds of each
+    day's local midnight, dawn and dusk. A table is never changed once built.
+    """
+    start_year: int
+    end_year: int
+    first_ordinal: int
+    midnights: np.ndarray
+    dawns: np.ndarray
+    dusks: np.ndarray
+
+    def __init__(self, *, start_year: int, end_year: int, location: LocationInfo, timezone: pytz.BaseTzInfo):
+        first_day = Date(start_year, 1, 1)
+        days = (Date(end_year + 1, 1, 1) - first_day).days
+        midnights = np.empty(days, dtype=np.float64)
+        dawns = np.empty(days, dtype=np.float64)
+        dusks = np.empty(days, dtype=np.float64)
+        for index in range(days):
+            day = first_day + timedelta(days=index)
+            midnights[index] = timezone.localize(
+                datetime(day.year, day.month, day.day)).timestamp()
+            dawns[index] = dawn(location.observer, date=day,
+                                tzinfo=timezone).timestamp()
+            dusks[index] = dusk(location.observer, date=day,
+                                tzinfo=timezone).timestamp()
+        for array in (midnights, dawns, dusks):
+            array.flags.writeable = False
+        self.start_year = start_year
+        self.end_year = end_year
+        self.first_ordinal = first_day.toordinal()
+        self.midnights = midnights
+        self.dawns = dawns
+        self.dusks = dusks
+
+    def covers(self, start_year: int, end_year: int) -> bool:
+        return self.start_year <= start_year and end_year <= self.end_year
+
+    def index_of(self, day: Date) -> int:
+        return day.toordinal() - self.first_ordinal
+
+
+class SolarCalendar:
+    """
+    Dawn and dusk for every day of a range of years, precomputed so checking whether a timestamp is
+    at night is a lookup instead of a solar calculation. Whole arrays of timestamps can be checked
+    at once.
+
+    Growing the range builds a new table and replaces the old one in a single assignment, so every
+    lookup takes one reference to the table and reads all of its arrays from it.
+    """
+    location: LocationInfo
+    timezone: pytz.BaseTzInfo
+    table: SolarTable
+    lock: Lock
+
+    def __init__(self, *, start_year: int, end_year: int, location: LocationInfo = SEATTLE, timezone: pytz.BaseTzInfo = PACIFIC_TIMEZONE):
+        self.location = location
+        self.timezone = timezone
+        self.lock = Lock()
+        self.table = SolarTable(start_year=start_year, end_year=end_year,
+                                location=location, timezone=timezone)
+
+    @property
+    def start_year(self) -> int:
+        return self.table.start_year
+
+    @property
+    def end_year(self) -> int:
+        return self.table.end_year
+
+    def cover(self, start_year: int, end_year: int) -> SolarTable:
+        """
+        Make sure every day from start_year through end_year is precomputed, returns a table that
+        covers them.
+        """
+        table = self.table
+        if table.covers(start_year, end_year):
+            return table
+        with self.lock:
+            table = self.table
+            if not table.covers(start_year, end_year):
+                table = SolarTable(
+                    start_year=min(start_year, table.start_year),
+                    end_year=max(end_year, table.end_year),
+                    location=self.location, timezone=self.timezone)
+                self.table = table
+            return table
+
+    def localize(self, timestamp: datetime) -> datetime:
+        """
+        Naive timestamps are taken to be local time, as the camera and snapshot names are.
+        """
+        if timestamp.tzinfo is None:
+            return self.timezone.localize(timestamp)
+        return timestamp.astimezone(self.timezone)
+
+    def dawn_and_dusk(self, day: Date) -> Tuple[datetime, datetime]:
+        table = self.cover(day.year, day.year)
+        index = table.index_of(day)
+        return (datetime.fromtimestamp(table.dawns[index], tz=self.timezone),
+                datetime.fromtimestamp(table.dusks[index], tz=self.timezone))
+
+    def is_night(self, timestamp: datetime) -> bool:
+        local = self.localize(timestamp)
+        table = self.cover(local.year, local.year)
+        index = table.index_of(local.date())
+        seconds = local.timestamp()
+        return bool(seconds < table.dawns[index] or seconds > table.dusks[index])
+
+    def is_night_array(self, epoch_seconds: np.ndarray) -> np.ndarray:
+        """
+        Vectorized is_night for an array of epoch seconds (see epoch_seconds()).
+        """
+        epoch_seconds = np.asarray(epoch_seconds, dtype=np.float64)
+        if epoch_seconds.size == 0:
+            return np.zeros(epoch_seconds.shape, dtype=bool)
+        table = self.__covering(epoch_seconds)
+        indices = np.searchsorted(
+            table.midnights, epoch_seconds, side='right') - 1
+        return (epoch_seconds < table.dawns[indices]) | (epoch_seconds > table.dusks[indices])
+
+    def day_ordinals(self, epoch_seconds: np.ndarray) -> np.ndarray:
+        """
+        The proleptic ordinal of the local day each of an array of epoch seconds falls on.
+        """
+        epoch_seconds = np.asarray(epoch_seconds, dtype=np.float64)
+        if epoch_seconds.size == 0:
+            return np.zeros(epoch_seconds.shape, dtype=np.int64)
+        table = self.__covering(epoch_seconds)
+        return np.searchsorted(table.midnights, epoch_seconds, side='right') - 1 + table.first_ordinal
+
+    def epoch_seconds(self, timestamps: Iterable[datetime]) -> np.ndarray:
+        return np.array([self.localize(timestamp).timestamp() for timestamp in timestamps], dtype=np.float64)
+
+    def __covering(self, epoch_seconds: np.ndarray) -> SolarTable:
+        first = datetime.fromtimestamp(epoch_seconds.min(), tz=self.timezone)
+        last = datetime.fromtimestamp(epoch_seconds.max(), tz=self.timezone)
+        return self.cover(first.year, last.year)
+
+
+_calendar: Optional[SolarCalendar] = None
+_calendar_lock = Lock()
+
+
+def solar_calendar() -> SolarCalendar:
+    """
+    The process wide calendar for Seattle. It starts out covering the current year and grows as
+    timestamps from other years are looked up.
+    """
+    global _calendar
+    with _calendar_lock:
+        if _calendar is None:
+            year = datetime.now(PACIFIC_TIMEZONE).year
+            _calendar = SolarCalendar(start_year=year, end_year=year)
+        return _calendar
@@ -0,0 +1,604 @@
+import os
+import json
+import sqlite3
+import threading
+
+from common.config import notable_state_bucket_name, notable_state_filename, state_store_backend, state_store_path
+from common.frozenmodel import Label
+from common.sheets import ClassificationRow, ClassificationHistory, RangeData, Cell
+from common.tracing import span
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import date as Date, datetime
+from common.services import RETRIES, sheets_service
+from common.storage import bucket_storage
+from google.api_core.exceptions import PreconditionFailed
+from googleapiclient.discovery import Resource
+from typing import List, Optional, Tuple
+
+
+class NotableState:
+    """
+    What the tracker needs to know about the history, kept up to date one classification at a time
+    instead of rescanning the latest rows: the last notable (posted or night) classification, the
+    run of equal classifications at the end of the history and the days seen since the last notable
+    classification.
+    """
+    # Only the most recent days matter since the reset date is always yesterday
+    tracked_days = 3
+    last_notable: Optional[Label]
+    last_notable_date: Optional[datetime]
+    last_posted_date: Optional[datetime]
+    last_classification: Optional[Label]
+    # The date of the last row, rows are appended in date order
+    last_date: Optional[datetime]
+    streak: int
+    rows: int
+    rows_since_notable: int
+    days_since_notable: List[Date]
+
+    def __init__(self):
+        self.last_notable = None
+        self.last_notable_date = None
+        self.last_posted_date = None
+        self.last_classification = None
+        self.last_date = None
+        self.streak = 0
+        self.rows = 0
+        self.rows_since_notable = 0
+        self.days_since_notable = []
+
+    def update(self, row: ClassificationRow):
+        if row.was_posted:
+            self.last_posted_date = row.date
+        if row.was_posted or row.classification == Label.NIGHT:
+            self.last_notable = row.classification
+            self.last_notable_date = row.date
+            self.rows_since_notable = 0
+            self.days_since_notable = []
+        else:
+            self.rows_since_notable += 1
+            day = row.date.date()
+            if not self.days_since_notable or self.days_since_notable[-1] != day:
+                self.days_since_notable = [
+                    *self.days_since_notable, day][-NotableState.tracked_days:]
+        if row.classification == self.last_classification:
+            self.streak += 1
+        else:
+            self.last_classification = row.classification
+            self.streak = 1
+        self.last_date = row.date
+        self.rows += 1
+
+    def includes(self, row: ClassificationRow) -> bool:
+        """
+        Whether row is no later than the last row, so appending it again would repeat or reorder
+        the history.
+        """
+        return self.last_date is not None and row.date <= self.last_date
+
+    def settles_with(self, classification: Label, *, count: int) -> bool:
+        """
+        Whether the last count classifications all equal classification.
+        """
+        if self.rows == 0:
+            return True
+        return self.last_classification == classification and self.streak >= min(count, self.rows)
+
+    def last_notable_classification(self, *, yesterday: Date, history_size: int) -> Label:
+        """
+        The classification new classifications are compared with: the last notable one, or night
+        when there is none in the last history_size rows or none since yesterday.
+        """
+        if self.last_notable is None or self.rows_since_notable >= history_size:
+            # If there has been no posts or night found, just assume that there was
+            # night at some point
+            return Label.NIGHT
+        elif yesterday in self.days_since_notable:
+            print(f'Post not found since yesterday, assuming {Label.NIGHT}')
+            return Label.NIGHT
+        else:
+            return self.last_notable
+
+    def as_dict(self) -> dict:
+        return {
+            'last_notable': self.last_notable.value if self.last_notable else None,
+            'last_notable_date': self.last_notable_date.isoformat() if self.last_notable_date else None,
+            'last_posted_date': self.last_posted_date.isoformat() if self.last_posted_date else None,
+            'last_classification': self.last_classification.value if self.last_classification else None,
+            'last_date': self.last_date.isoformat() if self.last_date else None,
+            'streak': self.streak,
+            'rows': self.rows,
+            'rows_since_notable': self.rows_since_notable,
+            'days_since_notable': [day.isoformat() for day in self.days_since_notable],
+        }
+
+    @classmethod
+    def from_dict(cls, values: dict) -> 'NotableState':
+        state = NotableState()
+        state.last_notable = Label(
+            values['last_notable']) if values['last_notable'] else None
+        state.last_notable_date = datetime.fromisoformat(
+            values['last_notable_date']) if values['last_notable_date'] else None
+        state.last_posted_date = datetime.fromisoformat(
+            values['last_posted_date']) if values['last_posted_date'] else None
+        state.last_classification = Label(
+            values['last_classification']) if values['last_classification'] else None
+        # Saved before the last date was kept
+        state.last_date = datetime.fromisoformat(
+            values['last_date']) if values.get('last_date') else None
+        state.streak = int(values['streak'])
+        state.rows = int(values['rows'])
+        state.rows_since_notable = int(values['rows_since_notable'])
+        state.days_since_notable = [Date.fromisoformat(
+            day) for day in values['days_since_notable']]
+        return state
+
+    @classmethod
+    def rebuild(cls, rows: List[ClassificationRow]) -> 'NotableState':
+        state = NotableState()
+        for row in rows:
+            state.update(row)
+        return state
+
+
+class StateStore:
+    """
+    Where classifications are kept. The tracker makes its decisions from the notable state of a
+    store, which stores keep up to date as rows are appended.
+    """
+    # Rows rescanned when the notable state has to be rebuilt, around 2 days
+    rebuild_size = 100
+
+    def append(self, row: ClassificationRow):
+        """
+        Append row unless it is no later than the last row, which makes retrying an append safe
+        and keeps a late retry from landing after newer rows.
+        """
+        pass
+
+    def latest(self, count: int) -> List[ClassificationRow]:
+        pass
+
+    def read_since(self, position: int, *, limit: int) -> Tuple[List[ClassificationRow], int]:
+        """
+        Up to limit rows after position, in the order they were appended, along with the position
+        after the last of them. Position 0 is before the first row.
+        """
+        pass
+
+    def notable_state(self) -> NotableState:
+        return self.rebuild_notable_state()
+
+    def rebuild_notable_state(self) -> NotableState:
+        """
+        Rescan the latest rows, only needed when there is no notable state yet or it is corrupt.
+        """
+        print(f'Rebuilding notable state from the latest {StateStore.rebuild_size} rows')
+        return NotableState.rebuild(self.latest(StateStore.rebuild_size))
+
+    def close(self):
+        pass
+
+
+class SheetsStateStore(StateStore):
+    spreadsheet_id = '1nMkjiqMvsOhj-ljEab2aBvNWy3bJXdot3u2vRXsyI5Q'
+    spreadsheet_sheet_name = 'StateV2'
+    spreadsheet_range = f'{spreadsheet_sheet_name}!A2:C'
+    # Extra rows read past the last known row in case rows were appended by another process
+    history_margin = 20
+    # Where the sheet ended and its notable state as of the last read or write of this process,
+    # saved to storage too so a new process does not have to rescan the sheet
+    last_row_hint: Optional[int] = None
+    state_hint: Optional[NotableState] = None
+    # The generation of the saved hint that was last read or written, 0 when there is none
+    hint_generation: Optional[int] = None
+    hint_lock = threading.Lock()
+    service: Resource
+    history: Optional[ClassificationHistory]
+    sheet_id: Optional[int]
+    last_row: Optional[int]
+    state: Optional[NotableState]
+    # A row this store appended whose formula has not been pasted yet
+    unpasted_row: Optional[int]
+
+    def __init__(self):
+        self.service = sheets_service()
+        self.history = None
+        self.sheet_id = None
+        self.last_row = None
+        self.state = None
+        self.unpasted_row = None
+
+    def append(self, row: ClassificationRow):
+        """
+        Append the classification, then copy the formula of the first row next to it. Other
+        processes append too, so the formula goes on the row the append reports it wrote rather
+        than the row after the last row known to this store.
+
+        A row no later than the last row is not appended again, so an append that failed part way
+        can be retried: only the formula of a row this store wrote is still pasted.
+        """
+        state = self.notable_state()
+        if state.includes(row):
+            print(f'{row} is already in the history, not appending it')
+            self.__paste_pending_formula()
+            return
+        response = self.__execute('sheets.values.append', self.service.spreadsheets().values().append(
+            spreadsheetId=SheetsStateStore.spreadsheet_id,
+            range=SheetsStateStore.spreadsheet_range,
+            valueInputOption='USER_ENTERED',
+            insertDataOption='INSERT_ROWS',
+            body={'values': [row.as_list()]},
+        ), num_retries=0)
+        self.unpasted_row = RangeData(response.get('updates', {}).get(
+            'updatedRange', '')).start_cell.row
+        if self.unpasted_row == self.last_row + 1:
+            self.last_row = self.unpasted_row
+            state.update(row)
+            if self.history is not None:
+                self.history.append(row)
+            self.__remember()
+        else:
+            # Rows this store has not read were appended in between, read them again next time
+            self.__forget()
+        self.__paste_pending_formula()
+
+    def __paste_pending_formula(self):
+        if self.unpasted_row is not None:
+            self.__paste_formula(self.unpasted_row)
+            self.unpasted_row = None
+
+    def __paste_formula(self, row: int):
+        self.__execute('sheets.batchUpdate', self.service.spreadsheets().batchUpdate(
+            spreadsheetId=SheetsStateStore.spreadsheet_id,
+            body={
+                'requests': [{
+                    'copyPaste': {
+                        'source': {
+                            'sheetId': self.sheet_id,
+                            'startColumnIndex': 3,
+                            'endColumnIndex': 4,
+                            'startRowIndex': 1,
+                            'endRowIndex': 2,
+                        },
+                        'destination': {
+                            'sheetId': self.sheet_id,
+                            'startColumnIndex': 3,
+                            'endColumnIndex': 4,
+                            # Row indexes start at 0 and rows at 1
+                            'startRowIndex': row - 1,
+                            'endRowIndex': row,
+                        },
+                        'pasteType': 'PASTE_FORMULA',
+                        'pasteOrientation': 'NORMAL',
+                    },
+                }],
+            }
+        ), num_retries=0)
+
+    def latest(self, count: int) -> List[ClassificationRow]:
+        return self.read_history().latest(count)
+
+    def read_since(self, position: int, *, limit: int) -> Tuple[List[ClassificationRow], int]:
+        # Positions are sheet rows, the first classification is on row 2
+        start_row = max(position, 1) + 1
+        range = RangeData.of(
+            sheet_name=SheetsStateStore.spreadsheet_sheet_name,
+            start=Cell(f'A{start_row}'),
+            end=Cell(f'C{start_row + limit - 1}'))
+        response = self.__execute('sheets.values.get', self.service.spreadsheets().values().get(
+            spreadsheetId=SheetsStateStore.spreadsheet_id,
+            range=str(range),
+        ))
+        values = response.get('values', [])
+        rows = [ClassificationRow.from_list(value)
+                for value in values if len(value) >= 3 and value[0]]
+        return rows, start_row + len(values) - 1 if values else position
+
+    def notable_state(self) -> NotableState:
+        """
+        Catch up on the notable state this process already knows by reading only the rows appended
+        since, otherwise rebuild it from the latest rows.
+        """
+        if self.state is None:
+            self.__load_hint()
+            hint = SheetsStateStore.state_hint
+            last_row = SheetsStateStore.last_row_hint
+            if hint is not None and last_row is not None:
+                appended = self.__read_rows(
+                    start_row=last_row + 1, end_row=last_row + SheetsStateStore.history_margin)
+                if appended.last_row < last_row + SheetsStateStore.history_margin:
+                    state = NotableState.from_dict(hint.as_dict())
+                    for row in appended.rows:
+                        state.update(row)
+                    self.sheet_id = appended.sheet_id
+                    self.last_row = appended.last_row
+                    self.state = state
+            if self.state is None:
+                self.state = self.rebuild_notable_state()
+            self.__remember()
+        return self.state
+
+    def rebuild_notable_state(self) -> NotableState:
+        history = self.read_history()
+        self.sheet_id = history.sheet_id
+        self.last_row = history.last_row
+        return NotableState.rebuild(history.latest(StateStore.rebuild_size))
+
+    def read_history(self) -> ClassificationHistory:
+        """
+        Read the latest classifications once per store.
+        """
+        if self.history is None:
+            last_row = SheetsStateStore.last_row_hint
+            history = None
+            if last_row is not None:
+                history = self.__read_history_ending_at(
+                    last_row + SheetsStateStore.history_margin)
+                if history.last_row >= last_row + SheetsStateStore.history_margin:
+                    # More rows were appended than expected, the real end is past what was read
+                    history = None
+            if history is None:
+                history = self.__read_history_ending_at(
+                    self.__get_latest_classification_range().start_cell.row)
+            self.history = history
+        return self.history
+
+    def __load_hint(self):
+        """
+        Read the saved hint once per process, later hints are kept in memory as well as saved.
+        """
+        with SheetsStateStore.hint_lock:
+            if SheetsStateStore.hint_generation is not None:
+                return
+            hint, SheetsStateStore.hint_generation = self.__read_saved_hint()
+            if hint is None or SheetsStateStore.state_hint is not None:
+                return
+            try:
+                state = NotableState.from_dict(hint['state'])
+                SheetsStateStore.last_row_hint = int(hint['last_row'])
+                SheetsStateStore.state_hint = state
+            except (ValueError, KeyError, TypeError) as error:
+                print(f'Saved notable state is corrupt: {error}')
+
+    def __remember(self):
+        SheetsStateStore.last_row_hint = self.last_row
+        SheetsStateStore.state_hint = NotableState.from_dict(
+            self.state.as_dict())
+        self.__save_hint()
+
+    def __save_hint(self):
+        """
+        Save the hint unless another process saved one since it was read, keeping whichever is
+        further along the sheet. A hint that is behind only costs reading the rows after it.
+        """
+        data = json.dumps({
+            'last_row': self.last_row,
+            'state': self.state.as_dict(),
+        }).encode('utf-8')
+        storage = bucket_storage(bucket_name=notable_state_bucket_name())
+        with SheetsStateStore.hint_lock:
+            for _ in range(3):
+                generation = SheetsStateStore.hint_generation
+                if generation is None:
+                    _, generation = self.__read_saved_hint()
+                try:
+                    SheetsStateStore.hint_generation = storage.save_bytes(data, filename=notable_state_filename(),
+                                                                          content_type='application/json', if_generation_match=generation)
+                    return
+                except PreconditionFailed:
+                    saved, SheetsStateStore.hint_generation = self.__read_saved_hint()
+                    if saved is not None and (saved.get('last_row') or 0) >= self.last_row:
+                        return
+
+    def __read_saved_hint(self) -> Tuple[Optional[dict], int]:
+        storage = bucket_storage(bucket_name=notable_state_bucket_name())
+        while True:
+            blob = storage.get(notable_state_filename())
+            if blob is None:
+                return None, 0
+            try:
+                data = blob.download_as_bytes(
+                    if_generation_match=blob.generation)
+            except PreconditionFailed:
+                # Saved again between getting and downloading it
+                continue
+            try:
+                return json.loads(data.decode('utf-8')), int(blob.generation)
+            except ValueError as error:
+                print(f'Saved notable state is corrupt: {error}')
+                return None, int(blob.generation)
+
+    def __forget(self):
+        self.history = None
+        self.last_row = None
+        self.state = None
+        SheetsStateStore.last_row_hint = None
+        SheetsStateStore.state_hint = None
+
+    def __read_history_ending_at(self, end_row: int) -> ClassificationHistory:
+        return self.__read_rows(
+            start_row=Cell(f'A{end_row}').minus_rows(
+                StateStore.rebuild_size + SheetsStateStore.history_margin, min_row=2).row,
+            end_row=end_row)
+
+    def __read_rows(self, *, start_row: int, end_row: int) -> ClassificationHistory:
+        range = RangeData.of(
+            sheet_name=SheetsStateStore.spreadsheet_sheet_name,
+            start=Cell(f'A{start_row}'),
+            end=Cell(f'C{end_row}'))
+        response = self.__execute('sheets.get', self.service.spreadsheets().get(
+            spreadsheetId=SheetsStateStore.spreadsheet_id,
+            ranges=[str(range)],
+            includeGridData=True,
+            fields='sheets(properties(sheetId,title),data(startRow,rowData(values(formattedValue))))',
+        ))
+        state_sheet = list(filter(
+            lambda sheet: sheet['properties']['title'] ==
+            SheetsStateStore.spreadsheet_sheet_name, response['sheets']))[0]
+        data = (state_sheet.get('data') or [{}])[0]
+        return ClassificationHistory.from_grid_data(
+            sheet_id=state_sheet['properties']['sheetId'],
+            start_row=data.get('startRow', start_row - 1) + 1,
+            row_data=data.get('rowData', []))
+
+    def __get_latest_classification_range(self) -> RangeData:
+        response = self.__execute('sheets.values.append', self.service.spreadsheets().values().append(
+            spreadsheetId=SheetsStateStore.spreadsheet_id,
+            range=SheetsStateStore.spreadsheet_range,
+            valueInputOption='USER_ENTERED',
+            body={'values': [['', '', '']]}
+        ))
+        return RangeData(response.get('updates', {}).get('updatedRange', ''))
+
+    def __execute(self, name: str, request, *, num_retries: int = RETRIES):
+        with span(name, remote=True):
+            return request.execute(num_retries=num_retries)
+
+
+class SqliteStateStore(StateStore):
+    """
+    Classifications in a local SQLite database, fast enough to be the source of truth and usable
+    offline. The notable state is saved in the same transaction as each row.
+    """
+    path: str
+    connection: sqlite3.Connection
+    lock: threading.Lock
+    state: Optional[NotableState]
+
+    def __init__(self, path: str):
+        self.path = path
+        self.state = None
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.lock, self.connection:
+            self.connection.execute('PRAGMA journal_mode=WAL')
+            self.connection.execute('''
+                CREATE TABLE IF NOT EXISTS classifications (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    date TEXT NOT NULL,
+                    classification TEXT NOT NULL,
+                    was_posted INTEGER NOT NULL
+                )''')
+            self.connection.execute('''
+                CREATE TABLE IF NOT EXISTS notable_state (
+                    id INTEGER PRIMARY KEY CHECK (id = 0),
+                    state TEXT NOT NULL
+                )''')
+
+    def append(self, row: ClassificationRow):
+        if self.notable_state().includes(row):
+            print(f'{row} is already in the history, not appending it')
+            return
+        state = NotableState.from_dict(self.notable_state().as_dict())
+        state.update(row)
+        with self.lock, self.connection:
+            self.connection.execute(
+                'INSERT INTO classifications (date, classification, was_posted) VALUES (?, ?, ?)',
+                (row.date.strftime('%Y-%m-%dT%H:%M:%S'), row.classification.value, int(bool(row.was_posted))))
+            self.__save(state)
+        self.state = state
+
+    def latest(self, count: int) -> List[ClassificationRow]:
+        with self.lock:
+            rows = self.connection.execute(
+                'SELECT date, classification, was_posted FROM classifications ORDER BY id DESC LIMIT ?', (count,)).fetchall()
+        return [self.__row(row) for row in reversed(rows)]
+
+    def read_since(self, position: int, *, limit: int) -> Tuple[List[ClassificationRow], int]:
+        # Positions are row ids
+        with self.lock:
+            rows = self.connection.execute(
+                'SELECT id, date, classification, was_posted FROM classifications WHERE id > ? ORDER BY id LIMIT ?', (position, limit)).fetchall()
+        return [self.__row(row[1:]) for row in rows], rows[-1][0] if rows else position
+
+    def notable_state(self) -> NotableState:
+        if self.state is None:
+            with self.lock:
+                saved = self.connection.execute(
+                    'SELECT state FROM notable_state WHERE id = 0').fetchone()
+            try:
+                self.state = NotableState.from_dict(json.loads(saved[0])) if saved else None
+            except (ValueError, KeyError, TypeError) as error:
+                print(f'Saved notable state is corrupt: {error}')
+            if self.state is None:
+                self.state = self.rebuild_notable_state()
+                with self.lock, self.connection:
+                    self.__save(self.state)
+        return self.state
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+    def __save(self, state: NotableState):
+        self.connection.execute(
+            'INSERT OR REPLACE INTO notable_state (id, state) VALUES (0, ?)', (json.dumps(state.as_dict()),))
+
+    def __row(self, row) -> ClassificationRow:
+        return ClassificationRow.from_list([row[0], row[1], 'TRUE' if row[2] else 'FALSE'])
+
+
+class MirroredStateStore(StateStore):
+    """
+    Reads from and writes to a primary store while every append is copied to a mirror in the
+    background. An empty primary is seeded from the mirror.
+    """
+    primary: StateStore
+    mirror: StateStore
+    executor: ThreadPoolExecutor
+    pending: List[Future]
+
+    def __init__(self, *, primary: StateStore, mirror: StateStore, seed_count: int = 100):
+        self.primary = primary
+        self.mirror = mirror
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.pending = []
+        if not self.primary.latest(1):
+            print(f'Seeding state store from its mirror')
+            for row in self.mirror.latest(seed_count):
+                self.primary.append(row)
+
+    def append(self, row: ClassificationRow):
+        self.primary.append(row)
+        self.pending.append(self.executor.submit(self.mirror.append, row))
+
+    def latest(self, count: int) -> List[ClassificationRow]:
+        return self.primary.latest(count)
+
+    def read_since(self, position: int, *, limit: int) -> Tuple[List[ClassificationRow], int]:
+        return self.primary.read_since(position, limit=limit)
+
+    def notable_state(self) -> NotableState:
+        return self.primary.notable_state()
+
+    def flush(self):
+        """
+        Wait for the mirror to catch up, failures are reported but do not affect the primary.
+        """
+        for future in self.pending:
+            error = future.exception()
+            if error is not None:
+                print(f'Failed to mirror classification: {error}')
+        self.pending = []
+
+    def close(self):
+        self.flush()
+        self.executor.shutdown()
+        self.primary.close()
+        self.mirror.close()
+
+
+def state_store() -> StateStore:
+    backend = state_store_backend()
+    if backend == 'sheets':
+        return SheetsStateStore()
+    elif backend == 'sqlite':
+        return SqliteStateStore(state_store_path())
+    elif backend == 'sqlite+sheets':
+        return MirroredStateStore(primary=SqliteStateStore(state_store_path()), mirror=SheetsStateStore())
+    else:
+        raise Exception(f'Unknown state store backend {backend}')
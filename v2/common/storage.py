@@ -1,11 +1,40 @@
+import os
+import mmap
+import shutil
+import tempfile
+import threading
+
 from io import BytesIO
 from PIL import Image
+from google.api_core.exceptions import NotFound, NotModified, PreconditionFailed
 from google.cloud import storage
-from typing import List
+from common.config import storage_backend, local_storage_root
+from common.encoding import ImageFormat, PNG
+from common.tracing import span
+from contextlib import contextmanager
+from typing import BinaryIO, Dict, Iterator, List, Optional, Tuple
 
 
 class Storage:
-    def save_image(self, image: Image.Image, *, filename: str):
+    def save_image(self, image: Image.Image, *, filename: str, image_format: ImageFormat = PNG, stream: bool = False) -> str:
+        """
+        Encode and save image as filename with the extension of image_format, returns the name of
+        the saved file. When streaming the encoder writes straight into the upload, so the encoded
+        image is never held in memory as a whole. A streamed image is only saved when the file does
+        not exist yet, PreconditionFailed is raised otherwise, so an encoding that fails part way
+        never replaces an image that was saved before.
+        """
+        pass
+
+    def save_file(self, local_filename: str, *, filename: str):
+        pass
+
+    def save_bytes(self, data: bytes, *, filename: str, content_type: str = 'application/octet-stream', if_generation_match: Optional[int] = None) -> Optional[int]:
+        """
+        Save data as filename and return the generation it was saved as. With if_generation_match
+        the file is only replaced while it is still at that generation (0 when it must not exist
+        yet), otherwise PreconditionFailed is raised.
+        """
         pass
 
     def list_files(self, directory) -> List[storage.Blob]:
@@ -17,29 +46,312 @@ class Storage:
     def get_image(self, filename: str) -> Image.Image:
         pass
 
+    def download_if_modified(self, filename: str, local_filename: str, *, generation: Optional[int]):
+        pass
+
+    def stream(self, filename: str, *, chunk_size: int = 1024 * 1024) -> Iterator[bytes]:
+        """
+        Read a file chunk by chunk without holding all of it in memory.
+        """
+        pass
+
+    def delete(self, filename: str, *, if_generation_match: Optional[int] = None):
+        pass
+
 
 class GcpBucketStorage(Storage):
+    """
+    A bucket accessed through the process wide client. The bucket handle is built locally rather
+    than fetched, a missing bucket surfaces as NotFound from the first request that uses it.
+    """
+    # Resumable uploads are sent in multiples of 256KB
+    upload_chunk_size = 1024 * 1024
     bucket_name: str
     client: storage.Client
     bucket: storage.Bucket
 
-    def __init__(self, *, bucket_name: str):
+    def __init__(self, *, bucket_name: str, client: Optional[storage.Client] = None):
         self.bucket_name = bucket_name
-        self.client = storage.Client()
-        self.bucket = self.client.get_bucket(self.bucket_name)
+        self.client = client or storage_client()
+        self.bucket = self.client.bucket(self.bucket_name)
+
+    def save_image(self, image: Image.Image, *, filename: str, image_format: ImageFormat = PNG, stream: bool = False) -> str:
+        name = f'{filename}{image_format.extension}'
+        if stream:
+            self.__stream_image(image, name=name, image_format=image_format)
+            return name
+        with span('storage.encode_image', filename=filename, format=image_format.name):
+            data = image_format.to_bytes(image)
+        with span('storage.upload', remote=True, bucket=self.bucket_name, filename=name):
+            self.bucket.blob(name).upload_from_string(
+                data, content_type=image_format.content_type)
+        return name
+
+    def __stream_image(self, image: Image.Image, *, name: str, image_format: ImageFormat):
+        blob = self.bucket.blob(name)
+        with span('storage.stream_upload', remote=True, bucket=self.bucket_name, filename=name, format=image_format.name):
+            try:
+                # Encoders flush when they finish, which a resumable upload can only do by closing
+                with blob.open('wb', chunk_size=GcpBucketStorage.upload_chunk_size, ignore_flush=True,
+                               content_type=image_format.content_type, if_generation_match=0) as writer:
+                    image_format.encode(image, writer)
+            except PreconditionFailed:
+                # The file already existed and was left as it was
+                raise
+            except Exception:
+                # Closing the upload finished it with the part that was encoded. The file did not
+                # exist before, so what is there now is that part.
+                try:
+                    blob.delete()
+                except NotFound:
+                    pass
+                raise
+
+    def save_file(self, local_filename: str, *, filename: str):
+        with span('storage.upload', remote=True, bucket=self.bucket_name, filename=filename):
+            self.bucket.blob(filename).upload_from_filename(local_filename)
 
-    def save_image(self, image: Image.Image, *, filename: str):
-        blob = self.bucket.blob(f'{filename}.png')
-        imagefile = BytesIO()
-        image.save(imagefile, format='PNG')
-        blob.upload_from_string(imagefile.getvalue())
+    def save_bytes(self, data: bytes, *, filename: str, content_type: str = 'application/octet-stream', if_generation_match: Optional[int] = None) -> Optional[int]:
+        blob = self.bucket.blob(filename)
+        with span('storage.upload', remote=True, bucket=self.bucket_name, filename=filename):
+            blob.upload_from_string(
+                data, content_type=content_type, if_generation_match=if_generation_match)
+        return int(blob.generation) if blob.generation is not None else None
 
     def list_files(self, directory: str) -> List[storage.Blob]:
-        return list(self.client.list_blobs(self.bucket_name, prefix=directory))
+        with span('storage.list_files', remote=True, bucket=self.bucket_name, directory=directory):
+            return list(self.client.list_blobs(self.bucket_name, prefix=directory))
 
     def get(self, filename: str) -> storage.Blob:
-        return self.bucket.get_blob(filename)
+        with span('storage.get', remote=True, bucket=self.bucket_name, filename=filename):
+            return self.bucket.get_blob(filename)
 
     def get_image(self, filename: str) -> Image.Image:
         blob = self.get(filename)
-        return Image.open(BytesIO(blob.download_as_bytes()))
+        with span('storage.download', remote=True, bucket=self.bucket_name, filename=filename):
+            data = blob.download_as_bytes()
+        return Image.open(BytesIO(data))
+
+    def download_if_modified(self, filename: str, local_filename: str, *, generation: Optional[int]) -> Optional[storage.Blob]:
+        """
+        Download filename unless it is still at generation, in a single request. Returns the blob
+        (with its new generation) when it was downloaded and None when it was not modified.
+        Raises NotFound when there is no such file.
+        """
+        blob = self.bucket.blob(filename)
+        with span('storage.download', remote=True, bucket=self.bucket_name, filename=filename, conditional=generation is not None):
+            try:
+                blob.download_to_filename(
+                    local_filename, if_generation_not_match=generation)
+            except NotModified:
+                return None
+        return blob
+
+    def stream(self, filename: str, *, chunk_size: int = 1024 * 1024) -> Iterator[bytes]:
+        with span('storage.stream', remote=True, bucket=self.bucket_name, filename=filename):
+            with self.bucket.blob(filename).open('rb', chunk_size=chunk_size) as f:
+                yield from iter(lambda: f.read(chunk_size), b'')
+
+    def delete(self, filename: str, *, if_generation_match: Optional[int] = None):
+        with span('storage.delete', remote=True, bucket=self.bucket_name, filename=filename):
+            self.bucket.blob(filename).delete(
+                if_generation_match=if_generation_match)
+
+
+class LocalBlob:
+    """
+    A file of a LocalDirectoryStorage, with the parts of storage.Blob callers use. Its generation
+    is the modification time in nanoseconds, which changes whenever the file is replaced.
+    """
+    name: str
+    path: str
+
+    def __init__(self, *, name: str, path: str):
+        self.name = name
+        self.path = path
+
+    @property
+    def generation(self) -> Optional[int]:
+        return os.stat(self.path).st_mtime_ns if os.path.exists(self.path) else None
+
+    @property
+    def etag(self) -> Optional[str]:
+        generation = self.generation
+        return None if generation is None else f'{generation:x}'
+
+    @property
+    def size(self) -> Optional[int]:
+        return os.path.getsize(self.path) if os.path.exists(self.path) else None
+
+    def exists(self) -> bool:
+        return os.path.exists(self.path)
+
+    def open(self) -> mmap.mmap:
+        """
+        Map the file into memory, the map reads like a file (read, seek and tell).
+        """
+        with open(self.path, 'rb') as f:
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def check_generation(self, if_generation_match: Optional[int]):
+        """
+        Raise PreconditionFailed unless the file is at if_generation_match, 0 when it does not exist.
+        """
+        if if_generation_match is not None and (self.generation or 0) != if_generation_match:
+            raise PreconditionFailed(self.name)
+
+    def download_as_bytes(self, *, if_generation_match: Optional[int] = None, **kwargs) -> bytes:
+        self.check_generation(if_generation_match)
+        if not self.size:
+            return b''
+        with self.open() as mapped:
+            return mapped[:]
+
+    def download_as_string(self, **kwargs) -> bytes:
+        return self.download_as_bytes()
+
+    def download_to_filename(self, filename: str, **kwargs):
+        shutil.copyfile(self.path, filename)
+
+    @contextmanager
+    def writer(self) -> Iterator[BinaryIO]:
+        """
+        Write the file, it is replaced once writing succeeds and left untouched when it fails.
+        """
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        descriptor, temporary_filename = tempfile.mkstemp(
+            dir=os.path.dirname(self.path), prefix='.upload-')
+        try:
+            with os.fdopen(descriptor, 'wb') as f:
+                yield f
+            os.replace(temporary_filename, self.path)
+        finally:
+            if os.path.exists(temporary_filename):
+                os.unlink(temporary_filename)
+
+    def upload_from_string(self, data, *, if_generation_match: Optional[int] = None, **kwargs):
+        self.check_generation(if_generation_match)
+        with self.writer() as f:
+            f.write(data if isinstance(data, bytes) else data.encode('utf-8'))
+
+    def upload_from_filename(self, filename: str, **kwargs):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        shutil.copyfile(filename, f'{self.path}.upload')
+        os.replace(f'{self.path}.upload', self.path)
+
+    def delete(self, *, if_generation_match: Optional[int] = None):
+        if not self.exists():
+            raise NotFound(self.name)
+        self.check_generation(if_generation_match)
+        os.unlink(self.path)
+
+
+class LocalDirectoryStorage(Storage):
+    """
+    A bucket synced to a local directory (<root>/<bucket name>), for batch jobs running next to a
+    copy of the buckets and for running pipelines offline. Reads are memory mapped.
+    """
+    bucket_name: str
+    directory: str
+
+    def __init__(self, *, bucket_name: str, root: Optional[str] = None):
+        self.bucket_name = bucket_name
+        self.directory = os.path.join(root or local_storage_root(), bucket_name)
+
+    def blob(self, filename: str) -> LocalBlob:
+        return LocalBlob(name=filename, path=os.path.join(self.directory, filename))
+
+    def save_image(self, image: Image.Image, *, filename: str, image_format: ImageFormat = PNG, stream: bool = False) -> str:
+        name = f'{filename}{image_format.extension}'
+        if stream:
+            blob = self.blob(name)
+            blob.check_generation(0)
+            with blob.writer() as f:
+                image_format.encode(image, f)
+        else:
+            self.blob(name).upload_from_string(image_format.to_bytes(image))
+        return name
+
+    def save_file(self, local_filename: str, *, filename: str):
+        self.blob(filename).upload_from_filename(local_filename)
+
+    def save_bytes(self, data: bytes, *, filename: str, content_type: str = 'application/octet-stream', if_generation_match: Optional[int] = None) -> Optional[int]:
+        blob = self.blob(filename)
+        blob.upload_from_string(data, if_generation_match=if_generation_match)
+        return blob.generation
+
+    def list_files(self, directory: str) -> List[LocalBlob]:
+        """
+        Every file whose name starts with directory, like a prefix listing of a bucket.
+        """
+        parent = os.path.dirname(directory)
+        names = []
+        for path, _, files in os.walk(os.path.join(self.directory, parent)):
+            relative = os.path.relpath(path, self.directory)
+            for file in files:
+                name = file if relative == '.' else f'{relative}/{file}'.replace(os.sep, '/')
+                if name.startswith(directory) and not file.startswith('.upload-') and not file.endswith('.upload'):
+                    names.append(name)
+        return [self.blob(name) for name in sorted(names)]
+
+    def get(self, filename: str) -> Optional[LocalBlob]:
+        blob = self.blob(filename)
+        return blob if blob.exists() else None
+
+    def get_image(self, filename: str) -> Image.Image:
+        with self.blob(filename).open() as mapped:
+            image = Image.open(mapped)
+            image.load()
+        return image
+
+    def download_if_modified(self, filename: str, local_filename: str, *, generation: Optional[int]) -> Optional[LocalBlob]:
+        blob = self.blob(filename)
+        if not blob.exists():
+            raise NotFound(filename)
+        if generation is not None and blob.generation == generation:
+            return None
+        blob.download_to_filename(local_filename)
+        return blob
+
+    def stream(self, filename: str, *, chunk_size: int = 1024 * 1024) -> Iterator[bytes]:
+        with open(self.blob(filename).path, 'rb') as f:
+            yield from iter(lambda: f.read(chunk_size), b'')
+
+    def delete(self, filename: str, *, if_generation_match: Optional[int] = None):
+        self.blob(filename).delete(if_generation_match=if_generation_match)
+
+
+_client: Optional[storage.Client] = None
+_storages: Dict[Tuple[str, str], Storage] = {}
+_lock = threading.Lock()
+
+
+def storage_client() -> storage.Client:
+    """
+    The process wide storage client, credentials are looked up once and every bucket shares its
+    authorized session.
+    """
+    global _client
+    with _lock:
+        if _client is None:
+            with span('storage.client'):
+                _client = storage.Client()
+        return _client
+
+
+def bucket_storage(*, bucket_name: str) -> Storage:
+    """
+    The process wide storage of a bucket for the configured backend, see storage_backend().
+    """
+    backend = storage_backend()
+    with _lock:
+        storage_of_bucket = _storages.get((backend, bucket_name))
+    if storage_of_bucket is None:
+        if backend == 'local':
+            storage_of_bucket = LocalDirectoryStorage(bucket_name=bucket_name)
+        else:
+            storage_of_bucket = GcpBucketStorage(bucket_name=bucket_name)
+        with _lock:
+            storage_of_bucket = _storages.setdefault(
+                (backend, bucket_name), storage_of_bucket)
+    return storage_of_bucket
@@ -0,0 +1,185 @@
+"""
+Lightweight span tracing. Spans are timed, nested through a context variable and emitted as JSON
+log records (which cloud logging turns into structured entries). When tracing is disabled span()
+hands back a shared no-op context manager so instrumented code pays close to nothing.
+"""
+import os
+import json
+import time
+import uuid
+import functools
+import threading
+import contextvars
+
+from typing import Any, Callable, Dict, List, Optional
+
+
+class Span:
+    name: str
+    span_id: str
+    parent: Optional['Span']
+    attributes: Dict[str, Any]
+    start: float
+    duration_ms: Optional[float]
+
+    def __init__(self, name: str, *, parent: Optional['Span'], attributes: Dict[str, Any]):
+        self.name = name
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent = parent
+        self.attributes = attributes
+        self.start = time.perf_counter()
+        self.duration_ms = None
+
+    @property
+    def depth(self) -> int:
+        return 0 if self.parent is None else self.parent.depth + 1
+
+
+class Tracer:
+    enabled: bool
+    trace_id: str
+    spans: List[Span]
+    lock: threading.Lock
+
+    def __init__(self, *, enabled: bool):
+        self.enabled = enabled
+        self.trace_id = uuid.uuid4().hex
+        self.spans = []
+        self.lock = threading.Lock()
+
+    def start_trace(self):
+        with self.lock:
+            self.trace_id = uuid.uuid4().hex
+            self.spans = []
+
+    def finish(self, span: Span, *, error: Optional[BaseException]):
+        span.duration_ms = (time.perf_counter() - span.start) * 1000
+        with self.lock:
+            self.spans.append(span)
+        record = {
+            'severity': 'ERROR' if error else 'INFO',
+            'message': f'span {span.name} took {span.duration_ms:.1f}ms',
+            'trace_id': self.trace_id,
+            'span_id': span.span_id,
+            'parent_id': span.parent.span_id if span.parent else None,
+            'span': span.name,
+            'depth': span.depth,
+            'duration_ms': round(span.duration_ms, 3),
+            **({'attributes': span.attributes} if span.attributes else {}),
+            **({'error': repr(error)} if error else {}),
+        }
+        print(json.dumps(record, default=str))
+
+
+class _SpanContext:
+    tracer: Tracer
+    name: str
+    attributes: Dict[str, Any]
+    span: Span
+    token: contextvars.Token
+
+    def __init__(self, tracer: Tracer, name: str, attributes: Dict[str, Any]):
+        self.tracer = tracer
+        self.name = name
+        self.attributes = attributes
+
+    def __enter__(self) -> Span:
+        self.span = Span(self.name, parent=_current.get(),
+                         attributes=self.attributes)
+        self.token = _current.set(self.span)
+        return self.span
+
+    def __exit__(self, error_type, error, traceback):
+        _current.reset(self.token)
+        self.tracer.finish(self.span, error=error)
+        return False
+
+
+class _NoopContext:
+    def __enter__(self):
+        return None
+
+    def __exit__(self, *args):
+        return False
+
+
+def enabled_by_environment() -> bool:
+    return os.environ.get('ISTHEMOUNTAINOUT_TRACE', '') not in ('', '0')
+
+
+_tracer = Tracer(enabled=enabled_by_environment())
+_current: contextvars.ContextVar = contextvars.ContextVar(
+    'span', default=None)
+_noop = _NoopContext()
+
+
+def enable(enabled: bool = True):
+    _tracer.enabled = enabled
+
+
+def is_enabled() -> bool:
+    return _tracer.enabled
+
+
+def start_trace():
+    """
+    Forget the spans of the previous trace, call at the start of each invocation.
+    """
+    _tracer.start_trace()
+
+
+def span(name: str, **attributes):
+    """
+    Time the enclosed block. Mark spans that wrap a remote call with remote=True so summary() can
+    tell which round-trip dominated.
+    """
+    if not _tracer.enabled:
+        return _noop
+    return _SpanContext(_tracer, name, attributes)
+
+
+def traced(name: str, **attributes):
+    def decorator(function: Callable):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not _tracer.enabled:
+                return function(*args, **kwargs)
+            with _SpanContext(_tracer, name, attributes):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def propagate(function: Callable) -> Callable:
+    """
+    Carry the current span over to another thread, e.g. before submitting to an executor.
+    """
+    parent = _current.get()
+
+    def run(*args, **kwargs):
+        token = _current.set(parent)
+        try:
+            return function(*args, **kwargs)
+        finally:
+            _current.reset(token)
+    return run
+
+
+def summary() -> Dict[str, Any]:
+    """
+    Total time spent per span name in the current trace, along with the slowest remote call.
+    """
+    with _tracer.lock:
+        spans = list(_tracer.spans)
+    totals: Dict[str, float] = {}
+    for finished in spans:
+        totals[finished.name] = totals.get(
+            finished.name, 0) + finished.duration_ms
+    remote = [s for s in spans if s.attributes.get('remote')]
+    slowest = max(remote, key=lambda s: s.duration_ms, default=None)
+    return {
+        'trace_id': _tracer.trace_id,
+        'spans_ms': {name: round(ms, 3) for name, ms in totals.items()},
+        'remote_ms': round(sum(s.duration_ms for s in remote), 3),
+        'slowest_remote': {'span': slowest.name, 'duration_ms': round(slowest.duration_ms, 3)} if slowest else None,
+    }
@@ -4,10 +4,11 @@ import io
 import random
 
 from common.config import brand_bucket_name, brand_filename, twitter_api_key_bucket_name, twitter_api_key_filename
-from common.storage import GcpBucketStorage
+from common.cache import cached_storage
 from common.frozenmodel import Label
+from common.tracing import span, traced
 from datetime import datetime
-from typing import List
+from typing import List, Optional
 from PIL import Image
 
 
@@ -26,7 +27,7 @@ class TwitterApiKeys:
     @classmethod
     def from_storage(cls):
         print('Loading twitter keys from the cloud')
-        bucket = GcpBucketStorage(bucket_name=twitter_api_key_bucket_name())
+        bucket = cached_storage(bucket_name=twitter_api_key_bucket_name())
         blob = bucket.get(twitter_api_key_filename())
         keys = json.loads(blob.download_as_string().decode('utf-8'))
         return TwitterApiKeys(
@@ -74,15 +75,28 @@ class TwitterPoster:
         else:
             return []
 
-    def brand_image(self, image: Image.Image) -> Image.Image:
+    @classmethod
+    def load_brand(cls) -> Image.Image:
         print('Loading brand image from the cloud')
-        bucket = GcpBucketStorage(bucket_name=brand_bucket_name())
-        brand = bucket.get_image(brand_filename())
+        bucket = cached_storage(bucket_name=brand_bucket_name())
+        return bucket.get_image(brand_filename())
+
+    def brand_image(self, image: Image.Image, *, brand: Optional[Image.Image] = None) -> Image.Image:
+        if brand is None:
+            brand = TwitterPoster.load_brand()
         branded = image.copy()
         branded.paste(brand, (0, 0), brand)
         return branded
 
+    @traced('twitter.post')
     def post(self, *, status: str, image: Image.Image, tags: List[str]):
+        self.tweet(status=status, tags=tags, media_id=self.upload(image))
+
+    def upload(self, image: Image.Image) -> int:
+        """
+        Upload the image to attach to a tweet. Media that is never attached is discarded by twitter,
+        so an upload can be repeated.
+        """
         auth = tweepy.OAuthHandler(
             self.keys.consumer_key,
             self.keys.consumer_secret_key)
@@ -90,6 +104,13 @@ class TwitterPoster:
             self.keys.access_token,
             self.keys.access_token_secret)
         api = tweepy.API(auth)
+        with io.BytesIO() as output:
+            image.save(output, format='PNG')
+            output.seek(0)
+            with span('twitter.media_upload', remote=True):
+                return api.media_upload(None, file=output).media_id
+
+    def tweet(self, *, status: str, tags: List[str], media_id: int):
         client = tweepy.Client(
             consumer_key=self.keys.consumer_key,
             consumer_secret=self.keys.consumer_secret_key,
@@ -98,11 +119,6 @@ class TwitterPoster:
 
         hashtags = ' '.join([f'#{tag}' for tag in tags])
         print(f'Posting "{status}" with tags {hashtags}')
-
-        image.show()
-        with io.BytesIO() as output:
-            image.save(output, format='PNG')
-            output.seek(0)
-            media = api.media_upload(None, file=output)
+        with span('twitter.create_tweet', remote=True):
             client.create_tweet(text='\n'.join(
-                [status, hashtags]), media_ids=[media.media_id])
+                [status, hashtags]), media_ids=[media_id])
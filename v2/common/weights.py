@@ -1,24 +1,60 @@
 import os
+import shutil
 import tempfile
 
-from common.storage import GcpBucketStorage
+from common.cache import cached_storage
+from common.storage import bucket_storage
 from common.config import model_bucket_name, model_filename
 from contextlib import contextmanager
+from google.api_core.exceptions import NotFound
 from typing import Optional
+from zipfile import ZipFile
+
+
+def weights_version(local_filename: Optional[str] = None, *, filename: Optional[str] = None) -> str:
+    """
+    Identify the current revision of the weights without downloading them. Cloud weights are
+    identified by their blob generation and etag, local weights by their path and modification time.
+    """
+    if local_filename:
+        return f'{os.path.abspath(local_filename)}@{os.path.getmtime(local_filename)}'
+    else:
+        bucket = bucket_storage(bucket_name=model_bucket_name())
+        blob = bucket.get(filename or model_filename())
+        if blob is None:
+            raise NotFound(
+                f'{filename or model_filename()} is not in {model_bucket_name()}, export it first')
+        return f'{blob.generation}/{blob.etag}'
 
 
 @contextmanager
-def weights(local_filename: Optional[str] = None):
+def weights(local_filename: Optional[str] = None, *, filename: Optional[str] = None):
     if local_filename:
         print(f'Loading weight locally from {local_filename}')
         yield local_filename
     else:
         print(f'Loading weights from the cloud')
-        bucket = GcpBucketStorage(bucket_name=model_bucket_name())
-        filename = '/tmp/isthemountainout.h5'
+        bucket = cached_storage(bucket_name=model_bucket_name())
+        with bucket.pinned(filename or model_filename()) as blob:
+            yield blob.path
+
+
+@contextmanager
+def model_archive(filename: str, local_directory: Optional[str] = None):
+    """
+    Yield a directory holding an exported model. Cloud models are stored as a zip of the exported
+    directory and are extracted into a temporary directory that is removed afterwards.
+    """
+    if local_directory:
+        print(f'Loading model locally from {local_directory}')
+        yield local_directory
+    else:
+        print(f'Loading model {filename} from the cloud')
+        bucket = cached_storage(bucket_name=model_bucket_name())
+        directory = tempfile.mkdtemp(prefix='isthemountainout-')
         try:
-            blob = bucket.get(model_filename())
-            blob.download_to_filename(filename)
-            yield filename
+            with bucket.pinned(filename) as blob, ZipFile(blob.path) as f:
+                f.extractall(os.path.join(directory, 'model'))
+            yield os.path.join(directory, 'model')
         finally:
-            os.unlink(filename)
+            shutil.rmtree(directory, ignore_errors=True)
@@ -0,0 +1,261 @@
+import json
+import time
+import uuid
+import random
+import threading
+
+from common.config import write_behind_bucket_name, write_behind_prefix
+from common.storage import Storage, bucket_storage
+from common.tracing import propagate, span
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import datetime, timedelta
+from google.api_core.exceptions import NotFound, PreconditionFailed
+from io import BytesIO
+from PIL import Image
+from typing import Callable, Dict, List, Optional, Tuple
+
+Handler = Callable[[dict, Optional[Image.Image]], None]
+
+TIMESTAMP_FORMAT = '%Y%m%dT%H%M%S'
+
+
+class WriteBehind:
+    """
+    Runs work that does not decide the response (state writes, posts) on background threads. Each
+    task is written to a journal in storage before submit() returns and removed once it succeeds,
+    so a task that keeps failing, or whose instance goes away, is left behind for drain() to retry.
+
+    A journaled task is leased to the instance that wrote or last claimed it for stale_after. Once
+    the lease runs out drain() claims the task by rewriting it on the condition that it is still at
+    the generation that was read, so only one instance replays it. Tasks are dropped after
+    max_replays replays, or once they are older than the max_age of their kind.
+
+    Tasks of ordered kinds run one at a time in submission order, the others run concurrently.
+    Tasks submitted without journaling are only journaled once they have failed every attempt.
+
+    A marker object is written along with every task, so drain() costs a single lookup while
+    nothing is journaled. The marker is removed by the drain that finds the journal empty.
+    """
+    attempts = 3
+    backoff_seconds = 1.0
+    # Journaled tasks younger than this may still be running on another instance
+    stale_after = timedelta(minutes=5)
+    max_replays = 5
+    marker_name = 'journaled'
+    storage: Storage
+    prefix: str
+    handlers: Dict[str, Tuple[Handler, bool, Optional[timedelta]]]
+    ordered: ThreadPoolExecutor
+    pool: ThreadPoolExecutor
+    pending: List[Future]
+    lock: threading.Lock
+
+    def __init__(self, *, storage: Storage, prefix: str, workers: int = 4):
+        self.storage = storage
+        self.prefix = prefix
+        self.handlers = {}
+        self.ordered = ThreadPoolExecutor(max_workers=1)
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+        self.pending = []
+        self.lock = threading.Lock()
+
+    def register(self, kind: str, handler: Handler, *, ordered: bool = False, max_age: Optional[timedelta] = None):
+        """
+        Tasks of kind are run by handler. Tasks older than max_age are dropped instead of replayed,
+        for work that is pointless once it is late.
+        """
+        self.handlers[kind] = (handler, ordered, max_age)
+
+    def submit(self, kind: str, payload: dict, *, image: Optional[Image.Image] = None, journal: bool = True) -> Future:
+        """
+        Journal the task, then run it in the background. The task is journaled by the time this
+        returns, so it survives the instance going away. Without journal the task is only journaled
+        if it fails, for callers that wait for their tasks anyway.
+        """
+        task_id = f'{datetime.utcnow().strftime(TIMESTAMP_FORMAT)}-{uuid.uuid4().hex[:8]}'
+        task = {
+            'id': task_id,
+            'kind': kind,
+            'payload': payload,
+            'image': f'{self.prefix}{task_id}.png' if image is not None else None,
+            'claimed': None,
+            'replays': 0,
+        }
+        generation = None
+        if journal:
+            with span('writebehind.journal', kind=kind):
+                generation = self.__journal(task, image)
+        handler, ordered, _ = self.handlers[kind]
+        executor = self.ordered if ordered else self.pool
+        return self.__track(executor.submit(propagate(self.__run), handler, task, image, generation))
+
+    def drain(self) -> Future:
+        """
+        Retry the tasks journaled by earlier invocations that never succeeded, in the background.
+        Ordered tasks are replayed before any ordered task submitted after this call.
+        """
+        return self.__track(self.ordered.submit(propagate(self.__drain)))
+
+    def flush(self):
+        """
+        Wait for every submitted task, failures are reported and stay journaled.
+        """
+        while True:
+            with self.lock:
+                pending, self.pending = self.pending, []
+            if not pending:
+                return
+            for future in pending:
+                error = future.exception()
+                if error is not None:
+                    print(f'Write behind task failed: {error}')
+
+    def __drain(self):
+        marker = self.storage.get(f'{self.prefix}{WriteBehind.marker_name}')
+        if marker is None:
+            return
+        # Kept from now on, a local file looks its generation up each time
+        marker_generation = int(marker.generation)
+        now = datetime.utcnow()
+        # Tasks that may still be journaled once this drain is done
+        remaining = 0
+        # Task names start with the time they were submitted, so this replays them in that order
+        for blob in sorted(self.storage.list_files(self.prefix), key=lambda blob: blob.name):
+            if not blob.name.endswith('.json'):
+                continue
+            try:
+                task = json.loads(blob.download_as_bytes(
+                    if_generation_match=blob.generation).decode('utf-8'))
+            except NotFound:
+                # Finished since it was listed
+                continue
+            except PreconditionFailed:
+                # Claimed since it was listed
+                remaining += 1
+                continue
+            remaining += 1
+            created = datetime.strptime(
+                task['id'].split('-')[0], TIMESTAMP_FORMAT)
+            leased = datetime.strptime(
+                task['claimed'], TIMESTAMP_FORMAT) if task.get('claimed') else created
+            if now - leased < WriteBehind.stale_after:
+                continue
+            if task['kind'] not in self.handlers:
+                print(f'No handler for {task["kind"]} task {task["id"]}, leaving it')
+                continue
+            handler, ordered, max_age = self.handlers[task['kind']]
+            replays = task.get('replays', 0)
+            if replays >= WriteBehind.max_replays or (max_age is not None and now - created > max_age):
+                print(
+                    f'Dropping {task["kind"]} task {task["id"]} submitted at {created} after {replays} replays')
+                self.__forget(task, int(blob.generation))
+                remaining -= 1
+                continue
+
+            task['claimed'] = now.strftime(TIMESTAMP_FORMAT)
+            task['replays'] = replays + 1
+            try:
+                generation = self.storage.save_bytes(json.dumps(task).encode('utf-8'), filename=blob.name,
+                                                     content_type='application/json', if_generation_match=int(blob.generation))
+            except PreconditionFailed:
+                # Another instance claimed it first
+                continue
+            image = self.storage.get_image(
+                task['image']) if task['image'] else None
+            print(f'Retrying {task["kind"]} task {task["id"]} (replay {task["replays"]})')
+            if ordered:
+                # Run it here so it finishes before the ordered tasks queued behind the drain
+                try:
+                    self.__run(handler, task, image, generation)
+                    remaining -= 1
+                except Exception:
+                    pass
+            else:
+                self.__track(self.pool.submit(
+                    propagate(self.__run), handler, task, image, generation))
+        if remaining == 0:
+            try:
+                # Unless a task was journaled since the marker was read
+                self.storage.delete(
+                    marker.name, if_generation_match=marker_generation)
+            except (NotFound, PreconditionFailed):
+                pass
+
+    def __track(self, future: Future) -> Future:
+        with self.lock:
+            self.pending.append(future)
+        return future
+
+    def __run(self, handler: Handler, task: dict, image: Optional[Image.Image], generation: Optional[int]):
+        for attempt in range(WriteBehind.attempts):
+            try:
+                with span(f'writebehind.{task["kind"]}', attempt=attempt):
+                    handler(task['payload'], image)
+                break
+            except Exception as error:
+                if attempt + 1 == WriteBehind.attempts:
+                    print(
+                        f'Giving up on {task["kind"]} task {task["id"]} for now: {error}')
+                    if generation is None:
+                        with span('writebehind.journal', kind=task['kind']):
+                            self.__journal(task, image)
+                    raise
+                self.__backoff(attempt)
+        if generation is not None:
+            self.__forget(task, generation)
+
+    def __backoff(self, attempt: int):
+        time.sleep(WriteBehind.backoff_seconds *
+                   2 ** attempt * random.uniform(0.5, 1.5))
+
+    def __journal(self, task: dict, image: Optional[Image.Image]) -> int:
+        if image is not None:
+            with BytesIO() as output:
+                image.save(output, format='PNG')
+                self.storage.save_bytes(
+                    output.getvalue(), filename=task['image'], content_type='image/png')
+        generation = self.storage.save_bytes(json.dumps(task).encode('utf-8'),
+                                             filename=f'{self.prefix}{task["id"]}.json', content_type='application/json')
+        self.storage.save_bytes(
+            b'', filename=f'{self.prefix}{WriteBehind.marker_name}', content_type='text/plain')
+        return generation
+
+    def __forget(self, task: dict, generation: int):
+        """
+        Remove the task as long as it is still at generation, once it is removed nobody replays it.
+        """
+        for attempt in range(WriteBehind.attempts):
+            try:
+                self.storage.delete(
+                    f'{self.prefix}{task["id"]}.json', if_generation_match=generation)
+                break
+            except (NotFound, PreconditionFailed):
+                # Its lease ran out and another instance claimed it, which also owns its image
+                print(f'{task["kind"]} task {task["id"]} was claimed by another instance')
+                return
+            except Exception:
+                if attempt + 1 == WriteBehind.attempts:
+                    raise
+                self.__backoff(attempt)
+        if task['image']:
+            try:
+                self.storage.delete(task['image'])
+            except NotFound:
+                pass
+
+
+_write_behind: Optional[WriteBehind] = None
+_write_behind_lock = threading.Lock()
+
+
+def write_behind() -> WriteBehind:
+    """
+    The process wide write behind stage, its threads outlive a single invocation.
+    """
+    global _write_behind
+    with _write_behind_lock:
+        if _write_behind is None:
+            _write_behind = WriteBehind(
+                storage=bucket_storage(bucket_name=write_behind_bucket_name()),
+                prefix=write_behind_prefix())
+        return _write_behind
@@ -1,29 +1,202 @@
 import os
+import json
+import time
+import shutil
 from zipfile import ZipFile
 from datetime import datetime
+from typing import Optional
+from common.encoding import PNG
 from common.image import DatasetImageProvider
+from common.pipeline import prefetch
+from PIL import Image
 import argparse
 
 parser = argparse.ArgumentParser(
     description='Utility for performing actions on dataset')
 parser.add_argument('action', choices=[
-                    'download'], help='Action to perform on dataset')
+                    'download', 'sync'], help='Action to perform on dataset')
+parser.add_argument('--workers', type=int, default=16,
+                    help='Number of images downloaded at once')
+parser.add_argument('--directory', default=os.path.join('dataset', 'sync'),
+                    help='Local dataset directory kept up to date by sync')
+parser.add_argument('--verify', action='store_true',
+                    help='List the image bucket during sync and fetch images whose generation changed')
 
 args = parser.parse_args()
 
+# Formats tf.keras.utils.image_dataset_from_directory reads, other images are converted to png
+TRAINABLE_EXTENSIONS = ('.png', '.jpg', '.jpeg')
+
+
+class Throughput:
+    """
+    Counts downloaded images and bytes, printing the rate every so often.
+    """
+    every: int
+    total: int
+    count: int
+    bytes: int
+    start: float
+
+    def __init__(self, *, total: int, every: int = 100):
+        self.every = every
+        self.total = total
+        self.count = 0
+        self.bytes = 0
+        self.start = time.perf_counter()
+
+    def add(self, size: int):
+        self.count += 1
+        self.bytes += size
+        if self.count % self.every == 0 or self.count == self.total:
+            print(self.report())
+
+    def report(self) -> str:
+        elapsed = max(time.perf_counter() - self.start, 1e-9)
+        return f'{self.count}/{self.total} images, {self.count / elapsed:.1f} images/s, {self.bytes / elapsed / 1e6:.2f} MB/s'
+
+
+def local_file_name(file_name: str) -> str:
+    root, extension = os.path.splitext(file_name)
+    return file_name if extension.lower() in TRAINABLE_EXTENSIONS else f'{root}{PNG.extension}'
+
+
+def fetch_image(provider: DatasetImageProvider, file_name: str, path: str) -> Optional[int]:
+    """
+    Download an image to path, converting it to png when training could not read it as stored
+    (snapshots may be stored as webp). Returns the generation that was downloaded.
+    """
+    generation = provider.download(file_name, f'{path}.download')
+    if local_file_name(file_name) != file_name:
+        with Image.open(f'{path}.download') as image, open(f'{path}.convert', 'wb') as output:
+            PNG.encode(image, output)
+        os.replace(f'{path}.convert', path)
+        os.unlink(f'{path}.download')
+    else:
+        os.replace(f'{path}.download', path)
+    return generation
+
 
 def download_dataset():
+    """
+    Images are downloaded concurrently into a staging directory while a single writer adds them to
+    the archive. Images already staged by an interrupted run are not downloaded again.
+    """
     provider = DatasetImageProvider()
+    staging = os.path.join('dataset', 'partial')
+    entries = [(file_name, classification)
+               for file_name, classification in provider]
+
+    def staged(entry) -> str:
+        file_name, classification = entry
+        return os.path.join(staging, classification, local_file_name(file_name))
+
+    def download(entry):
+        path = staged(entry)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fetch_image(provider, entry[0], path)
+        return entry
+
+    remaining = [entry for entry in entries if not os.path.exists(staged(entry))]
+    if len(remaining) < len(entries):
+        print(
+            f'resuming, {len(entries) - len(remaining)} of {len(entries)} images were already downloaded')
+
     now = datetime.now()
-    os.makedirs('dataset', exist_ok=True)
-    with ZipFile(os.path.join('dataset', f'dataset-{now.strftime("%Y-%m-%dT%H-%M-%S")}.zip'), 'w') as f:
-        for file_name, classification in provider:
-            newpath = os.path.join(classification, file_name)
-            print(f'writing {file_name} -> {newpath}')
-            f.writestr(newpath, provider.get(file_name).download_as_bytes())
+    archive = os.path.join(
+        'dataset', f'dataset-{now.strftime("%Y-%m-%dT%H-%M-%S")}.zip')
+    throughput = Throughput(total=len(remaining))
+    with ZipFile(f'{archive}.partial', 'w') as f:
+        for entry in entries:
+            if os.path.exists(staged(entry)):
+                f.write(staged(entry), arcname=os.path.join(
+                    entry[1], local_file_name(entry[0])))
+        for entry in prefetch(download, remaining, workers=args.workers, depth=args.workers * 4):
+            f.write(staged(entry), arcname=os.path.join(
+                entry[1], local_file_name(entry[0])))
+            throughput.add(os.path.getsize(staged(entry)))
+    os.replace(f'{archive}.partial', archive)
+    shutil.rmtree(staging)
+    print(f'wrote {len(entries)} images -> {archive} ({throughput.report()})')
+
+
+def read_manifest(path: str) -> dict:
+    """
+    The images of a synced dataset directory, by file name: {'label': ..., 'generation': ...}.
+    """
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def write_manifest(path: str, manifest: dict):
+    with open(f'{path}.tmp', 'w') as f:
+        json.dump(manifest, f)
+    os.replace(f'{path}.tmp', path)
+
+
+def sync_dataset():
+    """
+    Bring a local dataset directory (one directory per label) up to date with the labels. Only new
+    images are downloaded, relabelled images are moved between label directories and images that
+    are no longer labelled are removed.
+    """
+    provider = DatasetImageProvider()
+    manifest_path = os.path.join(args.directory, 'manifest.json')
+    manifest = read_manifest(manifest_path)
+    labels = {file_name: classification for file_name,
+              classification in provider}
+
+    def local(file_name: str, label: str) -> str:
+        return os.path.join(args.directory, label, local_file_name(file_name))
+
+    moved = removed = 0
+    for file_name, entry in list(manifest.items()):
+        label = labels.get(file_name)
+        if label is None:
+            if os.path.exists(local(file_name, entry['label'])):
+                os.unlink(local(file_name, entry['label']))
+            del manifest[file_name]
+            removed += 1
+        elif label != entry['label'] and os.path.exists(local(file_name, entry['label'])):
+            os.makedirs(os.path.join(args.directory, label), exist_ok=True)
+            os.replace(local(file_name, entry['label']),
+                       local(file_name, label))
+            entry['label'] = label
+            moved += 1
+
+    generations = {}
+    if args.verify:
+        generations = {blob.name: int(blob.generation)
+                       for blob in provider.image_storage.list_files('')}
+    fetch = [(file_name, label) for file_name, label in labels.items()
+             if file_name not in manifest
+             or manifest[file_name]['label'] != label
+             or not os.path.exists(local(file_name, label))
+             or (args.verify and generations.get(file_name) != manifest[file_name]['generation'])]
+
+    def download(entry):
+        file_name, label = entry
+        path = local(file_name, label)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        return entry, fetch_image(provider, file_name, path)
+
+    throughput = Throughput(total=len(fetch))
+    for (file_name, label), generation in prefetch(download, fetch, workers=args.workers, depth=args.workers * 4):
+        manifest[file_name] = {'label': label, 'generation': generation}
+        throughput.add(os.path.getsize(local(file_name, label)))
+        if throughput.count % 500 == 0:
+            write_manifest(manifest_path, manifest)
+    os.makedirs(args.directory, exist_ok=True)
+    write_manifest(manifest_path, manifest)
+    print(
+        f'{len(manifest)} images in {args.directory}: {len(fetch)} downloaded, {moved} relabelled, {removed} removed')
 
 
 if args.action == 'download':
     download_dataset()
+elif args.action == 'sync':
+    sync_dataset()
 else:
     print(f'Unknown action {args.action}')
@@ -0,0 +1,92 @@
+import os
+import sys
+import json
+import shutil
+import argparse
+
+from common.config import model_bucket_name, serving_model_filename, quantized_model_filename
+from common.evaluation import LabelledSamples, compare
+from common.frozenmodel import generate_inference_model
+from common.serving import export_serving_model, convert_to_tflite, KerasPredictor, TfLitePredictor
+from common.storage import bucket_storage
+from common.weights import weights
+
+parser = argparse.ArgumentParser(
+    description='Export the trained model for serving')
+parser.add_argument('format', choices=[
+                    'serving', 'tflite'], help='Model format to export')
+parser.add_argument(
+    '--local-weights', help='Set this flag to the path for the local weights filename, unset will load weights from cloud storage')
+parser.add_argument('--jit-compile', action='store_true',
+                    help='Compile the serving function with XLA')
+parser.add_argument('--quantization', choices=['dynamic', 'int8'], default='int8',
+                    help='Quantization to apply when exporting a tflite model')
+parser.add_argument('--calibration-count', type=int, default=100,
+                    help='Number of dataset images used to calibrate int8 quantization')
+parser.add_argument('--evaluation-count', type=int, default=500,
+                    help='Number of labelled dataset images used to compare the tflite model against the keras model')
+parser.add_argument('--max-accuracy-drop', type=float, default=0.01,
+                    help='Refuse to upload a tflite model that loses more accuracy than this')
+parser.add_argument('--upload', action='store_true',
+                    help='Upload the exported model to cloud storage')
+
+args = parser.parse_args()
+
+
+def export_serving():
+    directory = os.path.join('export', 'isthemountainout.serving')
+    with weights(local_filename=args.local_weights) as filepath:
+        model = generate_inference_model(weights_filepath=filepath)
+    print(f'exporting serving model -> {directory}')
+    shutil.rmtree(directory, ignore_errors=True)
+    export_serving_model(model, directory, jit_compile=args.jit_compile)
+    archive = shutil.make_archive(directory, 'zip', root_dir=directory)
+    print(f'archived {directory} -> {archive}')
+    if args.upload:
+        print(f'uploading {archive} -> {serving_model_filename()}')
+        bucket_storage(bucket_name=model_bucket_name()).save_file(
+            archive, filename=serving_model_filename())
+
+
+def export_tflite():
+    filename = os.path.join(
+        'export', f'isthemountainout.{args.quantization}.tflite')
+    with weights(local_filename=args.local_weights) as filepath:
+        model = generate_inference_model(weights_filepath=filepath)
+        keras_bytes = os.path.getsize(filepath)
+
+    samples = LabelledSamples.sample(
+        count=args.calibration_count + args.evaluation_count)
+    # Only evaluate on images that were not used for calibration
+    calibration, evaluation = samples.split(args.calibration_count)
+    print(f'converting model with {args.quantization} quantization -> {filename}')
+    content = convert_to_tflite(
+        model,
+        quantization=args.quantization,
+        representative_images=calibration.arrays)
+    os.makedirs('export', exist_ok=True)
+    with open(filename, 'wb') as f:
+        f.write(content)
+
+    results = compare(KerasPredictor(model),
+                      TfLitePredictor.from_file(filename), evaluation)
+    results['keras_bytes'] = keras_bytes
+    results['tflite_bytes'] = len(content)
+    print(json.dumps(results, indent=2))
+
+    if results['accuracy_drop'] > args.max_accuracy_drop:
+        print(
+            f'Accuracy dropped by {results["accuracy_drop"]:.4f} which is more than {args.max_accuracy_drop}, not uploading')
+        sys.exit(1)
+    if args.upload:
+        print(f'uploading {filename} -> {quantized_model_filename()}')
+        bucket_storage(bucket_name=model_bucket_name()).save_file(
+            filename, filename=quantized_model_filename())
+
+
+if args.format == 'serving':
+    export_serving()
+elif args.format == 'tflite':
+    export_tflite()
+else:
+    print(f'Unknown format {args.format}')
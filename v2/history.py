@@ -0,0 +1,107 @@
+import os
+import json
+import time
+import argparse
+
+from common.config import state_store_backend
+from common.frozenmodel import Label
+from common.history import ColumnarHistory
+from common.solar import PACIFIC_TIMEZONE
+from common.state import state_store
+from datetime import datetime
+
+parser = argparse.ArgumentParser(
+    description='Export the classification history to a columnar file and query it')
+parser.add_argument('action', choices=[
+                    'export', 'sync', 'query'], help='Action to perform on the history')
+parser.add_argument('--file', default=os.path.join('history', 'history.npz'),
+                    help='Columnar history file to write or query')
+parser.add_argument('--page-size', type=int, default=5000,
+                    help='Number of rows read from the state store per request')
+parser.add_argument('--query', choices=['counts', 'hours', 'streaks', 'visibility'], default='counts',
+                    help='Query to run')
+parser.add_argument('--label', choices=[label.value for label in Label], default=Label.BEAUTIFUL.value,
+                    help='Label the hours and streaks queries are about')
+parser.add_argument('--by', choices=['day', 'month'], default='month',
+                    help='Period the hours query is grouped by')
+parser.add_argument('--start', help='Only query classifications from this timestamp on')
+parser.add_argument('--end', help='Only query classifications before this timestamp')
+
+args = parser.parse_args()
+
+
+def sync_history(history: ColumnarHistory) -> ColumnarHistory:
+    store = state_store()
+    try:
+        while True:
+            rows, position = store.read_since(
+                history.position, limit=args.page_size)
+            if position == history.position:
+                return history
+            history = history.extend(rows, position=position)
+            print(f'read {len(rows)} rows, {len(history)} in total')
+    finally:
+        store.close()
+
+
+def export_history():
+    os.makedirs(os.path.dirname(args.file) or '.', exist_ok=True)
+    history = sync_history(ColumnarHistory.empty(source=state_store_backend()))
+    history.save(args.file)
+    print(f'wrote {len(history)} classifications -> {args.file}')
+
+
+def update_history():
+    if not os.path.exists(args.file):
+        export_history()
+        return
+    history = ColumnarHistory.load(args.file)
+    if history.source != state_store_backend():
+        raise Exception(
+            f'{args.file} was exported from {history.source}, export it again from {state_store_backend()}')
+    count = len(history)
+    history = sync_history(history)
+    history.save(args.file)
+    print(f'added {len(history) - count} classifications -> {args.file}')
+
+
+def query_history():
+    history = ColumnarHistory.load(args.file).between(
+        datetime.strptime(
+            args.start, '%Y-%m-%dT%H:%M:%S') if args.start else None,
+        datetime.strptime(args.end, '%Y-%m-%dT%H:%M:%S') if args.end else None)
+    label = Label(args.label)
+    start = time.perf_counter()
+    if args.query == 'counts':
+        result = {label.value: count for label,
+                  count in history.counts().items()}
+    elif args.query == 'hours':
+        periods, hours = history.hours(label, by=args.by)
+        result = {str(period): round(float(hour), 2)
+                  for period, hour in zip(periods, hours)}
+    elif args.query == 'streaks':
+        starts, lengths = history.streaks(label)
+        longest = lengths.argsort()[::-1][:10]
+        result = [{'start': datetime.fromtimestamp(int(starts[index]), tz=PACIFIC_TIMEZONE).isoformat(), 'classifications': int(lengths[index])}
+                  for index in longest]
+    else:
+        days, visible, counts = history.daily_visibility()
+        result = {
+            'days': int(len(days)),
+            'visible_days': int(visible.sum()),
+            'visible': {str(day): int(count) for day, count in zip(days, counts) if count},
+        }
+    elapsed_ms = (time.perf_counter() - start) * 1000
+    print(json.dumps(result, indent=2))
+    print(
+        f'queried {len(history)} classifications in {elapsed_ms:.1f}ms')
+
+
+if args.action == 'export':
+    export_history()
+elif args.action == 'sync':
+    update_history()
+elif args.action == 'query':
+    query_history()
+else:
+    print(f'Unknown action {args.action}')
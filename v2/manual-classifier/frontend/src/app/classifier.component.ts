@@ -36,7 +36,7 @@ export class ClassifierComponent implements OnDestroy {
         if (file) {
           return this.history
             .image(file.name)
-            .pipe(map((imageBase64) => ({ file, imageBase64 })));
+            .pipe(map((image) => ({ file, image })));
         } else {
           return of(undefined);
         }
@@ -57,7 +57,7 @@ export class ClassifierComponent implements OnDestroy {
             title: 'Mt. Rainier',
             subTitle: content.file.name,
             fileName: content.file.name,
-            imageBase64Url: `data:image/png;base64,${content.imageBase64}`,
+            imageBase64Url: `data:${content.image.contentType};base64,${content.image.base64}`,
           };
         } else {
           return undefined;
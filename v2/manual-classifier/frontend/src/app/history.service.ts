@@ -17,20 +17,27 @@ export class HistoryService {
     ).pipe(map((response) => response.data.mountainFiles as MountainFile[]));
   }
 
-  image(filename: string): Observable<string> {
+  image(filename: string): Observable<MountainImage> {
     return from(
       axios.get(`/api/mountain/history/${filename}`, {
         responseType: 'arraybuffer',
         params: this.route.snapshot.queryParams,
       }),
     ).pipe(
-      map((response) =>
-        Buffer.from(response.data, 'binary').toString('base64'),
-      ),
+      map((response) => ({
+        base64: Buffer.from(response.data, 'binary').toString('base64'),
+        // Snapshots are stored as png, webp or jpeg
+        contentType: response.headers['content-type'] ?? 'image/png',
+      })),
     );
   }
 }
 
+export interface MountainImage {
+  readonly base64: string;
+  readonly contentType: string;
+}
+
 export interface MountainFile {
   readonly name: string;
   readonly datetime: string;
@@ -39,7 +39,9 @@ export class MountainController {
               name: file.name,
               datetime: this.formatter.format(
                 new Date(
-                  file.name.replace('MountRainier-', '').replace('.png', ''),
+                  file.name
+                    .replace('MountRainier-', '')
+                    .replace(/\.(png|webp|jpg)$/, ''),
                 ),
               ),
             };
@@ -64,6 +66,7 @@ export class MountainController {
         sendFile(
           // eslint-disable-next-line @typescript-eslint/no-non-null-assertion
           Buffer.from(this.imageCache.get(filename)!, 'base64'),
+          contentType(filename),
           response,
           resolve,
         );
@@ -81,15 +84,26 @@ export class MountainController {
       return file.download().then((content) => {
         return new Promise((resolve) => {
           this.imageCache.set(filename, content[0].toString('base64'));
-          sendFile(content[0], response, resolve);
+          sendFile(content[0], contentType(filename), response, resolve);
         });
       });
     });
   }
 }
 
+function contentType(filename: string): string {
+  if (filename.endsWith('.webp')) {
+    return 'image/webp';
+  }
+  if (filename.endsWith('.jpg')) {
+    return 'image/jpeg';
+  }
+  return 'image/png';
+}
+
 function sendFile(
   content: Buffer,
+  type: string,
   response: Response,
   resolve: (value: StreamableFile) => void,
 ) {
@@ -97,7 +111,7 @@ function sendFile(
     writeFileSync(path, content);
     content.toString('base64');
     response.set({
-      'Content-Type': 'image/png',
+      'Content-Type': type,
       'Content-Disposition': `inline`,
     });
     const f = createReadStream(path);
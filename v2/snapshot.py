@@ -1,7 +1,9 @@
 from datetime import datetime, date as Date
 from common.image import SpaceNeedleImageProvider, ImageEditor
-from common.storage import GcpBucketStorage
-from common.config import mountain_history_bucket_name, mountain_history_filename_template
+from common.storage import bucket_storage
+from common.config import mountain_history_bucket_name, mountain_history_filename_template, snapshot_format
+from common.encoding import image_format
+from google.api_core.exceptions import PreconditionFailed
 import pytz
 
 PACIFIC_TIMEZONE = pytz.timezone('US/Pacific')
@@ -20,9 +22,13 @@ def main(request):
     if today() != date.date():
         f'Image date [{date_str}] and today {today_str} do not match, not storing image.', 412
     else:
-        storage = GcpBucketStorage(bucket_name=mountain_history_bucket_name())
-        storage.save_image(image, filename=date.strftime(
-            mountain_history_filename_template()))
+        storage = bucket_storage(bucket_name=mountain_history_bucket_name())
+        try:
+            # Streamed so the encoded snapshot is never held in memory next to the image
+            storage.save_image(image, filename=date.strftime(
+                mountain_history_filename_template()), image_format=image_format(snapshot_format()), stream=True)
+        except PreconditionFailed:
+            print(f'Snapshot for {date} was already stored')
         return '', 200
 
 
@@ -0,0 +1,415 @@
+"""
+Local stand-ins for the remote services used by classify.py (cloud storage, sheets, twitter and
+the roundshot camera) so the pipeline can be run and benchmarked without network access.
+"""
+import os
+import re
+import io
+import time
+import threading
+import numpy as np
+
+from collections import defaultdict
+from datetime import datetime
+from google.api_core.exceptions import NotFound, NotModified, PreconditionFailed
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from PIL import Image
+from typing import Dict, List, Optional
+
+
+class CallRecorder:
+    """
+    Records how long each stand-in call took, optionally simulating a fixed round-trip latency.
+    """
+    latency: float
+    calls: Dict[str, List[float]]
+    lock: threading.Lock
+
+    def __init__(self, *, latency_ms: float = 0):
+        self.latency = latency_ms / 1000
+        self.calls = defaultdict(list)
+        self.lock = threading.Lock()
+
+    def call(self, name: str, function, *args, **kwargs):
+        start = time.perf_counter()
+        if self.latency:
+            time.sleep(self.latency)
+        try:
+            return function(*args, **kwargs)
+        finally:
+            with self.lock:
+                self.calls[name].append(
+                    (time.perf_counter() - start) * 1000)
+
+    def reset(self):
+        with self.lock:
+            self.calls = defaultdict(list)
+
+
+class FakeBlob:
+    bucket: 'FakeBucket'
+    name: str
+
+    def __init__(self, bucket: 'FakeBucket', name: str):
+        self.bucket = bucket
+        self.name = name
+
+    @property
+    def path(self) -> str:
+        return os.path.join(self.bucket.root, self.name)
+
+    @property
+    def generation(self) -> Optional[int]:
+        return os.stat(self.path).st_mtime_ns if os.path.exists(self.path) else None
+
+    @property
+    def etag(self) -> Optional[str]:
+        generation = self.generation
+        return None if generation is None else f'etag-{generation}'
+
+    @property
+    def size(self) -> Optional[int]:
+        return os.path.getsize(self.path) if os.path.exists(self.path) else None
+
+    def exists(self) -> bool:
+        return os.path.exists(self.path)
+
+    def check_generation(self, if_generation_match: Optional[int]):
+        if if_generation_match is not None and (self.generation or 0) != if_generation_match:
+            raise PreconditionFailed(self.name)
+
+    def download_as_bytes(self, *, if_generation_match: Optional[int] = None, **kwargs) -> bytes:
+        self.check_generation(if_generation_match)
+
+        def read():
+            with open(self.path, 'rb') as f:
+                return f.read()
+        return self.bucket.recorder.call('storage.download', read)
+
+    def download_as_string(self, **kwargs) -> bytes:
+        return self.download_as_bytes(**kwargs)
+
+    def download_to_filename(self, filename: str, *, if_generation_not_match: Optional[int] = None, **kwargs):
+        if not self.exists():
+            raise NotFound(self.name)
+        if if_generation_not_match is not None and if_generation_not_match == self.generation:
+            self.bucket.recorder.call('storage.download', lambda: None)
+            raise NotModified(self.name)
+        data = self.download_as_bytes(**kwargs)
+        with open(filename, 'wb') as f:
+            f.write(data)
+
+    def upload_from_string(self, data, *, if_generation_match: Optional[int] = None, **kwargs):
+        self.check_generation(if_generation_match)
+
+        def write():
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(self.path, 'wb') as f:
+                f.write(data if isinstance(data, bytes) else data.encode('utf-8'))
+        self.bucket.recorder.call('storage.upload', write)
+
+    def delete(self, *, if_generation_match: Optional[int] = None, **kwargs):
+        if not self.exists():
+            raise NotFound(self.name)
+        self.check_generation(if_generation_match)
+        self.bucket.recorder.call('storage.delete', lambda: os.remove(self.path))
+
+    def upload_from_filename(self, filename: str, **kwargs):
+        with open(filename, 'rb') as f:
+            self.upload_from_string(f.read(), **kwargs)
+
+
+class FakeBucket:
+    name: str
+    root: str
+    recorder: CallRecorder
+
+    def __init__(self, name: str, *, root: str, recorder: CallRecorder):
+        self.name = name
+        self.root = os.path.join(root, name)
+        self.recorder = recorder
+        os.makedirs(self.root, exist_ok=True)
+
+    def blob(self, name: str, **kwargs) -> FakeBlob:
+        return FakeBlob(self, name)
+
+    def get_blob(self, name: str, **kwargs) -> Optional[FakeBlob]:
+        blob = FakeBlob(self, name)
+        return self.recorder.call('storage.get_blob', lambda: blob if blob.exists() else None)
+
+    def list_blobs(self, prefix: str = '', **kwargs) -> List[FakeBlob]:
+        def list_all():
+            names = []
+            for directory, _, filenames in os.walk(self.root):
+                for filename in filenames:
+                    names.append(os.path.relpath(
+                        os.path.join(directory, filename), self.root))
+            return [FakeBlob(self, name) for name in sorted(names) if name.startswith(prefix)]
+        return self.recorder.call('storage.list_blobs', list_all)
+
+
+class FakeStorageClient:
+    """
+    Replacement for google.cloud.storage.Client where every bucket is a directory under root.
+    """
+    root: str
+    recorder: CallRecorder
+
+    def __init__(self, *, root: str, recorder: CallRecorder):
+        self.root = root
+        self.recorder = recorder
+
+    def __call__(self, *args, **kwargs) -> 'FakeStorageClient':
+        # Installed in place of the Client class, so constructing a client returns this instance
+        return self
+
+    def bucket(self, name: str) -> FakeBucket:
+        return FakeBucket(name, root=self.root, recorder=self.recorder)
+
+    def get_bucket(self, name: str) -> FakeBucket:
+        return self.recorder.call('storage.get_bucket', lambda: self.bucket(name))
+
+    def list_blobs(self, bucket_name: str, prefix: str = '', **kwargs) -> List[FakeBlob]:
+        return self.bucket(bucket_name).list_blobs(prefix=prefix)
+
+
+class FakeRequest:
+    recorder: CallRecorder
+    name: str
+    function: callable
+
+    def __init__(self, recorder: CallRecorder, name: str, function):
+        self.recorder = recorder
+        self.name = name
+        self.function = function
+
+    def execute(self, **kwargs):
+        return self.recorder.call(self.name, self.function)
+
+
+class FakeSheetsService:
+    """
+    In memory replacement for the sheets v4 resource. Each sheet holds its data rows starting at
+    row 2, row 1 being the header.
+    """
+    recorder: CallRecorder
+    sheets: Dict[str, List[List[str]]]
+
+    def __init__(self, *, recorder: CallRecorder, sheets: Dict[str, List[List[str]]]):
+        self.recorder = recorder
+        self.sheets = sheets
+
+    def __call__(self, *args, **kwargs) -> 'FakeSheetsService':
+        # Installed in place of googleapiclient.discovery.build
+        return self
+
+    def spreadsheets(self) -> 'FakeSheetsService':
+        return self
+
+    def values(self) -> 'FakeSheetsService':
+        return self
+
+    def get(self, *, spreadsheetId: str, range: Optional[str] = None, **kwargs) -> FakeRequest:
+        if range is None:
+            return FakeRequest(self.recorder, 'sheets.get', lambda: self.__metadata(**kwargs))
+        return FakeRequest(self.recorder, 'sheets.values.get', lambda: self.__values(range))
+
+    def append(self, *, spreadsheetId: str, range: str, body: dict, **kwargs) -> FakeRequest:
+        return FakeRequest(self.recorder, 'sheets.values.append', lambda: self.__append(range, body['values']))
+
+    def batchUpdate(self, *, spreadsheetId: str, body: dict) -> FakeRequest:
+        return FakeRequest(self.recorder, 'sheets.batchUpdate', lambda: self.__batch_update(body['requests']))
+
+    def __sheet_named(self, sheet_name: str) -> List[List[str]]:
+        return self.sheets.setdefault(sheet_name, [])
+
+    def __sheet_with_id(self, sheet_id: int) -> List[List[str]]:
+        return self.__sheet_named(list(self.sheets.keys())[sheet_id])
+
+    def __metadata(self, *, ranges: Optional[List[str]] = None, includeGridData: bool = False, **kwargs) -> dict:
+        sheets = [{
+            'properties': {
+                'sheetId': index,
+                'title': title,
+                'gridProperties': {'rowCount': len(rows) + 1},
+            },
+        } for index, (title, rows) in enumerate(self.sheets.items())]
+        if includeGridData:
+            for range in ranges or []:
+                sheet_name, start, end = self.__parse_range(range)
+                rows = self.__sheet_named(sheet_name)
+                sheet = next(
+                    sheet for sheet in sheets if sheet['properties']['title'] == sheet_name)
+                sheet.setdefault('data', []).append({
+                    'startRow': start - 1,
+                    'rowData': [{'values': [{'formattedValue': value} for value in row[:3]]}
+                                for row in rows[max(0, start - 2):max(0, end - 1)]],
+                })
+        return {'sheets': sheets}
+
+    def __values(self, range: str) -> dict:
+        sheet_name, start, end = self.__parse_range(range)
+        rows = self.__sheet_named(sheet_name)
+        values = [row[:3] for row in rows[max(0, start - 2):max(0, end - 1)]]
+        return {'range': range, 'values': values}
+
+    def __append(self, range: str, values: List[List[str]]) -> dict:
+        sheet_name, _, _ = self.__parse_range(range)
+        rows = self.__sheet_named(sheet_name)
+        first_row = len(rows) + 2
+        for value in values:
+            if any(value):
+                rows.append(list(value))
+        return {'updates': {'updatedRange': f'{sheet_name}!A{first_row}:C{first_row + len(values) - 1}'}}
+
+    def __batch_update(self, requests: List[dict]) -> dict:
+        for request in requests:
+            if 'copyPaste' in request:
+                self.__copy_paste(**request['copyPaste'])
+            else:
+                raise NotImplementedError(
+                    f'FakeSheetsService does not support {", ".join(request)}')
+        return {'replies': [{} for _ in requests]}
+
+    def __copy_paste(self, *, source: dict, destination: dict, **kwargs):
+        """
+        Copy the source grid over the destination grid, repeating it to fill the destination like
+        sheets does. Cells are copied as they are held, formulas are not evaluated.
+        """
+        source_rows = self.__sheet_with_id(source['sheetId'])
+        rows = self.__sheet_with_id(destination['sheetId'])
+        # Grid row index 0 is the header, which is not held
+        copied = [[self.__cell(source_rows, row_index, column_index)
+                   for column_index in range(source['startColumnIndex'], source['endColumnIndex'])]
+                  for row_index in range(source['startRowIndex'], source['endRowIndex'])]
+        for offset, row_index in enumerate(range(destination['startRowIndex'], destination['endRowIndex'])):
+            if row_index < 1 or row_index > len(rows):
+                continue
+            row = rows[row_index - 1]
+            for column_offset, column_index in enumerate(range(destination['startColumnIndex'], destination['endColumnIndex'])):
+                source_row = copied[offset % len(copied)]
+                row.extend([''] * (column_index + 1 - len(row)))
+                row[column_index] = source_row[column_offset % len(source_row)]
+
+    def __cell(self, rows: List[List[str]], row_index: int, column_index: int) -> str:
+        if row_index < 1 or row_index > len(rows):
+            return ''
+        row = rows[row_index - 1]
+        return row[column_index] if column_index < len(row) else ''
+
+    def __parse_range(self, range: str):
+        sheet_name, _, cells = range.partition('!')
+        rows = [int(row) if row else None for row in re.findall(
+            r'[A-Z]+(\d*)', cells)]
+        start = rows[0] or 2
+        end = rows[-1] if len(rows) > 1 and rows[-1] else 10 ** 9
+        return sheet_name, start, end
+
+
+class FakeTwitterMedia:
+    media_id: int
+
+    def __init__(self, media_id: int):
+        self.media_id = media_id
+
+
+class FakeTwitter:
+    """
+    Stands in for tweepy.OAuthHandler, tweepy.API and tweepy.Client at once.
+    """
+    recorder: CallRecorder
+    tweets: List[dict]
+
+    def __init__(self, *, recorder: CallRecorder):
+        self.recorder = recorder
+        self.tweets = []
+
+    def __call__(self, *args, **kwargs) -> 'FakeTwitter':
+        return self
+
+    def set_access_token(self, *args):
+        pass
+
+    def media_upload(self, filename, *, file: io.IOBase, **kwargs) -> FakeTwitterMedia:
+        return self.recorder.call('twitter.media_upload', lambda: FakeTwitterMedia(len(file.read())))
+
+    def create_tweet(self, *, text: str, media_ids: List[int], **kwargs):
+        return self.recorder.call('twitter.create_tweet', lambda: self.tweets.append({'text': text, 'media_ids': media_ids}))
+
+
+class CameraServer:
+    """
+    Serves a generated panorama the way roundshot does, the camera url redirects to a timestamped
+    url of the latest image.
+    """
+    image: bytes
+    date: datetime
+    server: ThreadingHTTPServer
+    thread: threading.Thread
+
+    def __init__(self, *, size=(14000, 3000), date: Optional[datetime] = None, quality: int = 90):
+        self.image = panorama_jpeg(size=size, quality=quality)
+        self.date = date or datetime.now()
+        camera = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_HEAD(self):
+                self.__respond(body=False)
+
+            def do_GET(self):
+                self.__respond(body=True)
+
+            def __respond(self, *, body: bool):
+                if self.path == '/cams/241/original':
+                    self.send_response(302)
+                    self.send_header('Location', camera.image_path)
+                    self.end_headers()
+                elif self.path == camera.image_path:
+                    self.send_response(200)
+                    self.send_header('Content-Type', 'image/jpeg')
+                    self.send_header('Content-Length', str(len(camera.image)))
+                    self.end_headers()
+                    if body:
+                        self.wfile.write(camera.image)
+                else:
+                    self.send_response(404)
+                    self.end_headers()
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.thread = threading.Thread(
+            target=self.server.serve_forever, daemon=True)
+
+    @property
+    def image_path(self) -> str:
+        return self.date.strftime('/standin/%Y-%m-%d/%H-%M-%S/%Y-%m-%d-%H-%M-%S_original.jpg')
+
+    @property
+    def url(self) -> str:
+        return f'http://127.0.0.1:{self.server.server_address[1]}/cams/241/original'
+
+    def __enter__(self) -> 'CameraServer':
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def panorama_jpeg(*, size, quality: int = 90) -> bytes:
+    """
+    A smooth random image with some noise so it compresses roughly like a real photo.
+    """
+    width, height = size
+    rng = np.random.default_rng(0)
+    coarse = rng.integers(0, 255, size=(height // 64 + 1, width // 64 + 1, 3), dtype=np.uint8)
+    image = Image.fromarray(coarse).resize((width, height), Image.BILINEAR)
+    noise = rng.integers(-8, 8, size=(height, width, 3))
+    image = Image.fromarray(
+        np.clip(np.asarray(image, dtype=np.int16) + noise, 0, 255).astype(np.uint8))
+    with io.BytesIO() as output:
+        image.save(output, format='JPEG', quality=quality)
+        return output.getvalue()
@@ -0,0 +1,46 @@
+import json
+import pytest
+
+from common.jsonstream import JsonObjectStream
+
+DOCUMENT = json.dumps({
+    'MountRainier-2022-07-02T14:40:00.png': {'classification': 'Beautiful', 'mountainPosition': [1.25, 2e5]},
+    'MountRainier-2022-07-02T14:50:00.png': {'classification': 'Mystical', 'mountainPosition': [-1.5e10, 0]},
+    'negative': -12,
+    'fraction': 0.125,
+    'exponent': 6.02e23,
+    'flags': [True, False, None],
+    'text': 'Mount Rainier é☃ "quoted" \\ escaped',
+    'empty': {},
+    'last': 123456789,
+}).encode('utf-8')
+
+
+def chunks_of(data: bytes, size: int):
+    return [data[index:index + size] for index in range(0, len(data), size)]
+
+
+@pytest.mark.parametrize('size', [1, 2, 3, 5, 7, 16, 64, len(DOCUMENT)])
+def test_reads_members_split_across_chunks(size):
+    assert list(JsonObjectStream(chunks_of(DOCUMENT, size))) == list(
+        json.loads(DOCUMENT).items())
+
+
+@pytest.mark.parametrize('chunks', [
+    [b'{"a": 1.', b'25}'],
+    [b'{"a": 2', b'e5}'],
+    [b'{"a": -1.5e', b'10, "b": 1', b'}'],
+    [b'{"a": 1', b'2', b'3 }'],
+])
+def test_reads_numbers_split_across_chunks(chunks):
+    assert list(JsonObjectStream(chunks)) == list(
+        json.loads(b''.join(chunks)).items())
+
+
+def test_reads_empty_object():
+    assert list(JsonObjectStream([b' { ', b'} '])) == []
+
+
+def test_rejects_truncated_object():
+    with pytest.raises(ValueError):
+        list(JsonObjectStream([b'{"a": 1, "b": ']))
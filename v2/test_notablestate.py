@@ -0,0 +1,122 @@
+import random
+import pytest
+
+from datetime import datetime, timedelta
+
+# The state module pulls in the model and the Google clients
+state = pytest.importorskip('common.state')
+sheets = pytest.importorskip('common.sheets')
+frozenmodel = pytest.importorskip('common.frozenmodel')
+
+Label = frozenmodel.Label
+ClassificationRow = sheets.ClassificationRow
+NotableState = state.NotableState
+
+HISTORY_SIZE = 100
+START = datetime(2022, 7, 1, 4, 0)
+
+
+def rescan_last_notable(rows, *, yesterday):
+    """
+    How the tracker found the last notable classification before the state was kept incrementally.
+    """
+    for row in reversed(rows[-HISTORY_SIZE:]):
+        if row.was_posted or row.classification == Label.NIGHT:
+            return row.classification
+        elif row.date.date() == yesterday:
+            return Label.NIGHT
+    return Label.NIGHT
+
+
+def rescan_settles_with(rows, classification):
+    return all(row.classification == classification for row in rows[-2:])
+
+
+def row(date: datetime, classification: Label, was_posted: bool = False):
+    return ClassificationRow(date=date, classification=classification, was_posted=was_posted)
+
+
+def random_rows(seed: int, count: int):
+    generator = random.Random(seed)
+    date = START
+    rows = []
+    for _ in range(count):
+        # Mostly every 10 minutes, sometimes skipping ahead to a later day
+        date += timedelta(minutes=10) if generator.random() < 0.95 else timedelta(hours=generator.randint(6, 40))
+        classification = generator.choice(list(Label))
+        rows.append(row(date, classification, was_posted=classification !=
+                    Label.NIGHT and generator.random() < 0.1))
+    return rows
+
+
+def assert_matches_rescan(rows):
+    notable = NotableState()
+    for index, appended in enumerate(rows):
+        notable.update(appended)
+        # As if the state was saved and read back by another process
+        notable = NotableState.from_dict(notable.as_dict())
+        seen = rows[:index + 1]
+        assert notable.includes(appended)
+        assert not notable.includes(row(appended.date + timedelta(seconds=1), appended.classification))
+        for yesterday in {appended.date.date() - timedelta(days=days) for days in range(3)}:
+            assert notable.last_notable_classification(yesterday=yesterday, history_size=HISTORY_SIZE) == \
+                rescan_last_notable(seen, yesterday=yesterday), f'after {appended}, yesterday {yesterday}'
+        for classification in Label:
+            assert notable.settles_with(classification, count=2) == rescan_settles_with(seen, classification), \
+                f'after {appended}, settling with {classification}'
+
+
+@pytest.mark.parametrize('seed', range(8))
+def test_matches_rescan_of_random_history(seed):
+    assert_matches_rescan(random_rows(seed, 400))
+
+
+def test_empty_history_settles_and_assumes_night():
+    notable = NotableState()
+    assert notable.settles_with(Label.BEAUTIFUL, count=2)
+    assert notable.last_notable_classification(
+        yesterday=START.date(), history_size=HISTORY_SIZE) == Label.NIGHT
+
+
+def test_unposted_rows_since_yesterday_reset_to_night():
+    yesterday = START + timedelta(days=1)
+    today = START + timedelta(days=2)
+    rows = [
+        row(START + timedelta(hours=8), Label.BEAUTIFUL, was_posted=True),
+        row(yesterday + timedelta(hours=8), Label.BEAUTIFUL),
+        row(today + timedelta(hours=8), Label.BEAUTIFUL),
+    ]
+    notable = NotableState.rebuild(rows)
+    assert notable.last_notable_classification(
+        yesterday=yesterday.date(), history_size=HISTORY_SIZE) == Label.NIGHT
+    # The day after, yesterday's row is the one from today
+    assert notable.last_notable_classification(
+        yesterday=today.date(), history_size=HISTORY_SIZE) == Label.NIGHT
+    assert notable.last_notable_classification(
+        yesterday=START.date() - timedelta(days=1), history_size=HISTORY_SIZE) == Label.BEAUTIFUL
+    assert_matches_rescan(rows)
+
+
+def test_night_is_notable_without_being_posted():
+    yesterday = START + timedelta(days=1)
+    rows = [
+        row(START + timedelta(hours=8), Label.BEAUTIFUL, was_posted=True),
+        row(yesterday + timedelta(hours=22), Label.NIGHT),
+        row(yesterday + timedelta(hours=30), Label.HIDDEN),
+    ]
+    notable = NotableState.rebuild(rows)
+    assert notable.last_notable_classification(
+        yesterday=yesterday.date() - timedelta(days=1), history_size=HISTORY_SIZE) == Label.NIGHT
+    assert notable.last_notable == Label.NIGHT
+    assert notable.last_posted_date == rows[0].date
+    assert_matches_rescan(rows)
+
+
+def test_notable_row_past_the_history_is_forgotten():
+    rows = [row(START, Label.BEAUTIFUL, was_posted=True)] + \
+        [row(START + timedelta(minutes=index + 1), Label.HIDDEN)
+         for index in range(HISTORY_SIZE)]
+    assert_matches_rescan(rows[:-1])
+    assert_matches_rescan(rows)
+    assert NotableState.rebuild(rows).last_notable_classification(
+        yesterday=START.date() - timedelta(days=1), history_size=HISTORY_SIZE) == Label.NIGHT